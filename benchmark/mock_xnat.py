@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+"""Local stand-in for the parts of the XNAT REST API that dicom2bids.py uses.
+
+Serves an archive directory laid out the way XNAT stores sessions on disk:
+
+    <root>/state.json                                   project, sessions, scans and BIDS maps
+    <root>/archive/<session>/SCANS/<scan>/<resource>/   scan resource files (DICOM, NIFTI, BIDS)
+    <root>/archive/<session>/RESOURCES/<resource>/      session resource files
+
+state.json is written by synth_session.py. Uploads and deletes change the archive directory,
+so the result of a conversion can be inspected (or fed to xnat2bids.py) afterwards.
+
+Every request is counted by category (metadata, download, upload, delete) together with the
+bytes received and sent. GET /_mock/stats returns the counters as JSON; add ?reset=1 to clear them.
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+import zipfile
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+CATEGORIES = ["metadata", "download", "upload", "delete", "other"]
+
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counts = {c: {"requests": 0, "bytesIn": 0, "bytesOut": 0} for c in CATEGORIES}
+        self.started = time.time()
+
+    def add(self, category, bytesIn, bytesOut):
+        with self.lock:
+            entry = self.counts[category]
+            entry["requests"] += 1
+            entry["bytesIn"] += bytesIn
+            entry["bytesOut"] += bytesOut
+
+    def snapshot(self, reset=False):
+        with self.lock:
+            result = {"seconds": round(time.time() - self.started, 3), "categories": json.loads(json.dumps(self.counts))}
+            result["requests"] = sum(c["requests"] for c in self.counts.values())
+            result["bytesIn"] = sum(c["bytesIn"] for c in self.counts.values())
+            result["bytesOut"] = sum(c["bytesOut"] for c in self.counts.values())
+            if reset:
+                self.reset()
+            return result
+
+
+class MockXnat(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, root, hideAbsolutePath=False, latency=0.0, verbose=False):
+        ThreadingHTTPServer.__init__(self, address, Handler)
+        self.root = root
+        self.archive = os.path.join(root, "archive")
+        self.hideAbsolutePath = hideAbsolutePath
+        self.latency = latency
+        self.verbose = verbose
+        self.stats = Stats()
+        with open(os.path.join(root, "state.json")) as f:
+            self.state = json.load(f)
+        self.lastModified = formatdate(os.path.getmtime(os.path.join(root, "state.json")), usegmt=True)
+
+    def digest(self, filePath):
+        # XNAT lists an MD5 digest for each file
+        with open(filePath, "rb") as f:
+            return hashlib.md5(f.read()).hexdigest()
+
+    def scanDir(self, session, scanid, resource=None):
+        path = os.path.join(self.archive, session, "SCANS", scanid)
+        return os.path.join(path, resource) if resource else path
+
+    def sessionResourceDir(self, session, resource=None):
+        path = os.path.join(self.archive, session, "RESOURCES")
+        return os.path.join(path, resource) if resource else path
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    # Plumbing
+
+    def parse(self):
+        # Connections are kept alive, so counters are per request
+        self.bytesIn = 0
+        url = urlparse(self.path)
+        self.query = dict(parse_qsl(url.query))
+        return url.path
+
+    def send(self, code, body=b"", contentType="application/json", headers=None, category="metadata"):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+        if category:
+            self.server.stats.add(category, self.bytesIn, len(body))
+
+    def sendResultSet(self, rows):
+        self.send(200, {"ResultSet": {"Result": rows, "totalRecords": str(len(rows))}})
+
+    def sendDocument(self, document):
+        # Config documents support conditional GETs, like XNAT behind a caching proxy
+        body = json.dumps(document)
+        etag = '"%s"' % hashlib.sha1(body.encode("utf-8")).hexdigest()
+        headers = {"ETag": etag, "Last-Modified": self.server.lastModified}
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            self.server.stats.add("metadata", self.bytesIn, 0)
+            return
+        self.send(200, body, headers=headers)
+
+    def readBody(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                line = self.rfile.readline()
+                size = int(line.split(b";")[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = b"".join(chunks)
+        else:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.bytesIn += len(body)
+        return body
+
+    def delay(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    # Verbs
+
+    def do_GET(self):
+        self.delay()
+        path = self.parse()
+        state = self.server.state
+        sessions = state["sessions"]
+
+        if path == "/_mock/stats":
+            return self.send(200, self.server.stats.snapshot(reset=self.query.get("reset") == "1"), category=None)
+
+        if path == "/data/experiments":
+            project = self.query.get("project")
+            rows = [{"ID": label, "label": label, "project": state["project"], "subject_label": sessions[label]["subject"],
+                     "xsiType": "xnat:mrSessionData"}
+                    for label in sorted(sessions) if project in (None, state["project"])]
+            return self.sendResultSet(rows)
+
+        m = re.match(r"^/data/experiments/([^/]+)$", path)
+        if m and m.group(1) in sessions:
+            return self.sendResultSet([{"project": state["project"], "subject_ID": "SUBJ_" + sessions[m.group(1)]["subject"]}])
+
+        m = re.match(r"^/data/subjects/SUBJ_([^/]+)$", path)
+        if m:
+            return self.sendResultSet([{"label": m.group(1)}])
+
+        m = re.match(r"^/data/experiments/([^/]+)/scans$", path)
+        if m and m.group(1) in sessions:
+            return self.sendResultSet([{"ID": scan["id"], "series_description": scan["series_description"], "type": scan["type"]}
+                                       for scan in sessions[m.group(1)]["scans"]])
+
+        m = re.match(r"^/data/(?:archive/)?experiments/([^/]+)/scans/([^/]+)$", path)
+        if m and m.group(1) in sessions:
+            # Just enough of the scan document for the dcm2nii sidecar
+            fields = {"parameters/tr": 2000, "parameters/te": 30, "parameters/flip": 90}
+            return self.send(200, {"items": [{"data_fields": fields, "children": [{}, {"items": [{"data_fields": {}}]}]}]})
+
+        m = re.match(r"^/data/experiments/([^/]+)/scans/([^/]+)/resources$", path)
+        if m:
+            scanDir = self.server.scanDir(m.group(1), m.group(2))
+            rows = []
+            if os.path.isdir(scanDir):
+                for i, label in enumerate(sorted(os.listdir(scanDir))):
+                    rows.append({"label": label, "format": label, "xnat_abstractresource_id": str(i),
+                                 "file_count": str(len(os.listdir(os.path.join(scanDir, label))))})
+            return self.sendResultSet(rows)
+
+        m = re.match(r"^/data/experiments/([^/]+)/scans/([^/]+)/resources/([^/]+)/files$", path)
+        if m:
+            return self.listFiles(path, self.server.scanDir(*m.groups()), "%s/scans/%s/resources/%s/files" % m.groups())
+
+        m = re.match(r"^/data/experiments/([^/]+)/scans/([^/]+)/resources/([^/]+)/files/(.+)$", path)
+        if m:
+            return self.sendFile(os.path.join(self.server.scanDir(*m.groups()[:3]), m.group(4)))
+
+        if re.match(r"^/data/projects/([^/]+)/resources/config/files/bidsmap.json$", path):
+            if "project_bidsmap" in state:
+                return self.sendDocument(state["project_bidsmap"])
+            return self.send(404)
+
+        if path == "/data/config/bids/bidsmap":
+            if "site_bidsmap" in state:
+                return self.sendDocument(state["site_bidsmap"])
+            return self.send(404)
+
+        m = re.match(r"^/data/projects/([^/]+)$", path)
+        if m and m.group(1) == state["project"]:
+            children = [{"field": "PI", "items": [{"data_fields": {"firstname": "Pat", "lastname": "Investigator"}}]},
+                        {"field": "investigators/investigator", "items": [{"data_fields": {"firstname": "Sam", "lastname": "Scientist"}}]}]
+            return self.sendDocument({"items": [{"data_fields": {"ID": state["project"]}, "children": children}]})
+
+        m = re.match(r"^/data/experiments/([^/]+)/resources$", path)
+        if m:
+            resourceDir = self.server.sessionResourceDir(m.group(1))
+            labels = sorted(os.listdir(resourceDir)) if os.path.isdir(resourceDir) else []
+            return self.sendResultSet([{"label": label} for label in labels])
+
+        m = re.match(r"^/data/experiments/([^/]+)/resources/([^/]+)/files/(.+)$", path)
+        if m:
+            return self.sendFile(os.path.join(self.server.sessionResourceDir(m.group(1), m.group(2)), m.group(3)))
+
+        self.send(404, category="other")
+
+    def listFiles(self, path, resourceDir, zipPrefix):
+        if not os.path.isdir(resourceDir):
+            return self.send(404)
+        names = sorted(os.listdir(resourceDir))
+
+        if self.query.get("format") == "zip":
+            buf = io.BytesIO()
+            with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as z:
+                for name in names:
+                    z.write(os.path.join(resourceDir, name), "%s/%s" % (zipPrefix, name))
+            return self.send(200, buf.getvalue(), "application/zip", category="download")
+
+        rows = []
+        for name in names:
+            filePath = os.path.join(resourceDir, name)
+            row = {"Name": name, "Size": str(os.path.getsize(filePath)), "URI": path + "/" + name, "digest": self.server.digest(filePath)}
+            if self.query.get("locator") == "absolutePath":
+                # Pretend the archive is not mounted here, so the script has to download over HTTP
+                absolutePath = os.path.abspath(filePath)
+                row["absolutePath"] = "/nonexistent" + absolutePath if self.server.hideAbsolutePath else absolutePath
+            rows.append(row)
+        self.sendResultSet(rows)
+
+    def sendFile(self, filePath):
+        if not os.path.isfile(filePath):
+            return self.send(404, category="download")
+        with open(filePath, "rb") as f:
+            data = f.read()
+        requested = self.headers.get("Range")
+        if requested:
+            start, end = requested.split("=", 1)[1].split("-")
+            start = int(start)
+            end = min(int(end), len(data) - 1) if end else len(data) - 1
+            part = data[start:end + 1]
+            return self.send(206, part, "application/octet-stream", category="download",
+                             headers={"Content-Range": "bytes %d-%d/%d" % (start, start + len(part) - 1, len(data))})
+        self.send(200, data, "application/octet-stream", category="download")
+
+    def do_PUT(self):
+        self.delay()
+        path = self.parse()
+        body = self.readBody()
+
+        m = re.match(r"^/data/experiments/([^/]+)/scans/([^/]+)/resources/([^/]+)/files(?:/(.+))?$", path)
+        if m:
+            resourceDir = self.server.scanDir(*m.groups()[:3])
+        else:
+            m = re.match(r"^/data/experiments/([^/]+)/resources/([^/]+)/files(?:/(.+))?$", path)
+            if not m:
+                return self.send(404, category="upload")
+            resourceDir = self.server.sessionResourceDir(m.group(1), m.group(2))
+        fileName = m.groups()[-1]
+        if not os.path.isdir(resourceDir):
+            os.makedirs(resourceDir)
+
+        if "reference" in self.query:
+            # XNAT copies (or links) the files from a path it can see. With --hide-absolute-path the
+            # server cannot see the client's files either, so the resource is left empty.
+            if self.server.hideAbsolutePath:
+                return self.send(200, category="upload")
+            for name in os.listdir(self.query["reference"]):
+                shutil.copy(os.path.join(self.query["reference"], name), resourceDir)
+            return self.send(200, category="upload")
+
+        contentType = self.headers.get("Content-Type", "")
+        if contentType.startswith("multipart/form-data"):
+            boundary = contentType.split("boundary=", 1)[1].encode("ascii")
+            part = body.split(b"--" + boundary)[1]
+            partHeaders, body = part.split(b"\r\n\r\n", 1)
+            body = body[:-2]
+            nameMatch = re.search(br'filename="([^"]+)"', partHeaders)
+            if nameMatch and not fileName:
+                fileName = os.path.basename(nameMatch.group(1).decode("utf-8"))
+
+        if self.query.get("extract", "").lower() == "true":
+            with zipfile.ZipFile(io.BytesIO(body)) as z:
+                bad = z.testzip()
+                if bad is not None:
+                    return self.send(400, "Bad CRC for %s" % bad, "text/plain", category="upload")
+                for name in z.namelist():
+                    if not name.endswith("/"):
+                        with open(os.path.join(resourceDir, os.path.basename(name)), "wb") as f:
+                            f.write(z.read(name))
+        elif fileName:
+            with open(os.path.join(resourceDir, fileName), "wb") as f:
+                f.write(body)
+        self.send(200, category="upload")
+
+    def do_DELETE(self):
+        self.delay()
+        path = self.parse()
+        m = re.match(r"^/data/experiments/([^/]+)/scans/([^/]+)/resources/([^/]+)$", path)
+        if m:
+            shutil.rmtree(self.server.scanDir(*m.groups()), ignore_errors=True)
+            return self.send(200, category="delete")
+        m = re.match(r"^/data/experiments/([^/]+)/resources/([^/]+)$", path)
+        if m:
+            shutil.rmtree(self.server.sessionResourceDir(*m.groups()), ignore_errors=True)
+            return self.send(200, category="delete")
+        self.send(404, category="delete")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve a synthetic XNAT archive over a minimal XNAT REST API")
+    parser.add_argument("root", help="Directory written by synth_session.py")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on (0 picks a free port)")
+    parser.add_argument("--hide-absolute-path", action="store_true", help="Report absolutePath values that don't exist, to force HTTP downloads")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before answering each request")
+    parser.add_argument("--port-file", help="Write the port the server is listening on to this file")
+    parser.add_argument("--verbose", action="store_true", help="Log every request")
+    args = parser.parse_args()
+
+    server = MockXnat(("127.0.0.1", args.port), args.root, hideAbsolutePath=args.hide_absolute_path,
+                      latency=args.latency, verbose=args.verbose)
+    port = server.server_address[1]
+    if args.port_file:
+        with open(args.port_file + ".tmp", "w") as f:
+            f.write(str(port))
+        os.rename(args.port_file + ".tmp", args.port_file)
+    print("Serving %s on http://127.0.0.1:%d" % (args.root, port))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
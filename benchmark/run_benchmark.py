@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""End-to-end benchmark for dicom2bids.py and xnat2bids.py against a local mock XNAT.
+
+Generates a synthetic archive (synth_session.py), serves it with mock_xnat.py and runs these stages,
+each in its own process:
+
+    generate      write the synthetic DICOM sessions
+    convert       dicom2bids.py in batch mode over every session, overwriting existing NIFTI
+    incremental   dicom2bids.py again with --incremental True; nothing has changed, so little should happen
+    xnat2bids     assemble the converted archive into a BIDS tree
+
+For each stage it reports wall time, peak RSS of the stage's process tree, the number of requests the
+mock server saw and the bytes it received (bytesIn, i.e. uploads) and sent (bytesOut, i.e. downloads and
+listings), split by request category. Stages that don't talk to XNAT report the bytes they wrote to disk. With --baseline, a
+stage that is slower, or moves more bytes or makes more requests, than the baseline by more than
+--tolerance fails the run.
+"""
+
+import argparse
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+from urllib.request import urlopen
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+DICOM2BIDS = os.path.join(REPO_DIR, "xnat-dicom2bids-session", "dicom2bids.py")
+XNAT2BIDS = os.path.join(REPO_DIR, "xnat2bids", "xnat2bids.py")
+
+# Metrics compared against a baseline, and how much noise to ignore in each before applying the tolerance
+COMPARED = [("seconds", 0.5), ("peakRssMB", 16), ("requests", 2), ("bytesIn", 65536), ("bytesOut", 65536), ("bytesWritten", 65536)]
+
+
+def runStage(name, command, logPath, cwd=None):
+    # Run one stage in a child process. Returns wall time, peak RSS and exit status.
+    print("Running stage %s: %s" % (name, " ".join(shlex.quote(c) for c in command)))
+    sys.stdout.flush()
+    start = time.time()
+    with open(logPath, "w") as log:
+        proc = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, cwd=cwd)
+        # wait4 gives the resource usage of this child (and the children it waited for) alone
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, "waitstatus_to_exitcode") else status >> 8
+    seconds = time.time() - start
+    if proc.returncode != 0:
+        print("Stage %s failed with exit status %d. See %s" % (name, proc.returncode, logPath))
+    # ru_maxrss is in kilobytes on Linux
+    return {"stage": name, "seconds": round(seconds, 3), "peakRssMB": round(usage.ru_maxrss / 1024.0, 1),
+            "exitStatus": proc.returncode, "log": logPath}
+
+
+def serverStats(port, reset=True):
+    with urlopen("http://127.0.0.1:%d/_mock/stats%s" % (port, "?reset=1" if reset else "")) as r:
+        return json.loads(r.read().decode("utf-8"))
+
+
+def treeSize(path):
+    total = 0
+    for dirPath, _, fileNames in os.walk(path):
+        for fileName in fileNames:
+            filePath = os.path.join(dirPath, fileName)
+            if not os.path.islink(filePath):
+                total += os.path.getsize(filePath)
+    return total
+
+
+def startServer(root, workDir, hideAbsolutePath, latency):
+    portFile = os.path.join(workDir, "mock_xnat.port")
+    if os.path.exists(portFile):
+        os.remove(portFile)
+    command = [sys.executable, os.path.join(BENCHMARK_DIR, "mock_xnat.py"), root, "--port", "0", "--port-file", portFile,
+               "--latency", str(latency)]
+    if hideAbsolutePath:
+        command.append("--hide-absolute-path")
+    log = open(os.path.join(workDir, "mock_xnat.log"), "w")
+    server = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+    for _ in range(100):
+        if os.path.exists(portFile):
+            with open(portFile) as f:
+                return server, int(f.read())
+        if server.poll() is not None:
+            break
+        time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("Mock XNAT server did not start. See %s" % log.name)
+
+
+def compareToBaseline(results, baseline, tolerance):
+    # Returns a list of human-readable regressions
+    regressions = []
+    previous = {stage["stage"]: stage for stage in baseline["stages"]}
+    for stage in results["stages"]:
+        old = previous.get(stage["stage"])
+        if old is None:
+            continue
+        for metric, slack in COMPARED:
+            if metric in stage and metric in old and stage[metric] > old[metric] * (1 + tolerance) + slack:
+                regressions.append("%s %s went from %s to %s" % (stage["stage"], metric, old[metric], stage[metric]))
+    return regressions
+
+
+def printTable(stages):
+    print()
+    print("%-12s %9s %9s %9s %12s %12s %12s" % ("stage", "seconds", "rss MB", "requests", "to xnat", "from xnat", "written"))
+    for stage in stages:
+        print("%-12s %9.2f %9.1f %9s %12s %12s %12s" % (stage["stage"], stage["seconds"], stage["peakRssMB"], stage.get("requests", "-"),
+                                                       stage.get("bytesIn", "-"), stage.get("bytesOut", "-"), stage.get("bytesWritten", "-")))
+        for category, counts in sorted(stage.get("categories", {}).items()):
+            if counts["requests"]:
+                print("  %-10s %9s %9s %9d %12d %12d" % (category, "", "", counts["requests"], counts["bytesIn"], counts["bytesOut"]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark dicom2bids.py and xnat2bids.py against a local mock XNAT")
+    parser.add_argument("--workdir", default=os.path.join(os.getcwd(), "benchmark-work"), help="Scratch directory. Its contents are replaced")
+    parser.add_argument("--sessions", type=int, default=2, help="Number of synthetic sessions")
+    parser.add_argument("--bold-runs", type=int, default=2, help="Functional runs per session")
+    parser.add_argument("--slices", type=int, default=32, help="Slices per volume")
+    parser.add_argument("--volumes", type=int, default=4, help="Volumes per functional run")
+    parser.add_argument("--echoes", type=int, default=3, help="Echoes in the multi-echo scan. 1 leaves it out")
+    parser.add_argument("--rows", type=int, default=64, help="Rows per slice")
+    parser.add_argument("--cols", type=int, default=64, help="Columns per slice")
+    parser.add_argument("--with-sr", action="store_true", help="Add a structured report scan without pixel data")
+    parser.add_argument("--hide-absolute-path", action="store_true", help="Make the mock server hide the archive, so every DICOM file is downloaded over HTTP")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the mock server waits before answering each request")
+    parser.add_argument("--batch-concurrency", type=int, default=1, help="Passed to dicom2bids.py")
+    parser.add_argument("--dicom2bids-args", default="", help="Extra arguments for dicom2bids.py, e.g. \"--download-workers 16\"")
+    parser.add_argument("--stages", default="generate,convert,incremental,xnat2bids", help="Comma-separated stages to run")
+    parser.add_argument("--report", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON report from an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed fractional increase over the baseline before a stage counts as a regression")
+    args = parser.parse_args()
+
+    stageNames = [s.strip() for s in args.stages.split(",") if s.strip()]
+    workDir = os.path.abspath(args.workdir)
+    root = os.path.join(workDir, "xnat")
+    if "generate" in stageNames and os.path.isdir(workDir):
+        shutil.rmtree(workDir)
+    if not os.path.isdir(workDir):
+        os.makedirs(workDir)
+
+    results = {"started": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": sys.version.split()[0],
+               "parameters": {key: value for key, value in vars(args).items() if key not in ("report", "baseline")},
+               "stages": []}
+
+    if "generate" in stageNames:
+        command = [sys.executable, os.path.join(BENCHMARK_DIR, "synth_session.py"), root, "--sessions", str(args.sessions),
+                   "--bold-runs", str(args.bold_runs), "--slices", str(args.slices), "--volumes", str(args.volumes),
+                   "--echoes", str(args.echoes), "--rows", str(args.rows), "--cols", str(args.cols)]
+        if args.with_sr:
+            command.append("--with-sr")
+        stage = runStage("generate", command, os.path.join(workDir, "generate.log"))
+        stage["bytesWritten"] = treeSize(os.path.join(root, "archive"))
+        results["stages"].append(stage)
+        if stage["exitStatus"] != 0:
+            sys.exit(1)
+
+    server, port = startServer(root, workDir, args.hide_absolute_path, args.latency)
+    try:
+        for name in stageNames:
+            if name not in ("convert", "incremental"):
+                continue
+            outDir = os.path.join(workDir, name)
+            if os.path.isdir(outDir):
+                shutil.rmtree(outDir)
+            os.makedirs(outDir)
+            command = [sys.executable, DICOM2BIDS, "--host", "http://127.0.0.1:%d" % port, "--user", "bench", "--password", "bench",
+                       "--batch-project", "BENCH", "--batch-concurrency", str(args.batch_concurrency),
+                       "--dicomdir", os.path.join(outDir, "dicom"), "--niftidir", os.path.join(outDir, "nifti"),
+                       "--cache-dir", os.path.join(workDir, "cache"), "--refresh-cache", "True"]
+            command.extend(["--overwrite", "True"] if name == "convert" else ["--incremental", "True"])
+            command.extend(shlex.split(args.dicom2bids_args))
+            serverStats(port, reset=True)
+            stage = runStage(name, command, os.path.join(workDir, name + ".log"), cwd=outDir)
+            stage.update((key, value) for key, value in serverStats(port, reset=True).items() if key != "seconds")
+            results["stages"].append(stage)
+    finally:
+        server.terminate()
+        server.wait()
+
+    if "xnat2bids" in stageNames:
+        outDir = os.path.join(workDir, "bids")
+        if os.path.isdir(outDir):
+            shutil.rmtree(outDir)
+        os.makedirs(outDir)
+        stage = runStage("xnat2bids", [sys.executable, XNAT2BIDS, os.path.join(root, "archive"), outDir],
+                         os.path.join(workDir, "xnat2bids.log"))
+        stage["bytesWritten"] = treeSize(outDir)
+        results["stages"].append(stage)
+
+    printTable(results["stages"])
+    failed = [stage["stage"] for stage in results["stages"] if stage["exitStatus"] != 0]
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Wrote report to %s" % args.report)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compareToBaseline(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION: " + regression)
+        if regressions:
+            sys.exit(1)
+
+    if failed:
+        print("Failed stages: %s" % ", ".join(failed))
+        sys.exit(1)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""Generate synthetic DICOM sessions in XNAT archive layout for mock_xnat.py.
+
+Each session gets
+    a localizer that is not in the BIDS map,
+    a T1w anatomical,
+    --bold-runs functional runs sharing one series description (so they get run numbers),
+    a multi-echo functional scan when --echoes is more than 1,
+    a structured report (no pixel data) when --with-sr is set.
+
+Slice data is random noise; only the headers matter to dcm2niix and dicom2bids.py.
+"""
+
+import argparse
+import json
+import os
+import shutil
+
+import numpy
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+
+BASIC_TEXT_SR_STORAGE = "1.2.840.10008.5.1.4.1.1.88.11"
+
+
+def writeSeries(outDir, seriesDesc, seriesNumber, studyUID, slices=16, echoes=1, volumes=1, rows=64, cols=64, modality="MR"):
+    # Write one series to outDir. Returns the number of files written.
+    os.makedirs(outDir)
+    seriesUID = generate_uid()
+    instance = 0
+    for volume in range(volumes):
+        for echo in range(1, echoes + 1):
+            for sliceIndex in range(slices):
+                instance += 1
+                meta = FileMetaDataset()
+                meta.MediaStorageSOPClassUID = MRImageStorage if modality == "MR" else BASIC_TEXT_SR_STORAGE
+                meta.MediaStorageSOPInstanceUID = generate_uid()
+                meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+                ds = FileDataset(None, {}, file_meta=meta, preamble=b"\0" * 128)
+                ds.SOPClassUID = meta.MediaStorageSOPClassUID
+                ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+                ds.Modality = modality
+                ds.Manufacturer = "SIEMENS"
+                ds.PatientName = "Synthetic"
+                ds.PatientID = "SYNTH"
+                ds.StudyInstanceUID = studyUID
+                ds.SeriesInstanceUID = seriesUID
+                ds.SeriesDescription = seriesDesc
+                ds.SeriesNumber = seriesNumber
+                ds.StudyDate = ds.SeriesDate = ds.AcquisitionDate = "20200101"
+                ds.StudyTime = ds.SeriesTime = "120000"
+                ds.AcquisitionTime = "%06.2f" % (120000 + volume * 2)
+                ds.InstanceNumber = instance
+                ds.AcquisitionNumber = volume + 1
+
+                if modality == "MR":
+                    ds.EchoNumbers = echo
+                    ds.EchoTime = 12.0 * echo
+                    ds.RepetitionTime = 2000
+                    ds.FlipAngle = 90
+                    ds.ImagePositionPatient = [0.0, 0.0, float(sliceIndex)]
+                    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+                    ds.PixelSpacing = [1, 1]
+                    ds.SliceThickness = 1
+                    ds.Rows = rows
+                    ds.Columns = cols
+                    ds.SamplesPerPixel = 1
+                    ds.PhotometricInterpretation = "MONOCHROME2"
+                    ds.BitsAllocated = 16
+                    ds.BitsStored = 16
+                    ds.HighBit = 15
+                    ds.PixelRepresentation = 0
+                    ds.PixelData = numpy.random.randint(0, 1000, (rows, cols)).astype(numpy.uint16).tobytes()
+
+                fileName = "%s.%04d.dcm" % (seriesDesc.replace(" ", "_"), instance)
+                try:
+                    ds.save_as(os.path.join(outDir, fileName), enforce_file_format=True)
+                except TypeError:
+                    # pydicom < 3
+                    ds.is_little_endian = True
+                    ds.is_implicit_VR = False
+                    ds.save_as(os.path.join(outDir, fileName), write_like_original=False)
+    return instance
+
+
+def generate(root, sessions=1, boldRuns=2, slices=16, volumes=1, echoes=1, rows=64, cols=64, withSR=False,
+             project="BENCH", quiet=False):
+    """Write sessions and a matching state.json under root, replacing anything already there."""
+    if os.path.isdir(root):
+        shutil.rmtree(root)
+    archive = os.path.join(root, "archive")
+
+    state = {"project": project, "sessions": {},
+             "site_bidsmap": [{"series_description": "T1_MPRAGE", "bidsname": "T1w"},
+                              {"series_description": "ep2d_bold", "bidsname": "task-rest_bold"},
+                              {"series_description": "me_bold", "bidsname": "task-me_bold"},
+                              {"series_description": "report", "bidsname": "acq-report_T1w"}]}
+
+    totalFiles = 0
+    for sessionIndex in range(1, sessions + 1):
+        session = "SESS%03d" % sessionIndex
+        studyUID = generate_uid()
+        layout = [("localizer", 3, 1, 1, "MR"), ("T1_MPRAGE", slices, 1, 1, "MR")]
+        layout.extend(("ep2d_bold", slices, 1, volumes, "MR") for _ in range(boldRuns))
+        if echoes > 1:
+            layout.append(("me_bold", slices, echoes, volumes, "MR"))
+        if withSR:
+            layout.append(("report", 1, 1, 1, "SR"))
+
+        scans = []
+        for scanNumber, (desc, nSlices, nEchoes, nVolumes, modality) in enumerate(layout, 1):
+            scanid = str(scanNumber)
+            outDir = os.path.join(archive, session, "SCANS", scanid, "DICOM")
+            totalFiles += writeSeries(outDir, desc, scanNumber, studyUID, slices=nSlices, echoes=nEchoes, volumes=nVolumes,
+                                      rows=rows, cols=cols, modality=modality)
+            scans.append({"id": scanid, "series_description": desc, "type": desc})
+        state["sessions"][session] = {"subject": "%03d" % sessionIndex, "scans": scans}
+        if not quiet:
+            print("Wrote session %s with %d scans." % (session, len(scans)))
+
+    with open(os.path.join(root, "state.json"), "w") as f:
+        json.dump(state, f, indent=2)
+    return totalFiles
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate synthetic DICOM sessions for mock_xnat.py")
+    parser.add_argument("root", help="Output directory. Anything already there is removed")
+    parser.add_argument("--sessions", type=int, default=1, help="Number of sessions")
+    parser.add_argument("--bold-runs", type=int, default=2, help="Functional runs per session")
+    parser.add_argument("--slices", type=int, default=16, help="Slices per volume")
+    parser.add_argument("--volumes", type=int, default=1, help="Volumes per functional run")
+    parser.add_argument("--echoes", type=int, default=1, help="Echoes in the multi-echo scan. 1 leaves it out")
+    parser.add_argument("--rows", type=int, default=64, help="Rows per slice")
+    parser.add_argument("--cols", type=int, default=64, help="Columns per slice")
+    parser.add_argument("--with-sr", action="store_true", help="Add a structured report scan without pixel data")
+    parser.add_argument("--project", default="BENCH", help="Project ID")
+    args = parser.parse_args()
+
+    files = generate(args.root, sessions=args.sessions, boldRuns=args.bold_runs, slices=args.slices, volumes=args.volumes,
+                     echoes=args.echoes, rows=args.rows, cols=args.cols, withSR=args.with_sr, project=args.project)
+    print("Wrote %d DICOM files to %s." % (files, args.root))
@@ -0,0 +1,434 @@
+import hashlib
+import importlib.util
+import io
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+spec = importlib.util.spec_from_file_location(
+    "dicom2bids", os.path.join(HERE, os.pardir, "xnat-dicom2bids-session", "dicom2bids.py"))
+dicom2bids = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(dicom2bids)
+
+
+class BidsNameMatcherTest(unittest.TestCase):
+    def matcher(self, *entries):
+        matcher = dicom2bids.BidsNameMatcher()
+        for entry in entries:
+            matcher.add(entry, "test")
+        return matcher
+
+    def test_exact_rule_keeps_higher_priority(self):
+        matcher = self.matcher({"series_description_glob": "T*", "bidsname": "glob", "priority": 5},
+                               {"series_description": "T1", "bidsname": "high", "priority": 10},
+                               {"series_description": "T1", "bidsname": "low", "priority": 0})
+        self.assertEqual(matcher.match("T1")["bidsname"], "high")
+
+    def test_later_exact_rule_wins_on_equal_priority(self):
+        matcher = self.matcher({"series_description": "T1", "bidsname": "project"},
+                               {"series_description": "t1", "bidsname": "site"})
+        self.assertEqual(matcher.match("T1")["bidsname"], "site")
+
+    def test_glob_and_regex_rules(self):
+        matcher = self.matcher({"series_description_glob": "T1_MEMPRAGE*", "bidsname": "anat-T1w"},
+                               {"series_description_regex": r"bold_run(\d+)", "bidsname": "func-bold"})
+        self.assertIsNone(matcher.match("t1_mprage_rms"))
+        self.assertEqual(matcher.match("T1_MEMPRAGE_RMS")["bidsname"], "anat-T1w")
+        self.assertEqual(matcher.match("t1_memprage 1mm")["bidsname"], "anat-T1w")
+        self.assertEqual(matcher.match("BOLD_run02")["bidsname"], "func-bold")
+        # A regex has to match the whole description
+        self.assertIsNone(matcher.match("bold_run02_SBRef"))
+
+    def test_patterns_fall_through_to_exact_names(self):
+        matcher = self.matcher({"series_description_glob": "DTI*", "bidsname": "dwi-dwi"},
+                               {"series_description": "localizer", "bidsname": "anat-scout"})
+        self.assertEqual(matcher.match("Localizer")["bidsname"], "anat-scout")
+        self.assertEqual(matcher.match("DTI_64dir")["bidsname"], "dwi-dwi")
+        self.assertIsNone(matcher.match("fieldmap"))
+
+    def test_priority_and_tie_breaks(self):
+        matcher = self.matcher({"series_description_regex": "T1.*", "bidsname": "regex"},
+                               {"series_description_glob": "T1*", "bidsname": "glob"},
+                               {"series_description": "T1w", "bidsname": "exact"},
+                               {"series_description": "T1_mprage", "bidsname": "plain"},
+                               {"series_description_regex": "T1_.*", "bidsname": "urgent", "priority": 1})
+        # On equal priority exact beats glob beats regex
+        self.assertEqual(matcher.match("T1w")["bidsname"], "exact")
+        self.assertEqual(matcher.match("T1x")["bidsname"], "glob")
+        # A higher priority pattern beats an exact rule
+        self.assertEqual(matcher.match("T1_mprage")["bidsname"], "urgent")
+
+    def test_rules_added_after_a_match_are_used(self):
+        matcher = self.matcher({"series_description_glob": "T1*", "bidsname": "low"})
+        self.assertEqual(matcher.match("T1w")["bidsname"], "low")
+        matcher.add({"series_description_glob": "T1w*", "bidsname": "high", "priority": 2}, "test")
+        self.assertEqual(matcher.match("T1w")["bidsname"], "high")
+
+
+class FetchBidsMapTest(unittest.TestCase):
+    def setUp(self):
+        self.fetched = []
+        self.release = threading.Event()
+        self.savedCache = getattr(dicom2bids, "metadataCache", None)
+        dicom2bids.metadataCache = self
+        dicom2bids.bidsmapCache.clear()
+
+    def tearDown(self):
+        self.release.set()
+        dicom2bids.metadataCache = self.savedCache
+        dicom2bids.bidsmapCache.clear()
+
+    def fetch(self, url, params=None):
+        # Stands in for MetadataCache.fetch(). The "slow" map waits until the test releases it.
+        self.fetched.append(url)
+        if url == "slow":
+            self.release.wait(10)
+        if url == "broken":
+            raise dicom2bids.requests.ConnectionError("down")
+        return 200, '[{"series_description": "%s", "bidsname": "anat-T1w"}]' % url
+
+    def test_slow_fetch_does_not_block_other_maps(self):
+        results = []
+        waiters = [threading.Thread(target=lambda: results.append(dicom2bids.fetchBidsMap("slow", "project")))
+                   for _ in range(3)]
+        for waiter in waiters:
+            waiter.start()
+        while not self.fetched:
+            time.sleep(0.01)
+        start = time.time()
+        self.assertEqual(dicom2bids.fetchBidsMap("fast", "site-wide")[0]["series_description"], "fast")
+        self.assertLess(time.time() - start, 5)
+        self.release.set()
+        for waiter in waiters:
+            waiter.join(10)
+        # Callers asking for the same map share one fetch
+        self.assertEqual(self.fetched, ["slow", "fast"])
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(result is results[0] for result in results))
+
+    def test_failed_fetch_is_retried_by_the_next_caller(self):
+        for _ in range(2):
+            with self.assertRaises(dicom2bids.requests.ConnectionError):
+                dicom2bids.fetchBidsMap("broken", "project")
+        self.assertEqual(self.fetched, ["broken", "broken"])
+
+
+class RunMetricsTest(unittest.TestCase):
+    def test_events_are_only_kept_for_reports(self):
+        metrics = dicom2bids.RunMetrics()
+        with metrics.scope(session="S1"):
+            metrics.record("download", 0.5, bytes=10)
+            metrics.record("download", 0.25, status="error", bytes=5)
+        events, summary = metrics.takeSession("S1")
+        self.assertEqual(events, [])
+        self.assertEqual(summary, {"download": {"count": 2, "seconds": 0.75, "bytes": 15, "errors": 1}})
+        self.assertEqual(metrics.takeSession("S1"), ([], {}))
+
+    def test_take_session_forgets_kept_events(self):
+        metrics = dicom2bids.RunMetrics(keepEvents=True)
+        with metrics.scope(session="S1"):
+            metrics.record("http", 0.1, status=200, method="GET")
+        events, _ = metrics.takeSession("S1")
+        self.assertEqual([event["kind"] for event in events], ["http"])
+        self.assertEqual(metrics.events, {})
+        self.assertEqual(metrics.totals[("http", "GET", "200")][0], 1)
+
+
+class PlanEchoRenamesTest(unittest.TestCase):
+    bidsname = "sub-01_task-me_bold"
+
+    def plan(self, stems):
+        sidecars = {self.bidsname + suffix: {"EchoNumber": echo} for suffix, echo in stems}
+        imgNames = [stem + ".nii.gz" for stem in sidecars]
+        bidsNames = [stem + ".json" for stem in sidecars]
+        imgRenames, bidsRenames = dicom2bids.planEchoRenames(self.bidsname, imgNames, bidsNames, sidecars)
+        self.assertEqual({k[:-len(".json")]: v[:-len(".json")] for k, v in bidsRenames.items()},
+                         {k[:-len(".nii.gz")]: v[:-len(".nii.gz")] for k, v in imgRenames.items()})
+        return {old[len(self.bidsname):-len(".json")]: new for old, new in bidsRenames.items()}
+
+    def test_echoes(self):
+        self.assertEqual(self.plan([("_e1", 1), ("_e2", 2)]),
+                         {"_e1": "sub-01_task-me_echo-1_bold.json", "_e2": "sub-01_task-me_echo-2_bold.json"})
+
+    def test_phase_becomes_part_entity(self):
+        self.assertEqual(self.plan([("_e1", 1), ("_e2", 2), ("_e1_ph", 1), ("_e2_ph", 2)]),
+                         {"_e1": "sub-01_task-me_echo-1_part-mag_bold.json",
+                          "_e2": "sub-01_task-me_echo-2_part-mag_bold.json",
+                          "_e1_ph": "sub-01_task-me_echo-1_part-phase_bold.json",
+                          "_e2_ph": "sub-01_task-me_echo-2_part-phase_bold.json"})
+
+    def test_unknown_suffix_is_not_renamed(self):
+        renames = self.plan([("_e1", 1), ("_e2", 2), ("_e2_ADC", 2)])
+        self.assertEqual(renames["_e2_ADC"], "sub-01_task-me_bold_e2_ADC.json")
+        self.assertEqual(renames["_e2"], "sub-01_task-me_echo-2_bold.json")
+
+
+class Unseekable(io.RawIOBase):
+    # A write-only stream zipfile can't seek in, so it writes data descriptors
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.data.extend(b)
+        return len(b)
+
+
+class ZipStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.dirPath = os.path.join(self.tmpDir, "scan")
+        rng = random.Random(0)
+        # Compressible text bigger than several chunks, so it is deflated in parallel blocks
+        words = [rng.choice(["sub", "bold", "echo", "run", "T1w", "json"]) for _ in range(60000)]
+        self.files = {
+            "sub-01_bold.json": " ".join(words).encode(),
+            "sub-01_bold.nii.gz": bytes(rng.getrandbits(8) for _ in range(50000)),
+            "sub-01_dwi.bval": b"0 1000 1000\n",
+            "empty.txt": b"",
+            "extra/nested.tsv": b"a\tb\n" * 1000,
+        }
+        for name, data in self.files.items():
+            path = os.path.join(self.dirPath, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+        os.makedirs(os.path.join(self.dirPath, "emptydir"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def archive(self, **kwargs):
+        zipStream = dicom2bids.ZipStream(self.dirPath, chunkSize=8192, **kwargs)
+        return b"".join(zipStream.chunks())
+
+    def checkArchive(self, data):
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual({name: archive.read(name) for name in archive.namelist() if not name.endswith("/")}, self.files)
+            self.assertIn("emptydir/", archive.namelist())
+            methods = {info.filename: info.compress_type for info in archive.infolist()}
+        self.assertEqual(methods["sub-01_bold.nii.gz"], zipfile.ZIP_STORED)
+        self.assertEqual(methods["sub-01_bold.json"], zipfile.ZIP_DEFLATED)
+        return archive
+
+    def test_round_trip(self):
+        for threads in (1, 3):
+            with self.subTest(threads=threads):
+                self.checkArchive(self.archive(compressThreads=threads))
+
+    def test_parallel_deflate_matches_serial_contents(self):
+        serial = self.archive(compressThreads=1)
+        parallel = self.archive(compressThreads=4)
+        self.assertNotEqual(serial, parallel)
+        self.checkArchive(parallel)
+
+    def test_forced_zip64(self):
+        zipStream = dicom2bids.ZipStream(self.dirPath, chunkSize=8192, compressThreads=2)
+        zipStream.zip64Limit = 1000
+        data = b"".join(zipStream.chunks())
+        self.checkArchive(data)
+        self.assertIn(b"PK\x06\x06", data)
+
+    def test_reader_reads_zip_stream(self):
+        for limit in (dicom2bids.ZipStream.zip64Limit, 1000):
+            zipStream = dicom2bids.ZipStream(self.dirPath, chunkSize=8192, compressThreads=2)
+            zipStream.zip64Limit = limit
+            data = b"".join(zipStream.chunks())
+            members = {}
+            for name, blocks in dicom2bids.ZipStreamReader([data[i:i + 3000] for i in range(0, len(data), 3000)]).members():
+                members[name] = b"".join(blocks)
+            self.assertEqual({name: content for name, content in members.items() if not name.endswith("/")}, self.files)
+
+    def test_reader_reads_data_descriptors(self):
+        for forceZip64 in (False, True):
+            stream = Unseekable()
+            with zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED) as archive:
+                for name, content in sorted(self.files.items()):
+                    with archive.open(name, "w", force_zip64=forceZip64) as f:
+                        f.write(content)
+            data = bytes(stream.data)
+            with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                self.assertTrue(all(info.flag_bits & 0x08 for info in archive.infolist()))
+            members = {name: b"".join(blocks) for name, blocks in dicom2bids.ZipStreamReader([data], chunkSize=4096).members()}
+            self.assertEqual(members, self.files)
+
+    def test_reader_rejects_corrupt_member(self):
+        data = bytearray(self.archive())
+        # Flip a byte inside the deflated data of the json member
+        index = data.index(b"sub-01_bold.json") + len("sub-01_bold.json") + 10
+        data[index] ^= 0xFF
+        with self.assertRaises((zipfile.BadZipfile, dicom2bids.zlib.error)):
+            for _, blocks in dicom2bids.ZipStreamReader([bytes(data)]).members():
+                for _ in blocks:
+                    pass
+
+
+class FileServer(object):
+    """Serves one file over HTTP, misbehaving as told, and records the Range header of each request.
+
+    stallAfter: on the first request, send this many bytes of the body and then stop sending
+    truncateAfter: on the first request, send this many bytes of the body and then close the connection
+    ignoreRange: answer Range requests with the whole file and a 200
+    """
+    def __init__(self, data, stallAfter=None, truncateAfter=None, ignoreRange=False):
+        self.data = data
+        self.stallAfter = stallAfter
+        self.truncateAfter = truncateAfter
+        self.ignoreRange = ignoreRange
+        self.ranges = []
+        self.release = threading.Event()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                rangeHeader = self.headers.get("Range")
+                server.ranges.append(rangeHeader)
+                start = 0
+                if rangeHeader and not server.ignoreRange:
+                    start = int(rangeHeader.split("=")[1].rstrip("-"))
+                    self.send_response(206)
+                    self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(server.data) - 1, len(server.data)))
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Length", str(len(server.data) - start))
+                self.end_headers()
+                body = server.data[start:]
+                if server.stallAfter is not None and len(server.ranges) == 1:
+                    self.wfile.write(body[:server.stallAfter])
+                    self.wfile.flush()
+                    server.release.wait(10)
+                    return
+                if server.truncateAfter is not None and len(server.ranges) == 1:
+                    self.wfile.write(body[:server.truncateAfter])
+                    self.close_connection = True
+                    return
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = "http://127.0.0.1:%d/file.dcm" % self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.release.set()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.data = os.urandom(300000)
+        self.savedSession = getattr(dicom2bids, "sess", None)
+        dicom2bids.sess = dicom2bids.InstrumentedSession()
+        dicom2bids.sess.timeout = (5, 0.5)
+        dicom2bids.linkMode = "auto"
+
+    def tearDown(self):
+        dicom2bids.sess = self.savedSession
+        shutil.rmtree(self.tmpDir)
+
+    def serve(self, **kwargs):
+        server = FileServer(self.data, **kwargs)
+        self.addCleanup(server.close)
+        return server
+
+    def pathDict(self, server, digest=None):
+        return {"URI": server.url, "absolutePath": os.path.join(self.tmpDir, "not-mounted.dcm"), "size": len(self.data),
+                "digest": digest or hashlib.md5(self.data).hexdigest()}
+
+    def test_stalled_read_times_out_and_resumes(self):
+        server = self.serve(stallAfter=100000)
+        name = os.path.join(self.tmpDir, "file.dcm")
+        start = time.time()
+        dicom2bids.download(name, self.pathDict(server), retries=1, backoff=0)
+        # The server holds the stalled connection open for 10 s
+        self.assertLess(time.time() - start, 5)
+        with open(name, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(len(server.ranges), 2)
+        self.assertIsNone(server.ranges[0])
+        self.assertTrue(server.ranges[1].startswith("bytes="))
+
+    def test_truncated_transfer_resumes(self):
+        server = self.serve(truncateAfter=120000)
+        name = os.path.join(self.tmpDir, "file.dcm")
+        nbytes = dicom2bids.download(name, self.pathDict(server), retries=1, backoff=0)
+        with open(name, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertFalse(os.path.exists(name + ".part"))
+        self.assertEqual(len(server.ranges), 2)
+        # Resumes after the last whole block that reached the part file
+        offset = int(server.ranges[1].split("=")[1].rstrip("-"))
+        self.assertTrue(0 < offset <= 120000)
+        # The truncated first attempt plus the missing tail, with nothing sent twice
+        self.assertEqual(nbytes, len(self.data))
+
+    def test_existing_part_file_is_resumed(self):
+        server = self.serve()
+        name = os.path.join(self.tmpDir, "file.dcm")
+        with open(name + ".part", "wb") as f:
+            f.write(self.data[:100000])
+        nbytes = dicom2bids.download(name, self.pathDict(server))
+        self.assertEqual(server.ranges, ["bytes=100000-"])
+        self.assertEqual(nbytes, len(self.data) - 100000)
+        with open(name, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_server_ignoring_range_restarts_from_zero(self):
+        server = self.serve(ignoreRange=True)
+        name = os.path.join(self.tmpDir, "file.dcm")
+        with open(name + ".part", "wb") as f:
+            # Bytes that don't match the file, so appending to them would fail the digest check
+            f.write(b"\0" * 100000)
+        nbytes = dicom2bids.download(name, self.pathDict(server))
+        self.assertEqual(server.ranges, ["bytes=100000-"])
+        self.assertEqual(nbytes, len(self.data))
+        with open(name, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_digest_mismatch_discards_part_file(self):
+        server = self.serve()
+        name = os.path.join(self.tmpDir, "file.dcm")
+        with self.assertRaises(dicom2bids.DownloadIntegrityError):
+            dicom2bids.download(name, self.pathDict(server, digest="0" * 32), retries=1, backoff=0)
+        self.assertFalse(os.path.exists(name))
+        self.assertFalse(os.path.exists(name + ".part"))
+        # The retry starts over rather than resuming from the bad part file
+        self.assertEqual(server.ranges, [None, None])
+
+    def test_zip_download_records_mode(self):
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr("scan/resources/DICOM/files/file.dcm", self.data)
+        self.data = archive.getvalue()
+        server = self.serve()
+        savedMetrics = dicom2bids.runMetrics
+        dicom2bids.runMetrics = dicom2bids.RunMetrics(keepEvents=True)
+        self.addCleanup(setattr, dicom2bids, "runMetrics", savedMetrics)
+        fileList = [("file.dcm", {"URI": server.url, "absolutePath": "", "size": 300000, "digest": None})]
+        with dicom2bids.runMetrics.scope(session="S1"):
+            left = dicom2bids.downloadZip(server.url, fileList, self.tmpDir)
+        self.assertEqual(left, [])
+        events, _ = dicom2bids.runMetrics.takeSession("S1")
+        download, = [event for event in events if event["kind"] == "download"]
+        self.assertEqual(download["mode"], "zip")
+        self.assertEqual(download["status"], "ok")
+        self.assertEqual(download["bytes"], len(self.data))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,23 +10,44 @@ Original file lives here: https://bitbucket.org/nrg_customizations/nrg_pipeline_
 '''
 
 import argparse
+import asyncio
 import collections
+import contextlib
+import errno
+import fcntl
 import json
 import requests
 import os
 import glob
+import fnmatch
+import hashlib
+import io
+import queue
+import re
+import shutil
+import struct
 import sys
 import subprocess
+import threading
 import time
 import zipfile
+import zlib
 import tempfile
 import pydicom
+from pydicom.errors import InvalidDicomError
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from shutil import copy as fileCopy
 from nipype.interfaces.dcm2nii import Dcm2nii
 from collections import OrderedDict
+from functools import lru_cache
+from six.moves.urllib.parse import parse_qsl
 import requests.packages.urllib3
 import six
 from six.moves import zip
+try:
+    import httpx
+except ImportError:
+    httpx = None
 requests.packages.urllib3.disable_warnings()
 
 
@@ -43,107 +64,969 @@ def isTrue(arg):
     return arg is not None and (arg == 'Y' or arg == '1' or arg == 'True')
 
 
-def download(name, pathDict):
-    if os.access(pathDict['absolutePath'], os.R_OK):
+class RunMetrics(object):
+    """Records how long each XNAT request, download, dcm2niix run and zip took, and how many bytes it moved.
+
+    Every event is tagged with the session and scan it was done for. Those come from a per-thread
+    scope (see scope() and bind()), so callers don't have to pass them around. Events are added to
+    running totals for the run (exported as a Prometheus textfile) and for each session (summarized
+    by kind). The events themselves are only kept, per session, when keepEvents is set for the JSONL
+    run report, and takeSession() hands them over and forgets them.
+    """
+    def __init__(self, keepEvents=False):
+        self.lock = threading.Lock()
+        self.keepEvents = keepEvents
+        self.events = {}
+        self.sessionTotals = {}
+        self.totals = {}
+        self.local = threading.local()
+        self.started = time.time()
+
+    def current(self):
+        return dict(getattr(self.local, 'scope', {}))
+
+    @contextlib.contextmanager
+    def scope(self, **fields):
+        # Tag every event recorded by this thread inside the block with fields
+        previous = getattr(self.local, 'scope', {})
+        self.local.scope = dict(previous, **fields)
+        try:
+            yield
+        finally:
+            self.local.scope = previous
+
+    def bind(self, function):
+        # Run function (usually in another thread) in the caller's scope
+        fields = self.current()
+
+        def bound(*args, **kwargs):
+            with self.scope(**fields):
+                return function(*args, **kwargs)
+        return bound
+
+    def record(self, kind, seconds, status="ok", bytes=0, **fields):
+        event = self.current()
+        event.update(fields)
+        event.update({"kind": kind, "start": round(time.time() - seconds, 3), "seconds": round(seconds, 4),
+                      "status": status, "bytes": int(bytes or 0)})
+        with self.lock:
+            # Count, seconds and bytes by kind, method and status for Prometheus
+            entry = self.totals.setdefault((kind, event.get("method", ""), str(status)), [0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += event["seconds"]
+            entry[2] += event["bytes"]
+            session = event.get("session")
+            if session is not None:
+                self.addToSummary(self.sessionTotals.setdefault(session, {}), event)
+                if self.keepEvents:
+                    self.events.setdefault(session, []).append(event)
+        return event
+
+    @contextlib.contextmanager
+    def timed(self, kind, **fields):
+        # Time the block. The block can fill in "bytes" and "status" on the dict it is given.
+        result = {"status": "ok", "bytes": 0}
+        start = time.time()
+        try:
+            yield result
+        except BaseException as e:
+            if result["status"] == "ok":
+                result["status"] = "error"
+            result["error"] = repr(e)
+            raise
+        finally:
+            fields.update(result)
+            self.record(kind, time.time() - start, **fields)
+
+    def takeSession(self, session):
+        # The events (if kept) and summary of session so far, which are then forgotten
+        with self.lock:
+            events = self.events.pop(session, [])
+            summary = self.sessionTotals.pop(session, {})
+        for entry in summary.values():
+            entry["seconds"] = round(entry["seconds"], 3)
+        return events, summary
+
+    @staticmethod
+    def isError(event):
+        # HTTP events carry the status code, everything else a word
+        status = event["status"]
+        if isinstance(status, int):
+            return status >= 400 and status != 404
+        return status == "error" or status.startswith("exit")
+
+    @staticmethod
+    def addToSummary(summary, event):
+        # Count, total seconds, bytes and errors for each kind of event
+        entry = summary.setdefault(event["kind"], {"count": 0, "seconds": 0.0, "bytes": 0, "errors": 0})
+        entry["count"] += 1
+        entry["seconds"] += event["seconds"]
+        entry["bytes"] += event["bytes"]
+        if RunMetrics.isError(event):
+            entry["errors"] += 1
+
+    @staticmethod
+    def writeReport(path, session, events, summary):
+        # One JSON object per event, then a summary line
+        with open(path, "w") as f:
+            for event in events:
+                f.write(json.dumps(event, sort_keys=True) + "\n")
+            f.write(json.dumps({"kind": "summary", "session": session, "totals": summary}, sort_keys=True) + "\n")
+
+    def writePrometheus(self, path, extraLabels=None):
+        """Write run totals in the Prometheus textfile collector format."""
+        labels = dict(extraLabels or {})
+        with self.lock:
+            totals = {key: list(entry) for key, entry in self.totals.items()}
+        counts = {key: entry[0] for key, entry in totals.items()}
+        seconds = {key: entry[1] for key, entry in totals.items()}
+        nbytes = {key: entry[2] for key, entry in totals.items()}
+
+        def labelString(kind=None, method=None, status=None):
+            fields = dict(labels)
+            fields.update((k, v) for k, v in (("kind", kind), ("method", method), ("status", status)) if v)
+            if not fields:
+                return ""
+            return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in sorted(fields.items()))
+
+        lines = ["# HELP dicom2bids_operations_total Operations performed by dicom2bids.",
+                 "# TYPE dicom2bids_operations_total counter"]
+        lines.extend("dicom2bids_operations_total%s %d" % (labelString(*key), counts[key]) for key in sorted(counts))
+        lines.extend(["# HELP dicom2bids_operation_seconds_total Time spent in dicom2bids operations.",
+                      "# TYPE dicom2bids_operation_seconds_total counter"])
+        lines.extend("dicom2bids_operation_seconds_total%s %.4f" % (labelString(*key), seconds[key]) for key in sorted(seconds))
+        lines.extend(["# HELP dicom2bids_bytes_total Bytes moved by dicom2bids operations.",
+                      "# TYPE dicom2bids_bytes_total counter"])
+        lines.extend("dicom2bids_bytes_total%s %d" % (labelString(*key), nbytes[key]) for key in sorted(nbytes))
+        lines.extend(["# HELP dicom2bids_run_seconds Wall time of the dicom2bids run.",
+                      "# TYPE dicom2bids_run_seconds gauge",
+                      "dicom2bids_run_seconds%s %.3f" % (labelString(), time.time() - self.started)])
+
+        # Write to a temporary file and rename, so the collector never reads a partial file
+        tempPath = "%s.%d.tmp" % (path, os.getpid())
+        with open(tempPath, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tempPath, path)
+
+
+runMetrics = RunMetrics()
+
+
+class InstrumentedSession(requests.Session):
+    # A requests session that records the method, URL, status, bytes and duration of every request.
+    # Requests that don't set their own timeout get the session's (connect, read) timeout, so a
+    # stalled connection raises and can be retried instead of hanging a worker.
+    timeout = None
+
+    def request(self, method, url, *args, **kwargs):
+        if self.timeout is not None:
+            kwargs.setdefault("timeout", self.timeout)
+        start = time.time()
+        fields = {"method": method.upper(), "url": url.split("?", 1)[0]}
+        sent = kwargs.get("data")
+        sentBytes = len(sent) if isinstance(sent, (bytes, str)) else 0
+        if kwargs.get("json") is not None:
+            sentBytes = len(json.dumps(kwargs["json"]))
+        try:
+            r = super(InstrumentedSession, self).request(method, url, *args, **kwargs)
+        except requests.exceptions.RequestException as e:
+            runMetrics.record("http", time.time() - start, status="error", bytes=sentBytes, error=repr(e), **fields)
+            raise
+        # Streamed bodies are read later, by download() and readDicomHeader(), so only count what we know now
+        received = len(r.content) if not kwargs.get("stream") else 0
+        runMetrics.record("http", time.time() - start, status=r.status_code, bytes=sentBytes + received, **fields)
+        return r
+
+
+class DownloadIntegrityError(requests.exceptions.RequestException):
+    # A downloaded file doesn't match the size or digest in the XNAT file listing
+    pass
+
+
+def fileDigest(filePath, chunkSize=1048576):
+    # XNAT lists MD5 digests
+    digest = hashlib.md5()
+    with open(filePath, 'rb') as f:
+        while True:
+            block = f.read(chunkSize)
+            if not block:
+                return digest.hexdigest()
+            digest.update(block)
+
+
+def checkFile(filePath, pathDict):
+    """Return None if filePath matches the size and digest XNAT lists for it, otherwise why it doesn't."""
+    size = os.path.getsize(filePath)
+    if pathDict.get('size') is not None and size != pathDict['size']:
+        return "size %d, expected %d" % (size, pathDict['size'])
+    if pathDict.get('digest') and fileDigest(filePath) != pathDict['digest'].lower():
+        return "digest does not match %s" % pathDict['digest']
+    return None
+
+
+# ioctl that makes a file share another file's blocks (btrfs, XFS with reflink=1, ...)
+FICLONE = 0x40049409
+LINK_MODES = ['symlink', 'hardlink', 'reflink', 'copy']
+linkProbeLock = threading.Lock()
+linkProbes = {}
+
+
+def reflinkFile(src, dst):
+    # Clone src's blocks into dst, or failing that let the kernel copy them (e.g. NFS 4.2 server-side copy)
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
         try:
-            os.symlink(pathDict['absolutePath'], name)
-        except:
-            fileCopy(pathDict['absolutePath'], name)
-            print('Copied %s.' % pathDict['absolutePath'])
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except (IOError, OSError):
+            if not hasattr(os, 'copy_file_range'):
+                raise
+        remaining = os.fstat(fsrc.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+            if copied == 0:
+                raise OSError(errno.EIO, "copy_file_range stopped short on %s" % src)
+            remaining -= copied
+
+
+linkers = {'symlink': lambda src, dst: os.symlink(os.path.abspath(src), dst),
+           'hardlink': os.link,
+           'reflink': reflinkFile,
+           'copy': fileCopy}
+
+
+def linkFile(src, dst, mode='auto', autoSymlink=True):
+    """Put src at dst as cheaply as possible. Returns the strategy that worked.
+
+    In auto mode the first file staged between each pair of filesystems tries symlink (unless
+    autoSymlink is False), hardlink, reflink and copy in that order. Later files between the same
+    filesystems go straight to the strategy that worked. Other modes fall back to a copy.
+    """
+    if mode == 'auto':
+        key = (os.stat(src).st_dev, os.stat(os.path.dirname(os.path.abspath(dst))).st_dev, autoSymlink)
+        with linkProbeLock:
+            known = linkProbes.get(key)
+        candidates = [m for m in LINK_MODES if autoSymlink or m != 'symlink']
+        if known is not None:
+            candidates = candidates[candidates.index(known):]
     else:
-        with open(name, 'wb') as f:
-            r = get(pathDict['URI'], stream=True)
+        key = known = None
+        candidates = [mode, 'copy'] if mode != 'copy' else ['copy']
 
-            for block in r.iter_content(1024):
-                if not block:
-                    break
+    for candidate in candidates:
+        try:
+            linkers[candidate](src, dst)
+        except (IOError, OSError):
+            if os.path.lexists(dst):
+                os.remove(dst)
+            if candidate == candidates[-1]:
+                raise
+            continue
+        if key is not None and known is None:
+            with linkProbeLock:
+                if key not in linkProbes:
+                    linkProbes[key] = candidate
+                    print('Staging files from %s into %s with %s.' % (os.path.dirname(src), os.path.dirname(os.path.abspath(dst)), candidate))
+        return candidate
+
+
+def download(name, pathDict, retries=0, backoff=1.0, link=True):
+    """Link or copy a file from the archive if we can read it, otherwise fetch it over HTTP.
+
+    A file already at name that matches the listing's size and digest is kept. HTTP transfers go
+    to name + ".part" and pick up where an earlier, interrupted transfer left off with a Range
+    request. The part file is checked against the listing and renamed into place only when it is
+    complete, so name never holds a truncated file.
+    Failed HTTP transfers are retried up to `retries` times, waiting `backoff` seconds
+    before the first retry and doubling the wait each time after that.
+    Readable archive files are staged with linkFile() in --link-mode. If link is False the result
+    must outlive the archive file, so symlinks are not used.
+    Returns the number of bytes transferred over HTTP.
+    """
+    with runMetrics.timed("download", file=os.path.basename(name)) as result:
+        if os.path.islink(name):
+            if link and os.readlink(name) == os.path.abspath(pathDict['absolutePath']) and os.access(name, os.R_OK):
+                result["status"] = "kept"
+                return 0
+            os.remove(name)
+        elif os.path.isfile(name):
+            if os.access(pathDict['absolutePath'], os.R_OK) and os.path.samefile(name, pathDict['absolutePath']):
+                # A hardlink to the archive file
+                result["status"] = "kept"
+                return 0
+            problem = checkFile(name, pathDict)
+            if problem is None:
+                result["status"] = "kept"
+                return 0
+            print('Fetching %s again: %s.' % (name, problem))
+            os.remove(name)
+
+        partName = name + '.part'
+        if os.access(pathDict['absolutePath'], os.R_OK):
+            if os.path.lexists(partName):
+                os.remove(partName)
+            if link:
+                result["status"] = linkFile(pathDict['absolutePath'], partName, linkMode)
+            else:
+                result["status"] = linkFile(pathDict['absolutePath'], partName, 'auto' if linkMode == 'symlink' else linkMode,
+                                            autoSymlink=False)
+            os.rename(partName, name)
+            return 0
+
+        expected = pathDict.get('size')
+        attempt = 0
+        nbytes = 0
+        while True:
+            try:
+                offset = os.path.getsize(partName) if os.path.isfile(partName) else 0
+                if expected is not None and offset > expected:
+                    offset = 0
+                if expected is None or offset < expected:
+                    headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+                    r = sess.get(pathDict['URI'], headers=headers, stream=True)
+                    if r.status_code == 416:
+                        # Our part file doesn't fit the file on the server any more
+                        r.close()
+                        os.remove(partName)
+                        continue
+                    r.raise_for_status()
+                    if offset and r.status_code != 206:
+                        # The server ignored the Range header and is sending the whole file
+                        offset = 0
+                    elif offset:
+                        result["resumedAt"] = offset
+
+                    with open(partName, 'r+b' if offset else 'wb') as f:
+                        f.seek(offset)
+                        f.truncate()
+                        for block in r.iter_content(65536):
+                            if not block:
+                                break
+
+                            f.write(block)
+                            nbytes += len(block)
+
+                problem = checkFile(partName, pathDict)
+                if problem is not None:
+                    os.remove(partName)
+                    raise DownloadIntegrityError("%s: %s" % (name, problem))
+                os.rename(partName, name)
+                result["bytes"] = nbytes
+                result["retries"] = attempt
+                return nbytes
+            except (requests.ConnectionError, requests.exceptions.RequestException) as e:
+                if attempt >= retries:
+                    result["bytes"] = nbytes
+                    raise
+                delay = backoff * 2 ** attempt
+                attempt += 1
+                print('Download of %s failed (%s). Retry %d of %d in %.1f s.' % (name, e, attempt, retries, delay))
+                time.sleep(delay)
+
+
+def readDicomHeader(pathDict, probeBytes=65536, maxProbeBytes=4194304):
+    """Parse a DICOM file's headers without reading its pixel data.
+
+    Reads straight from absolutePath when we can. Otherwise only the start of the file is
+    fetched with an HTTP Range request, doubling the range while the headers we got stop
+    short of the Modality (0008,0060) element. Past maxProbeBytes the whole file is fetched.
+    """
+    if os.access(pathDict['absolutePath'], os.R_OK):
+        return pydicom.dcmread(pathDict['absolutePath'], stop_before_pixels=True)
 
-                f.write(block)
-        print('Downloaded file %s.' % name)
+    size = probeBytes
+    while True:
+        headers = {'Range': 'bytes=0-%d' % (size - 1)} if size else {}
+        r = sess.get(pathDict['URI'], headers=headers, stream=True)
+        try:
+            r.raise_for_status()
+            # Servers that ignore the Range header send the whole file, so stop reading once we have enough
+            data = bytearray()
+            for block in r.iter_content(65536):
+                data.extend(block)
+                if size and len(data) >= size:
+                    break
+        finally:
+            r.close()
 
-def zipdir(dirPath=None, zipFilePath=None, includeDirInZip=True):
+        truncated = bool(size) and len(data) >= size
+        try:
+            d = pydicom.dcmread(io.BytesIO(bytes(data[:size] if size else data)), stop_before_pixels=True)
+            if not truncated or (0x0008, 0x0060) in d:
+                return d
+        except (InvalidDicomError, struct.error, EOFError, ValueError):
+            # A probe that cuts an element short can fail in any of these ways
+            if not truncated:
+                raise
+        size = size * 2 if size * 2 <= maxProbeBytes else None
+
+
+def downloadFiles(fileList, destDir, workers=1, retries=0, backoff=1.0, label=None, link=True):
+    """Download (name, pathDict) pairs into destDir using a bounded pool of worker threads.
+
+    Prints progress as files complete and a single throughput summary at the end.
+    Exits if any file still fails after its retries, just like get() does.
+    """
+    total = len(fileList)
+    if total == 0:
+        return 0
+    label = label or destDir
+    start = time.time()
+    done = 0
+    nbytes = 0
+    reportEvery = max(10, total // 10)
+
+    workers = max(1, min(workers, total))
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = [executor.submit(runMetrics.bind(download), os.path.join(destDir, name), pathDict, retries, backoff, link)
+               for name, pathDict in fileList]
+    try:
+        for future in as_completed(futures):
+            nbytes += future.result()
+            done += 1
+            if done % reportEvery == 0 and done != total:
+                elapsed = time.time() - start
+                print('Fetched %d/%d files for %s (%.1f MB, %.1f s).' % (done, total, label, nbytes / 1e6, elapsed))
+    except (requests.ConnectionError, requests.exceptions.RequestException) as e:
+        for future in futures:
+            future.cancel()
+        print("Request Failed")
+        print("    " + str(e))
+        sys.exit(1)
+    finally:
+        executor.shutdown(wait=True)
+
+    elapsed = max(time.time() - start, 1e-6)
+    print('Fetched %d files for %s: %.1f MB in %.1f s (%.2f MB/s, %d workers).' %
+          (total, label, nbytes / 1e6, elapsed, nbytes / 1e6 / elapsed, workers))
+    return nbytes
+
+
+def downloadZip(filesURL, fileList, destDir, retries=0, backoff=1.0, label=None):
+    """Fetch a whole resource as one zip archive and unpack the files in fileList into destDir as it streams in.
+
+    Members are written to .part files, checked against the listing and renamed into place, just like
+    download() does. Files already in destDir are left alone. Returns the (name, pathDict) pairs that
+    did not come from the archive (all of them if it couldn't be fetched), for the caller to hand to
+    downloadFiles(), which also checks any files that were already there.
+    """
+    label = label or destDir
+    wanted = OrderedDict(fileList)
+    written = set()
+    start = time.time()
+    nbytes = 0
+    attempt = 0
+    while True:
+        missing = set(name for name in wanted if name not in written and not os.path.isfile(os.path.join(destDir, name)))
+        if not missing:
+            break
+        try:
+            with runMetrics.timed("download", file=os.path.basename(filesURL) + ".zip", mode="zip") as result:
+                r = sess.get(filesURL, params={"format": "zip"}, stream=True)
+                r.raise_for_status()
+                try:
+                    for member, blocks in ZipStreamReader(r.iter_content(1048576)).members():
+                        name = member.rsplit('/', 1)[-1]
+                        if name not in missing:
+                            for _ in blocks:
+                                pass
+                            continue
+                        partPath = os.path.join(destDir, name + '.part')
+                        with open(partPath, 'wb') as f:
+                            for block in blocks:
+                                f.write(block)
+                        problem = checkFile(partPath, wanted[name])
+                        if problem is not None:
+                            os.remove(partPath)
+                            raise DownloadIntegrityError("%s: %s" % (name, problem))
+                        os.rename(partPath, os.path.join(destDir, name))
+                        written.add(name)
+                        missing.discard(name)
+                finally:
+                    nbytes += r.raw.tell() if hasattr(r.raw, 'tell') else 0
+                    result["bytes"] = nbytes
+                    r.close()
+            break
+        except (requests.ConnectionError, requests.exceptions.RequestException, zipfile.BadZipfile, zlib.error) as e:
+            if attempt >= retries:
+                print('Could not fetch %s as a zip archive (%s).' % (label, e))
+                break
+            delay = backoff * 2 ** attempt
+            attempt += 1
+            print('Zip download of %s failed (%s). Retry %d of %d in %.1f s.' % (label, e, attempt, retries, delay))
+            time.sleep(delay)
+
+    elapsed = max(time.time() - start, 1e-6)
+    print('Fetched %d files for %s as a zip archive: %.1f MB in %.1f s (%.2f MB/s).' %
+          (len(written), label, nbytes / 1e6, elapsed, nbytes / 1e6 / elapsed))
+    return [(name, pathDict) for name, pathDict in wanted.items() if name not in written]
+
+
+def runPipeline(jobs, stages, maxInFlight):
+    """Push jobs through a list of (name, function, workers) stages joined by bounded queues.
+
+    Each stage runs in its own worker threads and hands a job on to the next stage when its
+    function returns True; returning False drops the job. At most maxInFlight jobs are in the
+    pipeline at once, so later jobs download while earlier ones convert and upload.
+    If any stage raises (including the SystemExit from get()), no new jobs are started,
+    the jobs already in flight are drained, and the first error is re-raised here.
+    """
+    queues = [queue.Queue(maxsize=maxInFlight) for _ in stages]
+    slots = threading.BoundedSemaphore(maxInFlight)
+    scope = runMetrics.current()
+    abort = threading.Event()
+    errors = []
+
+    def worker(index, name, function):
+        inQueue = queues[index]
+        outQueue = queues[index + 1] if index + 1 < len(queues) else None
+        while True:
+            job = inQueue.get()
+            if job is None:
+                return
+            passOn = False
+            if not abort.is_set():
+                try:
+                    with runMetrics.scope(scan=getattr(job, 'scanid', None), **scope):
+                        with runMetrics.timed("stage", stage=name):
+                            passOn = function(job)
+                except BaseException as e:
+                    print('Stage %s failed for scan %s.' % (name, getattr(job, 'scanid', job)))
+                    errors.append(e)
+                    abort.set()
+            if passOn and outQueue is not None:
+                outQueue.put(job)
+            else:
+                slots.release()
+
+    stageThreads = []
+    for index, (name, function, workers) in enumerate(stages):
+        threads = [threading.Thread(target=worker, args=(index, name, function), name='%s-%d' % (name, i))
+                   for i in range(max(1, workers))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        stageThreads.append(threads)
+
+    for job in jobs:
+        slots.acquire()
+        if abort.is_set():
+            slots.release()
+            break
+        queues[0].put(job)
+
+    # Shut the stages down in order, so each one sees all of the previous stage's output
+    for index, threads in enumerate(stageThreads):
+        for _ in threads:
+            queues[index].put(None)
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+
+
+class ConversionScheduler(object):
+    """Run converter processes concurrently within a budget of CPU cores.
+
+    dcm2niix converts a series on one thread, however big it is, so each job takes one core
+    unless the caller says it runs more threads. Jobs are admitted strictly in arrival order:
+    a heavy job at the head of the line waits for cores to free up rather than being
+    overtaken indefinitely by lighter jobs behind it.
+    """
+    def __init__(self, cores):
+        self.cores = max(1, cores)
+        self.coresInUse = 0
+        self.waiting = collections.deque()
+        self.condition = threading.Condition()
+
+    def weight(self, threads):
+        return max(1, min(self.cores, int(threads or 1)))
+
+    def run(self, label, command, fileCount=0, threads=1):
+        """Run command once enough cores are free. Output is captured and printed as one block."""
+        weight = self.weight(threads)
+        ticket = object()
+        queued = time.time()
+        with self.condition:
+            self.waiting.append(ticket)
+            while self.waiting[0] is not ticket or self.coresInUse + weight > self.cores:
+                self.condition.wait()
+            self.waiting.popleft()
+            self.coresInUse += weight
+            self.condition.notify_all()
+
+        print('Executing command for %s on %d of %d cores: %s' % (label, weight, self.cores, " ".join(command)))
+        start = time.time()
+        try:
+            proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout, stderr = proc.communicate()
+        finally:
+            with self.condition:
+                self.coresInUse -= weight
+                self.condition.notify_all()
+
+        runMetrics.record("convert", time.time() - start, status="ok" if proc.returncode == 0 else "exit %d" % proc.returncode, command=command[0], files=fileCount,
+                          cores=weight, waitSeconds=round(start - queued, 3))
+        lines = ['----- %s output for %s (exit code %d, %.1f s) -----' % (command[0], label, proc.returncode, time.time() - start)]
+        lines.append(stdout.decode('utf-8', 'replace').rstrip())
+        if stderr.strip():
+            lines.append('----- %s stderr for %s -----' % (command[0], label))
+            lines.append(stderr.decode('utf-8', 'replace').rstrip())
+        print('\n'.join(lines))
+
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, command, output=stdout, stderr=stderr)
+        return stdout
+
+
+def zipdir(dirPath=None, zipFilePath=None, includeDirInZip=True, compressThreads=1):
+    # Write a zip archive of dirPath to zipFilePath, with the same engine as ZipStream
     if not zipFilePath:
         zipFilePath = dirPath + ".zip"
-    if not os.path.isdir(dirPath):
-        raise OSError("dirPath argument must point to a directory. "
-            "'%s' does not." % dirPath)
-    parentDir, dirToZip = os.path.split(dirPath)
-    def trimPath(path):
-        archivePath = path.replace(parentDir, "", 1)
-        if parentDir:
-            archivePath = archivePath.replace(os.path.sep, "", 1)
-        if not includeDirInZip:
-            archivePath = archivePath.replace(dirToZip + os.path.sep, "", 1)
-        return os.path.normcase(archivePath)
-    outFile = zipfile.ZipFile(zipFilePath, "w",
-        compression=zipfile.ZIP_DEFLATED)
-    for (archiveDirPath, dirNames, fileNames) in os.walk(dirPath):
-        for fileName in fileNames:
-            filePath = os.path.join(archiveDirPath, fileName)
-            outFile.write(filePath, trimPath(filePath))
-        # Make sure we get empty directories as well
-        if not fileNames and not dirNames:
-            zipInfo = zipfile.ZipInfo(trimPath(archiveDirPath) + "/")
-            # some web sites suggest doing
-            # zipInfo.external_attr = 16
-            # or
-            # zipInfo.external_attr = 48
-            # Here to allow for inserting an empty directory.  Still TBD/TODO.
-            outFile.writestr(zipInfo, "")
-    outFile.close()
-
-BIDSVERSION = "1.0.1"
+    zipStream = ZipStream(dirPath, includeDirInZip=includeDirInZip, compressThreads=compressThreads)
+    start = time.time()
+    with open(zipFilePath, 'wb') as f:
+        for chunk in zipStream.chunks():
+            f.write(chunk)
+    runMetrics.record("zip", time.time() - start, bytes=os.path.getsize(zipFilePath), dir=os.path.basename(dirPath),
+                      threads=compressThreads)
+
+class ZipStream(object):
+    """Produce a zip archive of a directory as a stream of bytes, without staging it on disk.
+
+    Members that are already compressed (.nii.gz and friends) are STORED. Their CRC is computed
+    up front so the local header is complete, which keeps the archive readable by
+    java.util.zip. Everything else (JSON, bval, bvec, uncompressed NIfTI) is DEFLATED and
+    followed by a data descriptor. Zip64 records are written when sizes or offsets need them.
+    At most chunkSize bytes of file data are held in memory at a time.
+
+    With compressThreads above 1, DEFLATED members bigger than chunkSize are compressed the way
+    pigz does it: chunkSize blocks are deflated concurrently, each primed with the last 32 KiB of
+    the block before it and ended with a sync flush, so the pieces join into one deflate stream.
+    The CRC is still taken over the blocks in order. Up to 2 * compressThreads blocks are held
+    in memory.
+    """
+    storedExtensions = ('.gz', '.zip', '.bz2', '.xz', '.zst', '.jpg', '.jpeg', '.png')
+    # Deflate's window. Each parallel block may refer back this far into the block before it.
+    windowSize = 32768
+    # Sizes and offsets from here up need Zip64 records
+    zip64Limit = 0xFFFFFFFF
+
+    def __init__(self, dirPath, includeDirInZip=False, chunkSize=1048576, compressLevel=6, compressThreads=1):
+        if not os.path.isdir(dirPath):
+            raise OSError("dirPath argument must point to a directory. "
+                "'%s' does not." % dirPath)
+        self.dirPath = dirPath
+        self.includeDirInZip = includeDirInZip
+        self.chunkSize = chunkSize
+        self.compressLevel = compressLevel
+        self.compressThreads = max(1, compressThreads or 1)
+        self.bytesWritten = 0
+
+    def members(self):
+        parentDir, dirToZip = os.path.split(os.path.normpath(self.dirPath))
+        base = parentDir if self.includeDirInZip else os.path.normpath(self.dirPath)
+        for (archiveDirPath, dirNames, fileNames) in os.walk(self.dirPath):
+            dirNames.sort()
+            for fileName in sorted(fileNames):
+                filePath = os.path.join(archiveDirPath, fileName)
+                arcName = os.path.relpath(filePath, base).replace(os.path.sep, '/')
+                yield filePath, arcName
+            # Make sure we get empty directories as well
+            if not fileNames and not dirNames and os.path.normpath(archiveDirPath) != base:
+                yield None, os.path.relpath(archiveDirPath, base).replace(os.path.sep, '/') + '/'
+
+    def isStored(self, arcName):
+        return arcName.endswith('/') or arcName.lower().endswith(self.storedExtensions)
+
+    def __iter__(self):
+        # Only count time spent producing the archive, not time the consumer spends sending it
+        busy = 0.0
+        self.bytesWritten = 0
+        chunks = self.chunks()
+        while True:
+            start = time.time()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                busy += time.time() - start
+                break
+            busy += time.time() - start
+            self.bytesWritten += len(chunk)
+            yield chunk
+        runMetrics.record("zip", busy, bytes=self.bytesWritten, dir=os.path.basename(self.dirPath), streamed=True,
+                          threads=self.compressThreads)
+
+    def chunks(self):
+        # ThreadPoolExecutor only starts threads once there is work for them
+        pool = ThreadPoolExecutor(max_workers=self.compressThreads) if self.compressThreads > 1 else None
+        try:
+            for chunk in self.archiveChunks(pool):
+                yield chunk
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    def archiveChunks(self, pool):
+        entries = []
+        offset = 0
+        for filePath, arcName in self.members():
+            st = os.stat(filePath) if filePath else None
+            size = st.st_size if st else 0
+            stored = self.isStored(arcName)
+            entry = {'name': arcName.encode('utf-8'), 'offset': offset, 'size': size,
+                     'method': zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED,
+                     'flags': 0x800 if not arcName.isascii() else 0,
+                     'mode': (st.st_mode if st else 0o40755) & 0xFFFF,
+                     'dostime': self.dosTime(st.st_mtime if st else time.time()),
+                     'zip64': size >= self.zip64Limit or offset >= self.zip64Limit}
+
+            if stored:
+                entry['crc'] = self.crc(filePath) if filePath else 0
+                entry['csize'] = size
+            else:
+                entry['flags'] |= 0x08
+                entry['crc'] = entry['csize'] = 0
+
+            chunk = self.localHeader(entry)
+            offset += len(chunk)
+            yield chunk
+
+            if filePath:
+                crc = 0
+                csize = 0
+                with open(filePath, 'rb') as f:
+                    if stored:
+                        blocks = ((None, block) for block in iter(lambda: f.read(self.chunkSize), b''))
+                    elif pool is not None and size > self.chunkSize:
+                        blocks = self.deflateParallel(f, pool)
+                    else:
+                        blocks = self.deflate(f)
+                    for raw, block in blocks:
+                        if raw is not None:
+                            crc = zlib.crc32(raw, crc)
+                        csize += len(block)
+                        if block:
+                            yield block
+                offset += csize
+                if not stored:
+                    entry['crc'] = crc
+                    entry['csize'] = csize
+                    if entry['zip64']:
+                        chunk = struct.pack('<IIQQ', 0x08074b50, crc, csize, size)
+                    else:
+                        chunk = struct.pack('<IIII', 0x08074b50, crc, csize, size)
+                    offset += len(chunk)
+                    yield chunk
+            entries.append(entry)
+
+        # Central directory
+        centralStart = offset
+        for entry in entries:
+            chunk = self.centralHeader(entry)
+            offset += len(chunk)
+            yield chunk
+        centralSize = offset - centralStart
+
+        count = len(entries)
+        if count >= 0xFFFF or centralStart >= self.zip64Limit or centralSize >= self.zip64Limit:
+            yield struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, centralSize, centralStart)
+            yield struct.pack('<IIQI', 0x07064b50, 0, offset, 1)
+            count = min(count, 0xFFFF)
+            centralSize = 0xFFFFFFFF if centralSize >= self.zip64Limit else centralSize
+            centralStart = 0xFFFFFFFF if centralStart >= self.zip64Limit else centralStart
+        yield struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, centralSize, centralStart, 0)
+
+    def deflate(self, f):
+        # Yields (uncompressed, compressed) blocks of f as one deflate stream
+        compressor = zlib.compressobj(self.compressLevel, zlib.DEFLATED, -15)
+        for block in iter(lambda: f.read(self.chunkSize), b''):
+            yield block, compressor.compress(block)
+        yield None, compressor.flush()
+
+    def deflateBlock(self, block, dictionary, last):
+        if dictionary:
+            compressor = zlib.compressobj(self.compressLevel, zlib.DEFLATED, -15, zdict=dictionary)
+        else:
+            compressor = zlib.compressobj(self.compressLevel, zlib.DEFLATED, -15)
+        # A sync flush ends on a byte boundary without ending the stream, so the next block can follow directly
+        return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+    def deflateParallel(self, f, pool):
+        # Like deflate(), but the blocks are compressed on pool. zlib releases the GIL while it works.
+        pending = collections.deque()
+        previous = b''
+        block = f.read(self.chunkSize)
+        while block:
+            nextBlock = f.read(self.chunkSize)
+            pending.append((block, pool.submit(self.deflateBlock, block, previous[-self.windowSize:], not nextBlock)))
+            previous, block = block, nextBlock
+            while pending and (len(pending) >= 2 * self.compressThreads or not block):
+                raw, future = pending.popleft()
+                yield raw, future.result()
+
+    def crc(self, filePath):
+        crc = 0
+        with open(filePath, 'rb') as f:
+            while True:
+                block = f.read(self.chunkSize)
+                if not block:
+                    return crc
+                crc = zlib.crc32(block, crc)
+
+    @staticmethod
+    def dosTime(timestamp):
+        t = time.localtime(max(timestamp, 315532800))
+        return ((t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday) << 16 | \
+               (t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2)
+
+    def localHeader(self, entry):
+        extra = b''
+        csize, size = entry['csize'], entry['size']
+        if entry['zip64']:
+            extra = struct.pack('<HHQQ', 0x0001, 16, size, csize)
+            csize = size = 0xFFFFFFFF
+        version = 45 if entry['zip64'] else 20
+        return struct.pack('<IHHHHHIIIHH', 0x04034b50, version, entry['flags'], entry['method'],
+                           entry['dostime'] & 0xFFFF, entry['dostime'] >> 16, entry['crc'], csize, size,
+                           len(entry['name']), len(extra)) + entry['name'] + extra
+
+    def centralHeader(self, entry):
+        fields = []
+        size, csize, offset = entry['size'], entry['csize'], entry['offset']
+        if size >= self.zip64Limit or entry['zip64']:
+            fields.append(size)
+            size = 0xFFFFFFFF
+        if csize >= self.zip64Limit or entry['zip64']:
+            fields.append(csize)
+            csize = 0xFFFFFFFF
+        if offset >= self.zip64Limit:
+            fields.append(offset)
+            offset = 0xFFFFFFFF
+        extra = struct.pack('<HH%dQ' % len(fields), 0x0001, 8 * len(fields), *fields) if fields else b''
+        version = 45 if extra else 20
+        return struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 3 << 8 | version, version, entry['flags'],
+                           entry['method'], entry['dostime'] & 0xFFFF, entry['dostime'] >> 16, entry['crc'],
+                           csize, size, len(entry['name']), len(extra), 0, 0, 0, entry['mode'] << 16,
+                           offset) + entry['name'] + extra
+
+
+class ZipStreamReader(object):
+    """Read the members of a zip archive from a stream, front to back, without seeking.
+
+    Walks the local file headers, so nothing past the member being read is held in memory and
+    the central directory at the end is never needed. Handles DEFLATED members whose sizes
+    follow in a data descriptor, which is how java.util.zip (and so XNAT) writes them, and
+    Zip64 sizes. STORED members must have their sizes in the local header.
+    """
+    def __init__(self, chunks, chunkSize=1048576):
+        self.chunks = iter(chunks)
+        self.chunkSize = chunkSize
+        self.buffer = bytearray()
+
+    def readSome(self, n):
+        # Up to n bytes. Only returns b'' at the end of the stream.
+        while not self.buffer:
+            try:
+                self.buffer.extend(next(self.chunks))
+            except StopIteration:
+                return b''
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    def read(self, n):
+        data = bytearray()
+        while len(data) < n:
+            block = self.readSome(n - len(data))
+            if not block:
+                raise zipfile.BadZipfile("Archive ends in the middle of a member")
+            data.extend(block)
+        return bytes(data)
+
+    def unread(self, data):
+        self.buffer[:0] = data
+
+    def members(self):
+        """Yield (name, blocks) for each member. blocks must be used up before asking for the next member."""
+        while True:
+            signature = self.read(4)
+            if signature in (b'PK\x01\x02', b'PK\x05\x06', b'PK\x06\x06'):
+                # Central directory: no more members
+                return
+            if signature != b'PK\x03\x04':
+                raise zipfile.BadZipfile("Expected a local file header, found %r" % signature)
+            (version, flags, method, _, _, crc, csize, size, nameLength, extraLength) = \
+                struct.unpack('<HHHHHIIIHH', self.read(26))
+            name = self.read(nameLength).decode('utf-8' if flags & 0x800 else 'cp437')
+            extra = self.read(extraLength)
+            zip64 = False
+            while len(extra) >= 4:
+                headerId, dataSize = struct.unpack('<HH', extra[:4])
+                if headerId == 0x0001:
+                    zip64 = True
+                    values = list(struct.unpack('<%dQ' % (dataSize // 8), extra[4:4 + dataSize - dataSize % 8]))
+                    if size == 0xFFFFFFFF and values:
+                        size = values.pop(0)
+                    if csize == 0xFFFFFFFF and values:
+                        csize = values.pop(0)
+                extra = extra[4 + dataSize:]
+            if flags & 0x01:
+                raise zipfile.BadZipfile("%s is encrypted" % name)
+            if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+                raise zipfile.BadZipfile("%s uses unsupported compression method %d" % (name, method))
+            if method == zipfile.ZIP_STORED and flags & 0x08 and not csize:
+                raise zipfile.BadZipfile("%s is stored without its size" % name)
+            yield name, self.memberBlocks(name, method, flags, crc, csize, size, zip64)
+
+    def memberBlocks(self, name, method, flags, crc, csize, size, zip64):
+        actualCrc = 0
+        actualSize = 0
+        knownSize = not (flags & 0x08) or method == zipfile.ZIP_STORED
+        decompressor = zlib.decompressobj(-15) if method == zipfile.ZIP_DEFLATED else None
+        remaining = csize
+        while True:
+            if knownSize:
+                if remaining == 0:
+                    break
+                block = self.readSome(min(self.chunkSize, remaining))
+                if not block:
+                    raise zipfile.BadZipfile("Archive ends in the middle of %s" % name)
+                remaining -= len(block)
+            else:
+                block = self.readSome(self.chunkSize)
+                if not block:
+                    raise zipfile.BadZipfile("Archive ends in the middle of %s" % name)
+            if decompressor:
+                data = decompressor.decompress(block)
+                if decompressor.eof:
+                    self.unread(decompressor.unused_data)
+            else:
+                data = block
+            if data:
+                actualCrc = zlib.crc32(data, actualCrc)
+                actualSize += len(data)
+                yield data
+            if decompressor and decompressor.eof:
+                break
+        if decompressor and not decompressor.eof:
+            raise zipfile.BadZipfile("Compressed data for %s is truncated" % name)
+
+        if flags & 0x08:
+            header = self.read(4)
+            if header != b'PK\x07\x08':
+                self.unread(header)
+            if zip64:
+                crc, csize, size = struct.unpack('<IQQ', self.read(20))
+            else:
+                crc, csize, size = struct.unpack('<III', self.read(12))
+        if actualCrc != crc or actualSize != size:
+            raise zipfile.BadZipfile("CRC or size check failed for %s" % name)
 
-parser = argparse.ArgumentParser(description="Run dcm2niix on every file in a session")
-parser.add_argument("--host", default="https://cnda.wustl.edu", help="CNDA host", required=True)
-parser.add_argument("--user", help="CNDA username", required=True)
-parser.add_argument("--password", help="Password", required=True)
-parser.add_argument("--session", help="Session ID", required=True)
-parser.add_argument("--subject", help="Subject Label", required=False)
-parser.add_argument("--project", help="Project", required=False)
-parser.add_argument("--dicomdir", help="Root output directory for DICOM files", required=True)
-parser.add_argument("--niftidir", help="Root output directory for NIFTI files", required=True)
-parser.add_argument("--overwrite", help="Overwrite NIFTI files if they exist")
-parser.add_argument("--upload-by-ref", help="Upload \"by reference\". Only use if your host can read your file system.")
-parser.add_argument("--workflowId", help="Pipeline workflow ID")
-parser.add_argument('--version', action='version', version='%(prog)s 1')
-
-args, unknown_args = parser.parse_known_args()
-host = cleanServer(args.host)
-session = args.session
-subject = args.subject
-project = args.project
-overwrite = isTrue(args.overwrite)
-dicomdir = args.dicomdir
-niftidir = args.niftidir
-workflowId = args.workflowId
-uploadByRef = isTrue(args.upload_by_ref)
-dcm2niixArgs = unknown_args if unknown_args is not None else []
-
-imgdir = niftidir + "/IMG"
-bidsdir = niftidir + "/BIDS"
-
-builddir = os.getcwd()
-
-# Set up working directory
-if not os.access(dicomdir, os.R_OK):
-    print('Making DICOM directory %s' % dicomdir)
-    os.mkdir(dicomdir)
-if not os.access(niftidir, os.R_OK):
-    print('Making NIFTI directory %s' % niftidir)
-    os.mkdir(niftidir)
-if not os.access(imgdir, os.R_OK):
-    print('Making NIFTI image directory %s' % imgdir)
-    os.mkdir(imgdir)
-if not os.access(bidsdir, os.R_OK):
-    print('Making NIFTI BIDS directory %s' % bidsdir)
-    os.mkdir(bidsdir)
-
-# Set up session
-sess = requests.Session()
-sess.verify = False
-sess.auth = (args.user, args.password)
 
+BIDSVERSION = "1.0.1"
+FINGERPRINT_FILE = "dicom2bids_fingerprint.json"
+RUN_REPORT_FILE = "dicom2bids_run_report.jsonl"
 
 def get(url, **kwargs):
     try:
@@ -155,128 +1038,867 @@ def get(url, **kwargs):
         sys.exit(1)
     return r
 
-if project is None or subject is None:
-    # Get project ID and subject ID from session JSON
-    print("Get project and subject ID for session ID %s." % session)
-    r = get(host + "/data/experiments/%s" % session, params={"format": "json", "handler": "values", "columns": "project,subject_ID"})
-    sessionValuesJson = r.json()["ResultSet"]["Result"][0]
-    project = sessionValuesJson["project"] if project is None else project
-    subjectID = sessionValuesJson["subject_ID"]
-    print("Project: " + project)
-    print("Subject ID: " + subjectID)
-
-    if subject is None:
-        print()
-        print("Get subject label for subject ID %s." % subjectID)
-        r = get(host + "/data/subjects/%s" % subjectID, params={"format": "json", "handler": "values", "columns": "label"})
-        subject = r.json()["ResultSet"]["Result"][0]["label"]
-        print("Subject label: " + subject)
-
-# Get list of scan ids
-print("Get scan list for session ID %s." % session)
-r = get(host + "/data/experiments/%s/scans" % session, params={"format": "json"})
-scanRequestResultList = r.json()["ResultSet"]["Result"]
-scanIDList = [scan['ID'] for scan in scanRequestResultList]
-seriesDescList = [scan['series_description'] for scan in scanRequestResultList]  # { id: sd for (scan['ID'], scan['series_description']) in scanRequestResultList }
-print('Found scans %s.' % ', '.join(scanIDList))
-print('Series descriptions %s' % ', '.join(seriesDescList))
-
-# Fall back on scan type if series description field is empty
-if set(seriesDescList) == set(['']):
-    seriesDescList = [scan['type'] for scan in scanRequestResultList]
-    print('Fell back to scan types %s' % ', '.join(seriesDescList))
-
-# Read bids map from input config
-bidsmaplist = []
-
-print("Get project BIDS map if one exists")
-# We don't use the convenience get() method because that throws exceptions when the object is not found.
-r = sess.get(host + "/data/projects/%s/resources/config/files/bidsmap.json" % project, params={"contents": True})
-if r.ok:
-    bidsmaptoadd = r.json()
-    print("BIDS bidsmaptoadd: ",  bidsmaptoadd)
-    for mapentry in bidsmaptoadd:
-        if mapentry not in bidsmaplist:
-            bidsmaplist.append(mapentry)
-else:
-    print("Could not read project BIDS map")
-
-
-# Get site-level configs
-print("Get Site BIDS map ")
-# We don't use the convenience get() method because that throws exceptions when the object is not found.
-r = sess.get(host + "/data/config/bids/bidsmap", params={"contents": True})
-if r.ok:
-    bidsmaptoadd = r.json()
-    print("BIDS bidsmaptoadd: ",  bidsmaptoadd)
-    for mapentry in bidsmaptoadd:
-        if mapentry not in bidsmaplist:
-            bidsmaplist.append(mapentry)
-else:
-    print("Could not read site-wide BIDS map")
-
-print("BIDS bidsmaplist: ", json.dumps(bidsmaplist))
-
-# Collapse human-readable JSON to dict for processing
-bidsnamemap = {x['series_description'].lower(): x['bidsname'] for x in bidsmaplist if 'series_description' in x and 'bidsname' in x}
-
-# Map all series descriptions to BIDS names (case insensitive)
-resolved = [bidsnamemap[x.lower()] for x in seriesDescList if x.lower() in bidsnamemap]
-
-# Count occurrences
-bidscount = collections.Counter(resolved)
-
-# Remove multiples
-multiples = {seriesdesc: count for seriesdesc, count in six.viewitems(bidscount) if count > 1}
-
-# Cheat and reverse scanid and seriesdesc lists so numbering is in the right order
-for scanid, seriesdesc in zip(reversed(scanIDList), reversed(seriesDescList)):
-    print()
-    print('Beginning process for scan %s.' % scanid)
-    os.chdir(builddir)
-
-    print('Assigning BIDS name for scan %s.' % scanid)
-
-    # BIDS subject name
-    base = "sub-" + subject + "_"
-
-    if seriesdesc.lower() not in bidsnamemap:
-        print("Series " + seriesdesc + " not found in BIDSMAP")
-        # bidsname = "Z"
-        continue  # Exclude series from processing
-    else:
-        print("Series " + seriesdesc + " matched " + bidsnamemap[seriesdesc.lower()])
-        match = bidsnamemap[seriesdesc.lower()]
+def checkStatus(r):
+    # raise_for_status() for both requests and httpx responses
+    if r.status_code >= 400:
+        raise requests.exceptions.HTTPError("%d Error for url: %s" % (r.status_code, r.url))
+    return r
 
-    # split before last _
-    splitname = match.split("_")
 
-    # Check for multiples
-    if match in multiples:
-        # insert run-0x
-        run = 'run-%02d' % multiples[match]
-        splitname.insert(len(splitname) - 1, run)
+class AsyncXnatClient(object):
+    """Issue XNAT GETs concurrently from an asyncio event loop.
+
+    Uses httpx (with HTTP/2 when the h2 package is installed) if it is available, and otherwise
+    runs the blocking requests session in a thread pool. Either way at most `concurrency`
+    requests are in flight, connections are kept alive between them, and cancelling the
+    task that awaits a request abandons it.
+    """
+    def __init__(self, concurrency=16, backend="auto"):
+        self.concurrency = max(1, concurrency)
+        if backend == "auto":
+            backend = "httpx" if httpx is not None else "requests"
+        elif backend == "httpx" and httpx is None:
+            print("httpx is not installed. Falling back to requests for concurrent metadata requests.")
+            backend = "requests"
+        self.backend = backend
+        self.client = None
+        self.executor = None
+
+    async def __aenter__(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        if self.backend == "httpx":
+            try:
+                import h2
+                http2 = True
+            except ImportError:
+                http2 = False
+            self.client = httpx.AsyncClient(auth=sess.auth, verify=False, http2=http2, timeout=httpx.Timeout(sess.timeout[1], connect=sess.timeout[0]) if sess.timeout else httpx.Timeout(60.0),
+                                            limits=httpx.Limits(max_connections=self.concurrency,
+                                                                max_keepalive_connections=self.concurrency))
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        return self
+
+    async def __aexit__(self, *excInfo):
+        if self.client is not None:
+            await self.client.aclose()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    async def get(self, url, params=None):
+        """GET url. Returns a response with status_code, text and json(), whatever the backend."""
+        async with self.semaphore:
+            if self.client is None:
+                loop = asyncio.get_event_loop()
+                return await loop.run_in_executor(self.executor, runMetrics.bind(lambda: sess.get(url, params=params)))
+
+            start = time.time()
+            try:
+                r = await self.client.get(url, params=params)
+            except httpx.HTTPError as e:
+                runMetrics.record("http", time.time() - start, status="error", method="GET", url=url, backend="httpx", error=repr(e))
+                raise requests.exceptions.ConnectionError(str(e))
+            runMetrics.record("http", time.time() - start, status=r.status_code, bytes=len(r.content), method="GET", url=url,
+                              backend="httpx", httpVersion=r.http_version)
+            return r
+
+
+class MetadataPrefetch(object):
+    """Fill a SessionCatalog from a background thread running an asyncio loop.
+
+    The pipeline starts on the first scans straight away. Whatever it asks the catalog for that
+    the prefetch has already started is waited on rather than requested twice. cancel() stops
+    the prefetch; anything it had not finished is left for the pipeline to fetch itself.
+    """
+    def __init__(self, catalog, scanIDs, concurrency=16, backend="auto", fingerprints=False, skipConverted=False):
+        self.catalog = catalog
+        self.scanIDs = list(scanIDs)
+        self.concurrency = concurrency
+        self.backend = backend
+        self.fingerprints = fingerprints
+        self.skipConverted = skipConverted
+        self.loop = None
+        self.task = None
+        self.cancelled = False
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=runMetrics.bind(self.run), name="prefetch")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        with self.lock:
+            if self.cancelled:
+                return
+            self.loop = asyncio.get_event_loop()
+            self.task = asyncio.current_task()
+        start = time.time()
+        try:
+            async with AsyncXnatClient(self.concurrency, self.backend) as client:
+                await asyncio.gather(*[self.catalog.prefetchScan(client, scanid, self.fingerprints, self.skipConverted) for scanid in self.scanIDs],
+                                     return_exceptions=True)
+                print('Prefetched metadata for %d scans in %.1f s using %s.' % (len(self.scanIDs), time.time() - start, client.backend))
+        except asyncio.CancelledError:
+            print('Stopped prefetching metadata.')
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            if self.task is not None and not self.task.done():
+                self.loop.call_soon_threadsafe(self.task.cancel)
+
+    def join(self):
+        self.thread.join()
+
+
+class SessionCatalog(object):
+    """In-memory index of a session's scans, scan resources and resource file listings.
+
+    Every listing is requested from XNAT at most once, even when several pipeline threads
+    (or the background prefetch) ask for it at the same time. File listings are fetched with
+    locator=absolutePath, which gives us the URI, absolutePath and size of each file in a
+    single request.
+    """
+    def __init__(self, session):
+        self.session = session
+        self.lock = threading.Lock()
+        self.cache = {}
+
+    def claim(self, key):
+        # Returns (future, owner). The owner has to fill the future in, everyone else waits on it.
+        with self.lock:
+            future = self.cache.get(key)
+            owner = future is None
+            if owner:
+                future = self.cache[key] = Future()
+            return future, owner
+
+    def release(self, key, future):
+        # Give up on a claimed key, so the next caller fetches it itself
+        with self.lock:
+            if self.cache.get(key) is future:
+                del self.cache[key]
+        future.cancel()
+
+    def cached(self, key, fetch):
+        future, owner = self.claim(key)
+        if owner:
+            try:
+                future.set_result(fetch())
+            except BaseException as e:
+                future.set_exception(e)
+        try:
+            return future.result()
+        except Exception:
+            if owner:
+                raise
+            # The prefetch gave up on this one, so fetch it here, where failures are reported properly
+            with self.lock:
+                if self.cache.get(key) is future:
+                    del self.cache[key]
+            return self.cached(key, fetch)
+
+    async def cachedAsync(self, key, fetch):
+        # Like cached(), for coroutines. fetch is a coroutine function.
+        future, owner = self.claim(key)
+        if not owner:
+            return await asyncio.wrap_future(future)
+        try:
+            value = await fetch()
+        except BaseException:
+            self.release(key, future)
+            raise
+        future.set_result(value)
+        return value
+
+    def scans(self):
+        def fetch():
+            r = get(host + "/data/experiments/%s/scans" % self.session, params={"format": "json"})
+            return r.json()["ResultSet"]["Result"]
+        return self.cached(('scans',), fetch)
+
+    def resourcesURL(self, scanid):
+        return host + "/data/experiments/%s/scans/%s/resources" % (self.session, scanid)
+
+    def resources(self, scanid):
+        def fetch():
+            r = get(self.resourcesURL(scanid), params={"format": "json"})
+            return r.json()["ResultSet"]["Result"]
+        return self.cached(('resources', scanid), fetch)
+
+    def filesURL(self, scanid, resource):
+        return host + "/data/experiments/%s/scans/%s/resources/%s/files" % (self.session, scanid, resource)
+
+    @staticmethod
+    def fileDict(result, uris=None):
+        # I don't like the results being in a list, so I will build a dict keyed off file name
+        if uris is not None:
+            # Older XNATs replace URI with absolutePath, so we have to ask for the URIs separately
+            for f in result:
+                f['URI'] = uris[f['Name']]
+        return OrderedDict((f['Name'], {'URI': host + f['URI'],
+                                        'absolutePath': f.get('absolutePath', ''),
+                                        'size': int(f['Size']) if f.get('Size') else None,
+                                        'digest': f.get('digest') or None})
+                           for f in result)
+
+    def files(self, scanid, resource):
+        # resource is either a resource label or an xnat_abstractresource_id
+        def fetch():
+            filesURL = self.filesURL(scanid, resource)
+            r = get(filesURL, params={"format": "json", "locator": "absolutePath"})
+            result = r.json()["ResultSet"]["Result"]
+            uris = None
+            if result and 'URI' not in result[0]:
+                r = get(filesURL, params={"format": "json"})
+                uris = {f['Name']: f['URI'] for f in r.json()["ResultSet"]["Result"]}
+            return self.fileDict(result, uris)
+        return self.cached(('files', scanid, resource), fetch)
+
+    def fingerprintURL(self, scanid):
+        return host + "/data/experiments/%s/scans/%s/resources/NIFTI/files/%s" % (self.session, scanid, FINGERPRINT_FILE)
+
+    @staticmethod
+    def parseFingerprint(r):
+        if r.status_code == 404:
+            return None
+        checkStatus(r)
+        try:
+            return r.json()
+        except ValueError:
+            return None
+
+    def fingerprint(self, scanid):
+        # The fingerprint stored with a scan's NIFTI resource, or None if there isn't one
+        def fetch():
+            return self.parseFingerprint(sess.get(self.fingerprintURL(scanid)))
+        return self.cached(('fingerprint', scanid), fetch)
+
+    async def prefetchScan(self, client, scanid, fingerprints=False, skipConverted=False):
+        # Fetch a scan's resource listing, then its DICOM file listing (and fingerprint) at the same time.
+        # With skipConverted, scans that already have a NIFTI resource will be skipped, so stop at the resources.
+        async def fetchResources():
+            r = checkStatus(await client.get(self.resourcesURL(scanid), params={"format": "json"}))
+            return r.json()["ResultSet"]["Result"]
+
+        async def fetchFiles():
+            filesURL = self.filesURL(scanid, "DICOM")
+            r = checkStatus(await client.get(filesURL, params={"format": "json", "locator": "absolutePath"}))
+            result = r.json()["ResultSet"]["Result"]
+            uris = None
+            if result and 'URI' not in result[0]:
+                r = checkStatus(await client.get(filesURL, params={"format": "json"}))
+                uris = {f['Name']: f['URI'] for f in r.json()["ResultSet"]["Result"]}
+            return self.fileDict(result, uris)
+
+        async def fetchFingerprint():
+            return self.parseFingerprint(await client.get(self.fingerprintURL(scanid)))
 
-        # decrement count
-        multiples[match] -= 1
+        try:
+            labels = [res["label"] for res in await self.cachedAsync(('resources', scanid), fetchResources)]
+            pending = []
+            if skipConverted and "NIFTI" in labels:
+                return
+            if "DICOM" in labels:
+                pending.append(self.cachedAsync(('files', scanid, "DICOM"), fetchFiles))
+            if fingerprints and "NIFTI" in labels:
+                pending.append(self.cachedAsync(('fingerprint', scanid), fetchFingerprint))
+            await asyncio.gather(*pending)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print('Could not prefetch metadata for scan %s (%s). It will be fetched when the scan is processed.' % (scanid, e))
+
+    def prefetch(self, scanIDs, concurrency=16, backend="auto", fingerprints=False, skipConverted=False):
+        """Start fetching resource and DICOM file listings for many scans at once. Returns the running MetadataPrefetch."""
+        return MetadataPrefetch(self, scanIDs, concurrency, backend, fingerprints, skipConverted).start()
+
+
+class MetadataCache(object):
+    """On-disk cache for small, slow-changing XNAT documents such as BIDS maps and project metadata.
+
+    Entries younger than ttl seconds are served without contacting XNAT. Older entries are
+    revalidated with a conditional GET (ETag / Last-Modified), so an unchanged document costs
+    a 304. Missing documents (404) are cached too. When the cache grows past maxBytes the
+    least recently used entries are evicted. With refresh=True, each entry is fetched again
+    the first time it is asked for in this run. If cacheDir can't be created the cache is off.
+    """
+    def __init__(self, cacheDir, ttl=0, maxBytes=67108864, refresh=False):
+        self.cacheDir = cacheDir
+        self.ttl = ttl
+        self.maxBytes = maxBytes
+        self.refresh = refresh
+        self.refreshed = set()
+        self.lock = threading.Lock()
+        if cacheDir and not os.path.isdir(cacheDir):
+            try:
+                os.makedirs(cacheDir)
+            except OSError as e:
+                print("Warning: cannot create metadata cache directory %s (%s). Not caching metadata." % (cacheDir, e))
+                self.cacheDir = None
+
+    def path(self, url, params):
+        key = json.dumps([sess.auth[0] if sess.auth else None, url, sorted((params or {}).items())], default=str)
+        return os.path.join(self.cacheDir, hashlib.sha1(key.encode('utf-8')).hexdigest() + ".json")
+
+    def fetch(self, url, params=None):
+        """Return (status code, body text) for a GET of url, from the cache when we can."""
+        if not self.cacheDir:
+            r = sess.get(url, params=params)
+            return r.status_code, r.text
+
+        path = self.path(url, params)
+        # Only the files are locked, so concurrent fetches of different documents don't wait for each other
+        with self.lock:
+            entry = None
+            try:
+                with open(path) as f:
+                    entry = json.load(f)
+            except (IOError, OSError, ValueError):
+                pass
+
+            forceRefresh = self.refresh and path not in self.refreshed
+            self.refreshed.add(path)
+            now = time.time()
+            if entry is not None and not forceRefresh and now - entry["fetched"] < self.ttl:
+                try:
+                    os.utime(path, None)
+                except OSError:
+                    pass
+                runMetrics.record("cache", 0, status="hit", url=url)
+                return entry["status"], entry["body"]
+
+        headers = {}
+        if entry is not None and entry["status"] == 200 and not forceRefresh:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("lastModified"):
+                headers["If-Modified-Since"] = entry["lastModified"]
+
+        r = sess.get(url, params=params, headers=headers)
+        if r.status_code == 304 and entry is not None:
+            print("Cached copy of %s is still current." % url)
+            entry["fetched"] = now
+        elif r.ok or r.status_code == 404:
+            entry = {"url": url, "status": r.status_code, "body": r.text, "fetched": now,
+                     "etag": r.headers.get("ETag"), "lastModified": r.headers.get("Last-Modified")}
+        else:
+            # Don't remember server errors
+            return r.status_code, r.text
+
+        with self.lock:
+            tempPath = "%s.%d.%d.tmp" % (path, os.getpid(), threading.current_thread().ident)
+            try:
+                with open(tempPath, "w") as f:
+                    json.dump(entry, f)
+                os.replace(tempPath, path)
+                self.evict()
+            except (IOError, OSError) as e:
+                print("Could not cache %s: %s" % (url, e))
+        return entry["status"], entry["body"]
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cacheDir):
+            if name.endswith(".json"):
+                try:
+                    st = os.stat(os.path.join(self.cacheDir, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(os.path.join(self.cacheDir, name))
+            except OSError:
+                pass
+            total -= size
+
+
+bidsmapLock = threading.Lock()
+bidsmapCache = {}
+bidsmatcherCache = {}
+
+
+def fetchBidsMap(url, description):
+    # Fetch a BIDS map once per run, through the on-disk cache. Returns an empty list if it can't be read.
+    # The lock only guards the cache of futures. The first caller for a url fetches it with the lock
+    # released, and later callers for the same url wait on its future.
+    with bidsmapLock:
+        future = bidsmapCache.get(url)
+        owner = future is None
+        if owner:
+            future = bidsmapCache[url] = Future()
+    if owner:
+        try:
+            # We don't use the convenience get() method because that throws exceptions when the object is not found.
+            status, body = metadataCache.fetch(url, params={"contents": True})
+            if status == 200:
+                bidsmap = json.loads(body)
+                print("BIDS bidsmaptoadd: ",  bidsmap)
+            else:
+                print("Could not read %s BIDS map" % description)
+                bidsmap = []
+            future.set_result(bidsmap)
+        except BaseException as e:
+            # Let the next caller try again
+            with bidsmapLock:
+                del bidsmapCache[url]
+            future.set_exception(e)
+    return future.result()
+
+
+class BidsNameMatcher(object):
+    """Maps series descriptions to BIDS names using the rules of one or more bidsmaps.
+
+    Each bidsmap entry has a "bidsname" and one of
+        "series_description"        exact match (case insensitive)
+        "series_description_glob"   shell-style pattern, e.g. "T1_MEMPRAGE*"
+        "series_description_regex"  regular expression that must match the whole description
+    and an optional integer "priority" (default 0). The highest priority rule that matches wins.
+    On equal priority an exact rule beats a glob, a glob beats a regex, and a later entry beats
+    an earlier one, so the site map still overrides the project map.
+    """
+    kinds = OrderedDict([("series_description", "exact"),
+                         ("series_description_glob", "glob"),
+                         ("series_description_regex", "regex")])
+
+    def __init__(self):
+        self.exact = {}
+        self.patterns = []
+        self.ordered = True
+        self.seen = set()
+        self.count = 0
+
+    def add(self, mapentry, source):
+        # Returns False if the entry is a duplicate or can't be used
+        key = json.dumps(mapentry, sort_keys=True)
+        if key in self.seen:
+            return False
+        self.seen.add(key)
+
+        if not isinstance(mapentry, dict) or "bidsname" not in mapentry:
+            return False
+        fields = [field for field in self.kinds if field in mapentry]
+        if len(fields) != 1:
+            print("Ignoring %s BIDS map entry %s: needs exactly one of %s" % (source, key, ", ".join(self.kinds)))
+            return False
+        field = fields[0]
+        kind = self.kinds[field]
+        pattern = mapentry[field]
+        if not isinstance(pattern, six.string_types):
+            print("Ignoring %s BIDS map entry %s: %s must be a string" % (source, key, field))
+            return False
+        try:
+            priority = int(mapentry.get("priority", 0))
+        except (TypeError, ValueError):
+            print("Ignoring %s BIDS map entry %s: priority must be an integer" % (source, key))
+            return False
+
+        self.count += 1
+        rule = {"source": source, "kind": kind, "pattern": pattern, "priority": priority,
+                "bidsname": mapentry["bidsname"], "order": self.count}
+        if kind == "exact":
+            # Rules come in order, so a later one wins unless the earlier one has a higher priority
+            previous = self.exact.get(pattern.lower())
+            if previous is None or priority >= previous["priority"]:
+                self.exact[pattern.lower()] = rule
+            return True
+
+        if kind == "glob":
+            regex = fnmatch.translate(pattern)
+        else:
+            regex = r"(?:%s)\Z" % pattern
+        try:
+            rule["compiled"] = re.compile(regex, re.IGNORECASE)
+        except re.error as e:
+            print("Ignoring %s BIDS map entry %s: %s" % (source, key, e))
+            return False
+        self.patterns.append(rule)
+        self.ordered = False
+        return True
+
+    def sort(self):
+        # Put the patterns in match order. Call this once all rules are added, before the matcher is shared.
+        self.patterns.sort(key=lambda r: (-r["priority"], r["kind"] != "glob", -r["order"]))
+        self.ordered = True
+
+    def match(self, seriesdesc):
+        """Return the rule that maps seriesdesc, or None."""
+        if not self.ordered:
+            self.sort()
+        rule = self.exact.get(seriesdesc.lower())
+        for candidate in self.patterns:
+            # Patterns are sorted by priority, and an exact rule wins a tie
+            if rule is not None and candidate["priority"] <= rule["priority"]:
+                break
+            if candidate["compiled"].match(seriesdesc):
+                return candidate
+        return rule
+
+    def __len__(self):
+        return len(self.exact) + len(self.patterns)
+
+
+def describeRule(rule):
+    return "%s %s rule '%s'%s" % (rule["source"], rule["kind"], rule["pattern"],
+                                 " (priority %d)" % rule["priority"] if rule["priority"] else "")
+
+
+def getBidsNameMap(project):
+    # Read bids map from input config. The compiled matcher is shared by all sessions in the project.
+    with bidsmapLock:
+        if project in bidsmatcherCache:
+            return bidsmatcherCache[project]
+
+    matcher = BidsNameMatcher()
+
+    print("Get project BIDS map if one exists")
+    for mapentry in fetchBidsMap(host + "/data/projects/%s/resources/config/files/bidsmap.json" % project, "project"):
+        matcher.add(mapentry, "project")
+
+    # Get site-level configs
+    print("Get Site BIDS map ")
+    for mapentry in fetchBidsMap(host + "/data/config/bids/bidsmap", "site-wide"):
+        matcher.add(mapentry, "site")
+    matcher.sort()
+
+    print("Compiled %d BIDS map rules (%d exact, %d patterns)" % (len(matcher), len(matcher.exact), len(matcher.patterns)))
+
+    with bidsmapLock:
+        return bidsmatcherCache.setdefault(project, matcher)
+
+
+class StagingManager(object):
+    """Hands out per-scan scratch directories on a memory-backed filesystem, such as /dev/shm, within a budget.
+
+    A scan is staged when twice the size of its DICOM files (room for the files and for dcm2niix's
+    output) fits in what is left of the budget. Otherwise it uses the disk directories. All scratch
+    space lives under one directory per process, which holds an flock on it for as long as it runs.
+    release() empties a scan's space as soon as its outputs are moved out, and close() removes the
+    rest. Directories nobody holds a lock on were left behind by a run that died, and are removed on
+    start. A lock still works when containers with their own PID namespaces share the filesystem.
+    """
+    prefix = 'dicom2bids-'
+
+    def __init__(self, stagingDir, budget):
+        self.root = None
+        self.lockFd = None
+        self.budget = 0
+        self.reserved = {}
+        self.lock = threading.Lock()
+        if not stagingDir or budget <= 0:
+            return
+        if not os.path.isdir(stagingDir) or not os.access(stagingDir, os.W_OK):
+            print('Cannot stage scans in %s. Using disk only.' % stagingDir)
+            return
+        self.removeStale(stagingDir)
+        st = os.statvfs(stagingDir)
+        # Leave some room for everyone else using it
+        self.budget = min(budget, int(st.f_bavail * st.f_frsize * 0.9))
+        # Lock the directory before it gets a name removeStale() looks at
+        path = tempfile.mkdtemp(prefix='.' + self.prefix, dir=stagingDir)
+        self.lockFd = os.open(path, os.O_RDONLY)
+        fcntl.flock(self.lockFd, fcntl.LOCK_EX)
+        self.root = os.path.join(stagingDir, os.path.basename(path)[1:])
+        os.rename(path, self.root)
+        print('Staging scans of up to %.1f MB in %s.' % (self.budget / 1048576.0, self.root))
+
+    def removeStale(self, stagingDir):
+        for name in os.listdir(stagingDir):
+            if not name.startswith(self.prefix):
+                continue
+            path = os.path.join(stagingDir, name)
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                # A live run holds it
+                continue
+            else:
+                print('Removing %s, left by an earlier run.' % path)
+                shutil.rmtree(path, ignore_errors=True)
+            finally:
+                os.close(fd)
+
+    def acquire(self, key, nbytes):
+        # A new scratch directory for key if nbytes fit in the budget, otherwise None
+        if self.root is None or nbytes is None:
+            return None
+        with self.lock:
+            if key in self.reserved:
+                return self.reserved[key][0]
+            if nbytes + sum(size for _, size in self.reserved.values()) > self.budget:
+                return None
+            path = tempfile.mkdtemp(dir=self.root)
+            self.reserved[key] = (path, nbytes)
+            return path
+
+    def release(self, key):
+        with self.lock:
+            path, _ = self.reserved.pop(key, (None, 0))
+        if path:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def close(self):
+        if self.root:
+            shutil.rmtree(self.root, ignore_errors=True)
+            self.root = None
+        if self.lockFd is not None:
+            os.close(self.lockFd)
+            self.lockFd = None
+
+
+class DedupStore(object):
+    """Content-addressed store of DICOM files and converter outputs shared by every run on this node.
+
+    blobs/ holds DICOM files under the digest from the XNAT listing. They are linked into a scan's
+    DICOM directory before anything is downloaded, and files downloaded over HTTP are added.
+    outputs/ holds dcm2niix's raw outputs under the scan's fingerprint source (the digests and
+    names of its DICOM files plus the converter command) and the converter's version, so a
+    byte-identical series in another session is not downloaded or converted again.
+    Using an entry touches it. The store is measured and trimmed when it is opened, and after that
+    only counted as this process adds to it. Once it is bigger than maxBytes, the least recently
+    used entries are removed. Other processes may share the store and remove entries at any time.
+    """
+    def __init__(self, storeDir, maxBytes):
+        self.storeDir = storeDir
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.size = None
+        for sub in ('blobs', 'outputs'):
+            if not os.path.isdir(os.path.join(storeDir, sub)):
+                os.makedirs(os.path.join(storeDir, sub))
+        self.evict()
+
+    def blobPath(self, digest):
+        return os.path.join(self.storeDir, 'blobs', digest[:2], digest)
+
+    def outputsPath(self, key):
+        return os.path.join(self.storeDir, 'outputs', key)
+
+    def outputsKey(self, source):
+        # Outputs depend on the converter's version as well as its input and arguments
+        return hashlib.sha1(json.dumps([source, converterVersion()]).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def tempName(path):
+        return '%s.%d-%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+
+    def fetchBlobs(self, fileList, destDir):
+        # Link the files we already have into destDir. Returns how many there were.
+        start = time.time()
+        found = 0
+        nbytes = 0
+        for name, pathDict in fileList:
+            dest = os.path.join(destDir, name)
+            if not pathDict.get('digest') or os.path.lexists(dest):
+                continue
+            path = self.blobPath(pathDict['digest'])
+            try:
+                linkFile(path, dest, 'auto', autoSymlink=False)
+                os.utime(path)
+            except (IOError, OSError):
+                continue
+            found += 1
+            nbytes += pathDict.get('size') or 0
+        if found:
+            runMetrics.record("dedup", time.time() - start, status="hit", bytes=nbytes, store="blobs", files=found)
+        return found
+
+    def addBlobs(self, fileList, dirPath):
+        # Add the downloaded files in dirPath. Links into the archive are left out.
+        added = 0
+        for name, pathDict in fileList:
+            src = os.path.join(dirPath, name)
+            if not pathDict.get('digest') or os.path.islink(src) or not os.path.isfile(src):
+                continue
+            path = self.blobPath(pathDict['digest'])
+            if os.path.exists(path):
+                continue
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    pass
+            try:
+                linkFile(src, self.tempName(path), 'auto', autoSymlink=False)
+                os.rename(self.tempName(path), path)
+                added += os.path.getsize(path)
+            except (IOError, OSError) as e:
+                print('Could not add %s to the dedup store: %s' % (name, e))
+        self.trim(added)
+
+    def fetchOutputs(self, key, bidsname, dirsByLabel):
+        """Link the stored outputs for key into {label: directory}, renamed from the bidsname they were made with.
+
+        Returns {label: [file names]}, or None if there are no outputs for key (or they were evicted part way).
+        """
+        start = time.time()
+        path = self.outputsPath(key)
+        names = {}
+        nbytes = 0
+        try:
+            with open(os.path.join(path, 'entry.json')) as f:
+                entry = json.load(f)
+            os.utime(os.path.join(path, 'entry.json'))
+            for label, destDir in dirsByLabel.items():
+                names[label] = []
+                for name in sorted(os.listdir(os.path.join(path, label))):
+                    newName = bidsname + name[len(entry['bidsname']):] if name.startswith(entry['bidsname']) else name
+                    nbytes += os.path.getsize(os.path.join(path, label, name))
+                    linkFile(os.path.join(path, label, name), os.path.join(destDir, newName), 'auto', autoSymlink=False)
+                    names[label].append(newName)
+        except (IOError, OSError, ValueError, KeyError):
+            for label, destDir in dirsByLabel.items():
+                for name in names.get(label, []):
+                    if os.path.lexists(os.path.join(destDir, name)):
+                        os.remove(os.path.join(destDir, name))
+            return None
+        runMetrics.record("dedup", time.time() - start, status="hit", bytes=nbytes, store="outputs", files=sum(len(n) for n in names.values()))
+        return names
+
+    def addOutputs(self, key, bidsname, filesByLabel):
+        # Store {label: (directory, [file names])} as the outputs for key
+        path = self.outputsPath(key)
+        if os.path.exists(path):
+            return
+        tmpPath = self.tempName(path)
+        added = 0
+        try:
+            for label, (dirPath, names) in filesByLabel.items():
+                os.makedirs(os.path.join(tmpPath, label))
+                for name in names:
+                    added += os.path.getsize(os.path.join(dirPath, name))
+                    linkFile(os.path.join(dirPath, name), os.path.join(tmpPath, label, name), 'auto', autoSymlink=False)
+            with open(os.path.join(tmpPath, 'entry.json'), 'w') as f:
+                json.dump({'bidsname': bidsname, 'labels': sorted(filesByLabel)}, f)
+            os.rename(tmpPath, path)
+        except (IOError, OSError) as e:
+            print('Could not add outputs to the dedup store: %s' % e)
+            shutil.rmtree(tmpPath, ignore_errors=True)
+            return
+        self.trim(added)
+
+    def trim(self, added):
+        # Count bytes this process added, and evict once the store is over maxBytes
+        with self.lock:
+            self.size += added
+            due = self.size > self.maxBytes
+        if due:
+            self.evict()
+
+    def evict(self):
+        # Measure the store and remove least recently used entries until it fits in maxBytes.
+        # Entries that another process removes or adds while we look are skipped.
+        with self.lock:
+            entries = []
+            blobsDir = os.path.join(self.storeDir, 'blobs')
+            for prefix in os.listdir(blobsDir):
+                try:
+                    names = os.listdir(os.path.join(blobsDir, prefix))
+                except OSError:
+                    continue
+                for name in names:
+                    if name.endswith('.tmp'):
+                        continue
+                    try:
+                        st = os.stat(os.path.join(blobsDir, prefix, name))
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, os.path.join(blobsDir, prefix, name)))
+            outputsDir = os.path.join(self.storeDir, 'outputs')
+            for name in os.listdir(outputsDir):
+                entryPath = os.path.join(outputsDir, name)
+                if name.endswith('.tmp'):
+                    continue
+                try:
+                    mtime = os.path.getmtime(os.path.join(entryPath, 'entry.json'))
+                    size = sum(os.path.getsize(os.path.join(dirPath, f)) for dirPath, _, fileNames in os.walk(entryPath) for f in fileNames)
+                except OSError:
+                    continue
+                entries.append((mtime, size, entryPath))
 
-        # rejoin as string
-        bidsname = "_".join(splitname)
-    else:
-        bidsname = match
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.maxBytes:
+                    break
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                total -= size
+            self.size = total
+
+
+class SessionContext(object):
+    # The session being converted and where its files go
+    def __init__(self, session, subject, project, dicomdir, niftidir):
+        self.session = session
+        self.subject = subject
+        self.project = project
+        self.dicomdir = dicomdir
+        self.niftidir = niftidir
+        self.imgdir = niftidir + "/IMG"
+        self.bidsdir = niftidir + "/BIDS"
+        self.catalog = SessionCatalog(session)
+
+
+class ScanJob(object):
+    # Everything the pipeline stages need to know about one scan
+    def __init__(self, ctx, scanid, seriesdesc, bidsname):
+        self.ctx = ctx
+        self.scanid = scanid
+        self.seriesdesc = seriesdesc
+        self.bidsname = bidsname
+        self.hasNifti = False
+        self.usingDicom = True
+        self.fileCount = 0
+        self.fingerprint = None
+        self.previous = None
+        self.outputs = {}
+        # Scratch directory from the StagingManager, if the scan is staged in memory
+        self.staged = None
+        # DedupStore key for the converter's outputs, if every DICOM file's digest is known
+        self.dedupKey = None
+        # {label: [file names]} linked from the DedupStore's outputs for an identical series
+        self.reused = None
+        self.scanDicomDir = os.path.join(ctx.dicomdir, scanid)
+        self.scanBidsDir = os.path.join(ctx.bidsdir, scanid)
+        self.scanImgDir = os.path.join(ctx.imgdir, scanid)
+        self.done = False
+
+
+def fetchScan(job):
+    # Check the scan's resources and download its DICOMs. Returns False if the scan should be skipped.
+    ctx = job.ctx
+    scanid = job.scanid
+    scanDicomDir = job.scanDicomDir
 
     # Get scan resources
     print("Get scan resources for scan %s." % scanid)
-    r = get(host + "/data/experiments/%s/scans/%s/resources" % (session, scanid), params={"format": "json"})
-    scanResources = r.json()["ResultSet"]["Result"]
+    scanResources = ctx.catalog.resources(scanid)
     print('Found resources %s.' % ', '.join(res["label"] for res in scanResources))
 
     ##########
     # Do initial checks to determine if scan should be skipped
     hasNifti = any([res["label"] == "NIFTI" for res in scanResources])  # Store this for later
-    if hasNifti and not overwrite:
+    if hasNifti and not overwrite and not incremental:
         print("Scan %s has a preexisting NIFTI resource, and I am running with overwrite=False. Skipping." % scanid)
-        continue
+        return False
 
     dicomResourceList = [res for res in scanResources if res["label"] == "DICOM"]
     imaResourceList = [res for res in scanResources if res["format"] == "IMA"]
@@ -284,19 +1906,19 @@ for scanid, seriesdesc in zip(reversed(scanIDList), reversed(seriesDescList)):
     if len(dicomResourceList) == 0 and len(imaResourceList) == 0:
         print("Scan %s has no DICOM or IMA resource." % scanid)
         # scanInfo['hasDicom'] = False
-        continue
+        return False
     elif len(dicomResourceList) == 0 and len(imaResourceList) > 1:
         print("Scan %s has more than one IMA resource and no DICOM resource. Skipping." % scanid)
         # scanInfo['hasDicom'] = False
-        continue
+        return False
     elif len(dicomResourceList) > 1 and len(imaResourceList) == 0:
         print("Scan %s has more than one DICOM resource and no IMA resource. Skipping." % scanid)
         # scanInfo['hasDicom'] = False
-        continue
+        return False
     elif len(dicomResourceList) > 1 and len(imaResourceList) > 1:
         print("Scan %s has more than one DICOM resource and more than one IMA resource. Skipping." % scanid)
         # scanInfo['hasDicom'] = False
-        continue
+        return False
 
     dicomResource = dicomResourceList[0] if len(dicomResourceList) > 0 else None
     imaResource = imaResourceList[0] if len(imaResourceList) > 0 else None
@@ -309,28 +1931,16 @@ for scanid, seriesdesc in zip(reversed(scanIDList), reversed(seriesDescList)):
             if imaResource["file_count"]:
                 if int(imaResource["file_count"]) == 0:
                     print("IMA resource for scan %s has no files either. Skipping." % scanid)
-                    continue
+                    return False
             else:
                 print("IMA resource for scan %s has a blank \"file_count\", so I cannot check it to see if there are no files. I am not skipping the scan, but this may lead to errors later if there are no files." % scanid)
     elif imaResource is not None and imaResource["file_count"]:
         if int(imaResource["file_count"]) == 0:
             print("IMA resource for scan %s has no files. Skipping." % scanid)
-            continue
+            return False
     else:
         print("DICOM and IMA resources for scan %s both have a blank \"file_count\", so I cannot check to see if there are no files. I am not skipping the scan, but this may lead to errors later if there are no files." % scanid)
 
-    ##########
-    # Prepare DICOM directory structure
-    print()
-    scanDicomDir = os.path.join(dicomdir, scanid)
-    if not os.path.isdir(scanDicomDir):
-        print('Making scan DICOM directory %s.' % scanDicomDir)
-        os.mkdir(scanDicomDir)
-    # Remove any existing files in the builddir.
-    # This is unlikely to happen in any environment other than testing.
-    for f in os.listdir(scanDicomDir):
-        os.remove(os.path.join(scanDicomDir, f))
-
     ##########
     # Get list of DICOMs/IMAs
 
@@ -340,8 +1950,7 @@ for scanid, seriesdesc in zip(reversed(scanIDList), reversed(seriesDescList)):
     if not usingDicom:
 
         print('Get IMA resource id for scan %s.' % scanid)
-        r = get(host + "/data/experiments/%s/scans/%s/resources" % (session, scanid), params={"format": "json"})
-        resourceDict = {resource['format']: resource['xnat_abstractresource_id'] for resource in r.json()["ResultSet"]["Result"]}
+        resourceDict = {resource['format']: resource['xnat_abstractresource_id'] for resource in scanResources}
 
         if resourceDict["IMA"]:
             resourceid = resourceDict["IMA"]
@@ -352,92 +1961,342 @@ for scanid, seriesdesc in zip(reversed(scanIDList), reversed(seriesDescList)):
     print('Get list of DICOM files for scan %s.' % scanid)
 
     if usingDicom:
-        filesURL = host + "/data/experiments/%s/scans/%s/resources/DICOM/files" % (session, scanid)
+        dicomFileDict = ctx.catalog.files(scanid, "DICOM")
     elif resourceid is not None:
-        filesURL = host + "/data/experiments/%s/scans/%s/resources/%s/files" % (session, scanid, resourceid)
+        dicomFileDict = ctx.catalog.files(scanid, resourceid)
     else:
         print("Trying to convert IMA files but there is no resource id available. Skipping.")
-        continue
+        return False
 
-    r = get(filesURL, params={"format": "json"})
-    # I don't like the results being in a list, so I will build a dict keyed off file name
-    dicomFileDict = {dicom['Name']: {'URI': host + dicom['URI']} for dicom in r.json()["ResultSet"]["Result"]}
+    job.hasNifti = hasNifti
+    job.usingDicom = usingDicom
+    job.fileCount = len(dicomFileDict)
+    job.fingerprint = scanFingerprint(dicomFileDict, converterCommand(usingDicom), "sub-" + ctx.subject + "_" + job.bidsname)
 
-    # Have to manually add absolutePath with a separate request
-    r = get(filesURL, params={"format": "json", "locator": "absolutePath"})
-    for dicom in r.json()["ResultSet"]["Result"]:
-        dicomFileDict[dicom['Name']]['absolutePath'] = dicom['absolutePath']
+    ##########
+    # Compare with the fingerprint of the previous conversion to see what needs redoing
+    if hasNifti and incremental and not overwrite:
+        previous = ctx.catalog.fingerprint(scanid)
+        if previous is None:
+            print("Scan %s has a NIFTI resource but no fingerprint. Reconverting." % scanid)
+        elif previous.get("source") != job.fingerprint["source"]:
+            print("DICOM files or converter arguments for scan %s have changed. Reconverting." % scanid)
+        elif previous.get("bidsname") == job.fingerprint["bidsname"]:
+            print("Scan %s is up to date. Skipping." % scanid)
+            return False
+        elif all(raw.startswith(previous["bidsname"]) for outputs in previous.get("outputs", {}).values() for raw in outputs.values()):
+            print("Scan %s only needs renaming from %s to %s." % (scanid, previous["bidsname"], job.fingerprint["bidsname"]))
+            job.previous = previous
+            for label, dirPath in (("NIFTI", job.scanImgDir), ("BIDS", job.scanBidsDir)):
+                prepareDirectory(dirPath)
+                fileList = [(name, pathDict) for name, pathDict in ctx.catalog.files(scanid, label).items() if name != FINGERPRINT_FILE]
+                # Copy rather than link, since the old resources are deleted before the upload
+                downloadFiles(fileList, dirPath, workers=downloadWorkers, retries=downloadRetries,
+                              label='scan %s %s' % (scanid, label), link=False)
+            return True
+        else:
+            print("Cannot tell how outputs of scan %s were named. Reconverting." % scanid)
 
     ##########
-    # Download DICOMs
-    print("Downloading files for scan %s." % scanid)
-    os.chdir(scanDicomDir)
+    # An identical series may already have been converted on this node
+    if dedupStore and usingDicom and all(info.get('digest') for info in dicomFileDict.values()):
+        job.dedupKey = dedupStore.outputsKey(job.fingerprint["source"])
+        prepareDirectory(job.scanImgDir)
+        prepareDirectory(job.scanBidsDir)
+        job.reused = dedupStore.fetchOutputs(job.dedupKey, job.fingerprint["bidsname"],
+                                             {"NIFTI": job.scanImgDir, "BIDS": job.scanBidsDir})
+        if job.reused:
+            print("Scan %s is identical to a series already converted here. Reusing its outputs." % scanid)
+            return True
 
+    ##########
     # Check secondary
-    # Download any one DICOM from the series and check its headers
-    # If the headers indicate it is a secondary capture, we will skip this series.
+    # Read the headers of any one DICOM from the series, without its pixel data.
+    # If the headers indicate it is a secondary capture, we will skip this series before downloading anything else.
     dicomFileList = list(dicomFileDict.items())
 
-    (name, pathDict) = dicomFileList[0]
-    download(name, pathDict)
-
     if usingDicom:
+        (name, pathDict) = dicomFileList[0]
         print('Checking modality in DICOM headers of file %s.' % name)
-        d = pydicom.dcmread(name)
+        try:
+            d = readDicomHeader(pathDict)
+        except (requests.ConnectionError, requests.exceptions.RequestException) as e:
+            print("Request Failed")
+            print("    " + str(e))
+            sys.exit(1)
         modalityHeader = d.get((0x0008, 0x0060), None)
         if modalityHeader:
             print('Modality header: %s' % modalityHeader)
             modality = modalityHeader.value.strip("'").strip('"')
             if modality == 'SC' or modality == 'SR':
                 print('Scan %s is a secondary capture. Skipping.' % scanid)
-                continue
+                return False
         else:
             print('Could not read modality from DICOM headers. Skipping.')
-            continue
+            return False
 
     ##########
-    # Download remaining DICOMs
-    for name, pathDict in dicomFileList[1:]:
-        download(name, pathDict)
+    # Prepare DICOM directory structure, in memory if the scan fits.
+    # A disk directory with files from an interrupted run is kept, so they can be reused.
+    print()
+    sizes = [info['size'] for info in dicomFileDict.values()]
+    if usingDicom and None not in sizes and not (os.path.isdir(scanDicomDir) and os.listdir(scanDicomDir)):
+        job.staged = staging.acquire(job, 2 * sum(sizes))
+    if job.staged:
+        scanDicomDir = job.scanDicomDir = os.path.join(job.staged, 'DICOM')
+        print('Staging scan %s (%.1f MB of DICOM) in %s.' % (scanid, sum(sizes) / 1048576.0, job.staged))
+    if not os.path.isdir(scanDicomDir):
+        print('Making scan DICOM directory %s.' % scanDicomDir)
+        os.mkdir(scanDicomDir)
+
+    # Files left by an earlier, interrupted run are checked and reused by download().
+    # Anything that isn't in the listing (or a partial download of something in it) goes.
+    for f in os.listdir(scanDicomDir):
+        if f not in dicomFileDict and not (f.endswith('.part') and f[:-5] in dicomFileDict):
+            os.remove(os.path.join(scanDicomDir, f))
+
+    # Files this node already has don't need downloading. Links to a readable archive are cheaper still.
+    if dedupStore and not os.access(dicomFileList[0][1]['absolutePath'], os.R_OK):
+        found = dedupStore.fetchBlobs(dicomFileList, scanDicomDir)
+        if found:
+            print("Found %d of %d files for scan %s in the dedup store." % (found, len(dicomFileList), scanid))
+
+    ##########
+    # Download DICOMs
+    print("Downloading files for scan %s." % scanid)
+    if useZipDownload(dicomFileList, scanDicomDir):
+        dicomFileList = downloadZip(ctx.catalog.filesURL(scanid, "DICOM" if usingDicom else resourceid), dicomFileList,
+                                    scanDicomDir, retries=downloadRetries, label='scan %s' % scanid)
+        if dicomFileList:
+            print("Checking or fetching the other %d files for scan %s one at a time." % (len(dicomFileList), scanid))
+    downloadFiles(dicomFileList, scanDicomDir, workers=downloadWorkers, retries=downloadRetries,
+                  label='scan %s' % scanid)
+    if dedupStore:
+        dedupStore.addBlobs(list(dicomFileDict.items()), scanDicomDir)
 
-    os.chdir(builddir)
     print('Done downloading for scan %s.' % scanid)
     print()
 
-    ##########
-    # Prepare NIFTI directory structure
-    scanBidsDir = os.path.join(bidsdir, scanid)
-    if not os.path.isdir(scanBidsDir):
-        print('Creating scan NIFTI BIDS directory %s.' % scanBidsDir)
-        os.mkdir(scanBidsDir)
+    return True
+
+
+def useZipDownload(fileList, destDir):
+    # Whether to fetch a scan's files as one zip archive rather than one request per file
+    if zipDownload == "never" or not fileList:
+        return False
+    if os.access(fileList[0][1]['absolutePath'], os.R_OK):
+        # We can link straight to the archive
+        return False
+    needed = sum(1 for name, _ in fileList if not os.path.isfile(os.path.join(destDir, name)))
+    return zipDownload == "always" or needed >= zipDownloadMinFiles
+
+
+# dcm2niix marks the outputs of later echoes with _e<n> (and phase images with _ph)
+ECHO_SUFFIX = re.compile(r'_e\d+(?=_|$)')
+# The part-<label> entity for dcm2niix's suffixes for parts of complex-valued images
+PART_SUFFIXES = {'_ph': 'phase', '_real': 'real', '_imaginary': 'imag'}
+
+
+def readSidecars(bidsDir, names):
+    # The JSON sidecars among names in bidsDir, as {name without .json: contents}
+    sidecars = {}
+    for name in names:
+        if name.endswith('.json'):
+            try:
+                with open(os.path.join(bidsDir, name)) as f:
+                    sidecars[name[:-len('.json')]] = json.load(f)
+            except ValueError:
+                print('Could not read sidecar %s.' % name)
+    return sidecars
+
+
+def withEcho(bidsname, echonumber):
+    # Insert echo-<n> where the run entity is, or else right before the data type
+    splitname = bidsname.split("_")
+    runstring = [s for s in splitname if s.startswith("run-")]
+    splitname.insert(splitname.index(runstring[0]) if runstring else len(splitname) - 1, "echo-%d" % echonumber)
+    return "_".join(splitname)
+
+
+def withPart(bidsname, part):
+    # Insert part-<label> right before the data type, which is where BIDS puts it after echo-<n>
+    splitname = bidsname.split("_")
+    splitname.insert(len(splitname) - 1, "part-%s" % part)
+    return "_".join(splitname)
+
+
+def planEchoRenames(bidsname, imgNames, bidsNames, sidecars):
+    """Work out how to rename converter outputs when a scan has more than one echo.
+
+    Every output (image, sidecar, bval, bvec) belongs to the echo in the sidecar with the same
+    stem: its EchoNumber, or the rank of its EchoTime when some sidecar has no EchoNumber. If
+    there are several echoes, the converter's echo suffix is replaced by an echo-<n> entity.
+    A phase (_ph), real or imaginary suffix becomes a part-<label> entity, and then the magnitude
+    images get part-mag, so they stay apart. Outputs with any other suffix keep their names.
+    Returns ({old: new} for the image directory, {old: new} for the BIDS directory).
+    """
+    stems = {name.split('.', 1)[0] for name in list(imgNames) + list(bidsNames)}
+    echoes = {stem: sidecars[stem] for stem in stems if stem.startswith(bidsname) and stem in sidecars}
+    if echoes and all(sidecar.get('EchoNumber') is not None for sidecar in echoes.values()):
+        keys = {stem: int(sidecar['EchoNumber']) for stem, sidecar in echoes.items()}
+    elif echoes and all(sidecar.get('EchoTime') is not None for sidecar in echoes.values()):
+        keys = {stem: float(sidecar['EchoTime']) for stem, sidecar in echoes.items()}
+    else:
+        keys = {}
+    echonumbers = {key: index for index, key in enumerate(sorted(set(keys.values())), 1)}
+
+    newStems = {}
+    if len(echonumbers) > 1:
+        leftovers = {}
+        for stem in keys:
+            leftover = ECHO_SUFFIX.sub('', stem[len(bidsname):])
+            if re.match('^[a-z]$', leftover):
+                # Older dcm2niix marked later echoes with a single letter
+                leftover = ''
+            leftovers[stem] = leftover
+        hasParts = any(leftover in PART_SUFFIXES for leftover in leftovers.values())
+        for stem, key in keys.items():
+            leftover = leftovers[stem]
+            if leftover and leftover not in PART_SUFFIXES:
+                print('Not renaming %s: %s has no place in a BIDS name.' % (stem, leftover))
+                continue
+            newStems[stem] = withEcho(bidsname, echonumbers[key])
+            if hasParts:
+                newStems[stem] = withPart(newStems[stem], PART_SUFFIXES.get(leftover, 'mag'))
+        if len(set(newStems.values())) < len(newStems):
+            print('Echoes of %s do not have distinct names. Keeping the converter\'s names.' % bidsname)
+            newStems = {}
+
+    def rename(name):
+        stem, dot, rest = name.partition('.')
+        return newStems.get(stem, stem) + dot + rest
+    return {name: rename(name) for name in imgNames}, {name: rename(name) for name in bidsNames}
+
+
+def applyRenames(dirPath, renames):
+    # Rename files in dirPath as one step. Every file moves to a temporary name first, so old and new
+    # names can't collide, and if any rename fails the ones already done are undone.
+    moves = [(old, new) for old, new in sorted(renames.items()) if old != new]
+    for old, new in moves:
+        if new not in renames and os.path.lexists(os.path.join(dirPath, new)):
+            raise OSError(errno.EEXIST, "Cannot rename %s to %s, which already exists" % (old, new))
+    done = []
+    try:
+        for old, new in moves:
+            os.rename(os.path.join(dirPath, old), os.path.join(dirPath, old + ".renaming"))
+            done.append((old + ".renaming", old))
+        for old, new in moves:
+            os.rename(os.path.join(dirPath, old + ".renaming"), os.path.join(dirPath, new))
+            done.append((new, old + ".renaming"))
+    except OSError:
+        for current, previous in reversed(done):
+            os.rename(os.path.join(dirPath, current), os.path.join(dirPath, previous))
+        raise
+    for old, new in moves:
+        print('Renamed %s to %s.' % (old, new))
+
+
+def converterCommand(usingDicom):
+    # The converter and the arguments that affect its output, without the per-scan paths
+    if usingDicom:
+        return "dcm2niix -b y -z y".split() + dcm2niixArgs
+    return "dcm2nii -b @PIPELINE_DIR_PATH@/catalog/DicomToBIDS/resources/dcm2nii.ini -g y -f Y -e N -p N -d N".split()
 
-    scanImgDir = os.path.join(imgdir, scanid)
-    if not os.path.isdir(scanImgDir):
-        print('Creating scan NIFTI image directory %s.' % scanImgDir)
-        os.mkdir(scanImgDir)
+
+@lru_cache(maxsize=None)
+def converterVersion():
+    # dcm2niix's version line, e.g. "v1.0.20211006". Empty if it can't be run.
+    try:
+        output = subprocess.run(["dcm2niix", "--version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout
+    except OSError:
+        return ""
+    lines = output.decode('utf-8', 'replace').split()
+    return lines[-1] if lines else ""
+
+
+def scanFingerprint(dicomFileDict, command, bidsname):
+    # Summarize everything that determines a scan's converted outputs
+    files = [[name, info.get('size'), info.get('digest')] for name, info in sorted(dicomFileDict.items())]
+    source = hashlib.sha1(json.dumps({"files": files, "converter": command}, sort_keys=True).encode('utf-8')).hexdigest()
+    return {"version": 1, "source": source, "fileCount": len(files), "converter": command, "bidsname": bidsname}
+
+
+def renameOutputs(job, bidsname):
+    # Give a scan's previously converted outputs a new BIDS name without running the converter again
+    previous = job.previous
+    oldBidsname = previous["bidsname"]
+    rawNames = {}
+    for label, outputs in previous["outputs"].items():
+        rawNames[label] = {final: bidsname + raw[len(oldBidsname):] for final, raw in outputs.items()}
+
+    # The sidecars are already here under their old final names
+    sidecars = {}
+    for final, sidecar in readSidecars(job.scanBidsDir, rawNames["BIDS"]).items():
+        sidecars[rawNames["BIDS"][final + '.json'][:-len('.json')]] = sidecar
+    imgRenames, bidsRenames = planEchoRenames(bidsname, list(rawNames["NIFTI"].values()), list(rawNames["BIDS"].values()), sidecars)
+    job.outputs = {}
+    for label, dirPath, renames in (("NIFTI", job.scanImgDir, imgRenames), ("BIDS", job.scanBidsDir, bidsRenames)):
+        applyRenames(dirPath, {final: renames[raw] for final, raw in rawNames[label].items()})
+        job.outputs[label] = {renames[raw]: raw for raw in rawNames[label].values()}
+
+
+def prepareDirectory(dirPath):
+    if not os.path.isdir(dirPath):
+        print('Creating directory %s.' % dirPath)
+        os.mkdir(dirPath)
 
     # Remove any existing files in the builddir.
     # This is unlikely to happen in any environment other than testing.
-    for f in os.listdir(scanBidsDir):
-        os.remove(os.path.join(scanBidsDir, f))
+    for f in os.listdir(dirPath):
+        os.remove(os.path.join(dirPath, f))
 
-    for f in os.listdir(scanImgDir):
-        os.remove(os.path.join(scanImgDir, f))
+
+def convertScan(job):
+    # Run the converter on a downloaded scan and sort its outputs into the image and BIDS directories.
+    ctx = job.ctx
+    scanid = job.scanid
+    seriesdesc = job.seriesdesc
+    usingDicom = job.usingDicom
+    scanDicomDir = job.scanDicomDir
+    scanBidsDir = job.scanBidsDir
+    scanImgDir = job.scanImgDir
 
     # Convert the differences
-    bidsname = base + bidsname
+    # BIDS subject name
+    base = "sub-" + ctx.subject + "_"
+    bidsname = base + job.bidsname
     print("Base " + base + " series " + seriesdesc + " match " + bidsname)
 
+    if job.previous is not None:
+        # The previous outputs were downloaded by fetchScan, and only their names need to change
+        renameOutputs(job, bidsname)
+        return True
+
+    if job.reused is not None:
+        # fetchScan linked in the outputs of an identical series, already under this scan's name
+        sortOutputs(job, bidsname, job.reused["NIFTI"], job.reused["BIDS"])
+        return True
+
+    ##########
+    # Prepare NIFTI directory structure
+    prepareDirectory(scanBidsDir)
+    prepareDirectory(scanImgDir)
+
     print('Converting scan %s to NIFTI...' % scanid)
     # Do some stuff to execute dcm2niix as a subprocess
 
+    # dcm2niix writes to scratch space in memory if the scan is staged
+    outDir = scanBidsDir
+    if job.staged:
+        outDir = os.path.join(job.staged, 'out')
+        os.mkdir(outDir)
+
     if usingDicom:
-        dcm2niix_command = "dcm2niix -b y -z y".split() + dcm2niixArgs + " -f {} -o {} {}".format(bidsname, scanBidsDir, scanDicomDir).split()
-        print("Executing command: " + " ".join(dcm2niix_command))
-        print(subprocess.check_output(dcm2niix_command))
+        dcm2niix_command = converterCommand(usingDicom) + " -f {} -o {} {}".format(bidsname, outDir, scanDicomDir).split()
+        converter.run('scan %s' % scanid, dcm2niix_command, job.fileCount)
     else:
         # call dcm2nii for converting ima files
-        print(subprocess.check_output("dcm2nii -b @PIPELINE_DIR_PATH@/catalog/DicomToBIDS/resources/dcm2nii.ini -g y -f Y -e N -p N -d N -o {} {}".format(scanBidsDir, scanDicomDir).split()))
+        converter.run('scan %s' % scanid, converterCommand(usingDicom) + "-o {} {}".format(scanBidsDir, scanDicomDir).split(), job.fileCount)
 
         #print subprocess.check_output("mv {}/*.nii.gz {}/{}.nii.gz".format(scanBidsDir, scanBidsDir, "bidsname").split())
 
@@ -446,7 +2305,7 @@ for scanid, seriesdesc in zip(reversed(scanIDList), reversed(seriesDescList)):
             os.rename(files, os.path.join(scanBidsDir, bidsname + ".nii.gz"))
 
         # Create BIDS sidecar file from IMA XML
-        imaSessionURL = host + "/data/archive/experiments/%s/scans/%s" % (session, scanid)
+        imaSessionURL = host + "/data/archive/experiments/%s/scans/%s" % (ctx.session, scanid)
         r = get(imaSessionURL, params={"format": "json"})
 
         # fields from ima json result
@@ -505,60 +2364,153 @@ for scanid, seriesdesc in zip(reversed(scanIDList), reversed(seriesDescList)):
 
     print('Done.')
 
-    # Move imaging to image directory
-    for f in os.listdir(scanBidsDir):
+    # Move imaging to image directory, and everything else to the BIDS directory if it isn't there already
+    imgNames = []
+    bidsNames = []
+    for f in os.listdir(outDir):
         if "nii" in f:
-            os.rename(os.path.join(scanBidsDir, f), os.path.join(scanImgDir, f))
-
-    # Check number of files in image directory, if more than one assume multiple echoes
-    numechoes = len(os.listdir(scanImgDir))  # multiple .nii.gz files will be generated by dcm2niix if there are multiple echoes
-    if numechoes > 1:
-        # Loop through set of folders (IMG and BIDS)
-        for dir in (scanImgDir, scanBidsDir):
-            # Get sorted list of files
-            multiple_echoes = sorted(os.listdir(dir))
-
-            # Divide length of file list by number of echoes to find out how many files in each echo
-            # (Multiband DWI would have BVEC, BVAL, and JSON in BIDS dir for each echo)
-            filesinecho = len(multiple_echoes) / numechoes
-
-            echonumber = 1
-            filenumber = 1
-
-            # Rename files
-            for echo in multiple_echoes:
-                splitname = echo.split("_")
-
-                # Locate run if present in BIDS name
-                runstring = [s for s in splitname if "run" in s]
-
-                if runstring != []:
-                    runindex = splitname.index(runstring[0])
-                    splitname.insert(runindex, "echo-" + str(echonumber))  # insert where run is (will displace run to later position)
-                else:
-                    splitname.insert(-1, "echo-" + str(echonumber))  # insert right before the data type
-
-                # Remove the "a" or other character from before the .nii.gz if not on the first echo
-                if (echonumber > 1):
-                    ending = splitname[-1].split(".")
-                    cleanedtype = ending[0][:-1]
-                    ending[0] = cleanedtype
-                    cleanedname = ".".join(ending)
-                    splitname[-1] = cleanedname
-
-                # Rejoin name
-                echoname = "_".join(splitname)
-
-                # Do file rename
-                os.rename(os.path.join(dir, echo), os.path.join(dir, echoname))
+            shutil.move(os.path.join(outDir, f), os.path.join(scanImgDir, f))
+            imgNames.append(f)
+        else:
+            if outDir != scanBidsDir:
+                shutil.move(os.path.join(outDir, f), os.path.join(scanBidsDir, f))
+            bidsNames.append(f)
+    # The DICOMs aren't needed any more either
+    staging.release(job)
+
+    # Keep the raw outputs for any identical series that comes along later
+    if job.dedupKey:
+        dedupStore.addOutputs(job.dedupKey, bidsname,
+                              {"NIFTI": (scanImgDir, imgNames), "BIDS": (scanBidsDir, bidsNames)})
+
+    sortOutputs(job, bidsname, imgNames, bidsNames)
+    return True
+
+
+def sortOutputs(job, bidsname, imgNames, bidsNames):
+    # Rename multiple echoes, and remember which converter output each final file came from
+    scanImgDir = job.scanImgDir
+    scanBidsDir = job.scanBidsDir
+    imgRenames, bidsRenames = planEchoRenames(bidsname, imgNames, bidsNames, readSidecars(scanBidsDir, bidsNames))
+    applyRenames(scanImgDir, imgRenames)
+    applyRenames(scanBidsDir, bidsRenames)
+    job.outputs = {"NIFTI": {new: old for old, new in imgRenames.items()},
+                   "BIDS": {new: old for old, new in bidsRenames.items()}}
+
+
+def runConcurrently(*functions):
+    # Call each function on its own thread and return their results in order. The first error is raised.
+    with ThreadPoolExecutor(max_workers=len(functions)) as pool:
+        futures = [pool.submit(runMetrics.bind(function)) for function in functions]
+    return [future.result() for future in futures]
+
+
+def uploadResource(ctx, scanid, resourceLabel, dirPath, queryArgs, byReference=False):
+    # Upload the contents of dirPath as a scan resource, by reference, as a streamed zip or as a zip file
+    queryArgs = dict(queryArgs)
+    if workflowId is not None:
+        queryArgs["event_id"] = workflowId
+    resourceURL = host + "/data/experiments/%s/scans/%s/resources/%s/files" % (ctx.session, scanid, resourceLabel)
+    if byReference:
+        queryArgs["reference"] = os.path.abspath(dirPath)
+        r = sess.put(resourceURL, params=queryArgs)
+    elif zipUpload == 'stream':
+        queryArgs["extract"] = True
+        queryArgs["inbody"] = True
+        zipStream = ZipStream(os.path.abspath(dirPath), includeDirInZip=False, compressThreads=zipThreads)
+        r = sess.put(resourceURL + "/%s_%s.zip" % (scanid, resourceLabel), params=queryArgs, data=iter(zipStream),
+                     headers={"Content-Type": "application/zip"})
+    else:
+        queryArgs["extract"] = True
+        (t, tempFilePath) = tempfile.mkstemp(suffix='.zip')
+        os.close(t)
+        zipdir(dirPath=os.path.abspath(dirPath), zipFilePath=tempFilePath, includeDirInZip=False, compressThreads=zipThreads)
+        with open(tempFilePath, 'rb') as f:
+            r = sess.put(resourceURL, params=queryArgs, files={'file': f})
+        os.remove(tempFilePath)
+    r.raise_for_status()
 
-                # When file count rolls over increment echo and continue
-                if filenumber == filesinecho:
-                    echonumber += 1
-                    filenumber = 1  # restart count for new echo
 
-                # Increment file count each time one is renamed
-                filenumber += 1
+class UploadPlanner(object):
+    """Decides whether scan resources are uploaded by reference or as zips.
+
+    mode is 'ref', 'zip' or 'auto'. In auto mode the first upload is the probe. It goes by reference,
+    and the files XNAT then lists for the resource are compared with the local ones. If they match,
+    XNAT can read our output directory, and every later upload also goes by reference. If not, the
+    probe's resource is deleted and uploaded again as a zip, and so is everything after it. A probe
+    that fails outright also counts as a no, so the round trips are paid once per run, not per scan.
+    Uploads that start while the probe is running wait for its answer.
+    """
+    def __init__(self, mode):
+        self.mode = mode
+        self.byReference = {'ref': True, 'zip': False}.get(mode)
+        self.probing = False
+        self.condition = threading.Condition()
+
+    def upload(self, ctx, scanid, resourceLabel, dirPath, queryArgs):
+        with self.condition:
+            while self.byReference is None and self.probing:
+                self.condition.wait()
+            probe = self.byReference is None
+            self.probing = probe
+        if not probe:
+            return uploadResource(ctx, scanid, resourceLabel, dirPath, queryArgs, byReference=self.byReference)
+
+        byReference = False
+        try:
+            byReference = self.probe(ctx, scanid, resourceLabel, dirPath, queryArgs)
+        finally:
+            with self.condition:
+                self.byReference = byReference
+                self.probing = False
+                self.condition.notify_all()
+        if not byReference:
+            uploadResource(ctx, scanid, resourceLabel, dirPath, queryArgs)
+
+    def probe(self, ctx, scanid, resourceLabel, dirPath, queryArgs):
+        # Upload dirPath by reference. Returns True if XNAT ended up with the same files, otherwise removes the resource and returns False.
+        resourceURL = host + "/data/experiments/%s/scans/%s/resources/%s" % (ctx.session, scanid, resourceLabel)
+        try:
+            uploadResource(ctx, scanid, resourceLabel, dirPath, queryArgs, byReference=True)
+            problem = self.compare(resourceURL + "/files", dirPath)
+        except requests.exceptions.HTTPError as e:
+            problem = str(e)
+        if problem is None:
+            print("XNAT can read %s. Uploading by reference." % os.path.abspath(dirPath))
+            return True
+
+        print("XNAT could not upload %s by reference: %s. Uploading zips instead." % (os.path.abspath(dirPath), problem))
+        params = {"event_id": workflowId} if workflowId is not None else {}
+        r = sess.delete(resourceURL, params=params)
+        if r.status_code != 404:
+            r.raise_for_status()
+        return False
+
+    @staticmethod
+    def compare(filesURL, dirPath):
+        # Returns None if XNAT lists the same file names and sizes as dirPath holds, otherwise what differs
+        r = sess.get(filesURL, params={"format": "json"})
+        if r.status_code == 404:
+            return "XNAT has no files for the resource"
+        r.raise_for_status()
+        remote = {row["Name"]: int(row["Size"]) for row in r.json()["ResultSet"]["Result"] if row.get("Size") not in (None, "")}
+        local = {name: os.path.getsize(os.path.join(dirPath, name)) for name in os.listdir(dirPath)
+                 if os.path.isfile(os.path.join(dirPath, name))}
+        if remote == local:
+            return None
+        missing = sorted(name for name in local if remote.get(name) != local[name])
+        return "XNAT lists %d of %d files correctly%s" % (len(local) - len(missing), len(local),
+                                                         " (e.g. not %s)" % missing[0] if missing else "")
+
+
+def uploadScan(job):
+    # Replace the scan's NIFTI and BIDS resources with the converted files, then clean up its DICOMs.
+    ctx = job.ctx
+    scanid = job.scanid
+    hasNifti = job.hasNifti
+    scanDicomDir = job.scanDicomDir
+    scanBidsDir = job.scanBidsDir
+    scanImgDir = job.scanImgDir
 
     ##########
     # Upload results
@@ -574,164 +2526,466 @@ for scanid, seriesdesc in zip(reversed(scanIDList), reversed(seriesDescList)):
             queryArgs = {}
             if workflowId is not None:
                 queryArgs["event_id"] = workflowId
-            r = sess.delete(host + "/data/experiments/%s/scans/%s/resources/NIFTI" % (session, scanid), params=queryArgs)
-            r.raise_for_status()
-
-            r = sess.delete(host + "/data/experiments/%s/scans/%s/resources/BIDS" % (session, scanid), params=queryArgs)
-            r.raise_for_status()
+            for r in runConcurrently(
+                    lambda: sess.delete(host + "/data/experiments/%s/scans/%s/resources/NIFTI" % (ctx.session, scanid), params=queryArgs),
+                    lambda: sess.delete(host + "/data/experiments/%s/scans/%s/resources/BIDS" % (ctx.session, scanid), params=queryArgs)):
+                r.raise_for_status()
         except (requests.ConnectionError, requests.exceptions.RequestException) as e:
             print("There was a problem deleting")
             print("    " + str(e))
             print("Skipping upload for scan %s." % scanid)
-            continue
+            return False
+
+    # Record what these outputs were made from, so later runs can tell whether they are stale
+    job.fingerprint["outputs"] = job.outputs
+    with open(os.path.join(scanImgDir, FINGERPRINT_FILE), "w") as f:
+        json.dump(job.fingerprint, f, indent=4)
 
     # Uploading
     print('Uploading files for scan %s' % scanid)
-    queryArgs = {"format": "NIFTI", "content": "NIFTI_RAW", "tags": "BIDS"}
-    if workflowId is not None:
-        queryArgs["event_id"] = workflowId
-    if uploadByRef:
-        queryArgs["reference"] = os.path.abspath(scanImgDir)
-        r = sess.put(host + "/data/experiments/%s/scans/%s/resources/NIFTI/files" % (session, scanid), params=queryArgs)
-    else:
-        queryArgs["extract"] = True
-        (t, tempFilePath) = tempfile.mkstemp(suffix='.zip')
-        zipdir(dirPath=os.path.abspath(scanImgDir), zipFilePath=tempFilePath, includeDirInZip=False)
-        files = {'file': open(tempFilePath, 'rb')}
-        r = sess.put(host + "/data/experiments/%s/scans/%s/resources/NIFTI/files" % (session, scanid), params=queryArgs, files=files)
-        os.remove(tempFilePath)
-    r.raise_for_status()
-
-
-    queryArgs = {"format": "BIDS", "content": "BIDS", "tags": "BIDS"}
-    if workflowId is not None:
-        queryArgs["event_id"] = workflowId
-    if uploadByRef:
-        queryArgs["reference"] = os.path.abspath(scanBidsDir)
-        r = sess.put(host + "/data/experiments/%s/scans/%s/resources/BIDS/files" % (session, scanid), params=queryArgs)
-    else:
-        queryArgs["extract"] = True
-        (t, tempFilePath) = tempfile.mkstemp(suffix='.zip')
-        zipdir(dirPath=os.path.abspath(scanBidsDir), zipFilePath=tempFilePath, includeDirInZip=False)
-        files = {'file': open(tempFilePath, 'rb')}
-        r = sess.put(host + "/data/experiments/%s/scans/%s/resources/BIDS/files" % (session, scanid), params=queryArgs, files=files)
-        os.remove(tempFilePath)
-    r.raise_for_status()
+    runConcurrently(
+        lambda: uploadPlanner.upload(ctx, scanid, "NIFTI", scanImgDir, {"format": "NIFTI", "content": "NIFTI_RAW", "tags": "BIDS"}),
+        lambda: uploadPlanner.upload(ctx, scanid, "BIDS", scanBidsDir, {"format": "BIDS", "content": "BIDS", "tags": "BIDS"}))
 
     ##########
     # Clean up input directory
     print()
     print('Cleaning up %s directory.' % scanDicomDir)
-    for f in os.listdir(scanDicomDir):
-        os.remove(os.path.join(scanDicomDir, f))
-    os.rmdir(scanDicomDir)
+    if os.path.isdir(scanDicomDir):
+        for f in os.listdir(scanDicomDir):
+            os.remove(os.path.join(scanDicomDir, f))
+        os.rmdir(scanDicomDir)
 
     print()
-    print('All done with image conversion.')
+    print('Done with scan %s.' % scanid)
+
+    job.done = True
+    return True
+
+
+def convertSession(session, subject=None, project=None, dicomdir=None, niftidir=None):
+    # Convert every mapped scan in a session and upload the session-level BIDS metadata.
+    # Returns a summary of what was done.
+    start = time.time()
+    if project is None or subject is None:
+        # Get project ID and subject ID from session JSON
+        print("Get project and subject ID for session ID %s." % session)
+        r = get(host + "/data/experiments/%s" % session, params={"format": "json", "handler": "values", "columns": "project,subject_ID"})
+        sessionValuesJson = r.json()["ResultSet"]["Result"][0]
+        project = sessionValuesJson["project"] if project is None else project
+        subjectID = sessionValuesJson["subject_ID"]
+        print("Project: " + project)
+        print("Subject ID: " + subjectID)
+
+        if subject is None:
+            print()
+            print("Get subject label for subject ID %s." % subjectID)
+            r = get(host + "/data/subjects/%s" % subjectID, params={"format": "json", "handler": "values", "columns": "label"})
+            subject = r.json()["ResultSet"]["Result"][0]["label"]
+            print("Subject label: " + subject)
+
+    ctx = SessionContext(session, subject, project, dicomdir, niftidir)
+
+    # Set up working directory
+    if not os.access(dicomdir, os.R_OK):
+        print('Making DICOM directory %s' % dicomdir)
+        os.mkdir(dicomdir)
+    if not os.access(niftidir, os.R_OK):
+        print('Making NIFTI directory %s' % niftidir)
+        os.mkdir(niftidir)
+    if not os.access(ctx.imgdir, os.R_OK):
+        print('Making NIFTI image directory %s' % ctx.imgdir)
+        os.mkdir(ctx.imgdir)
+    if not os.access(ctx.bidsdir, os.R_OK):
+        print('Making NIFTI BIDS directory %s' % ctx.bidsdir)
+        os.mkdir(ctx.bidsdir)
+
+    # Get list of scan ids
+    print("Get scan list for session ID %s." % session)
+    scanRequestResultList = ctx.catalog.scans()
+    scanIDList = [scan['ID'] for scan in scanRequestResultList]
+    seriesDescList = [scan['series_description'] for scan in scanRequestResultList]  # { id: sd for (scan['ID'], scan['series_description']) in scanRequestResultList }
+    print('Found scans %s.' % ', '.join(scanIDList))
+    print('Series descriptions %s' % ', '.join(seriesDescList))
+
+    # Fall back on scan type if series description field is empty
+    if set(seriesDescList) == set(['']):
+        seriesDescList = [scan['type'] for scan in scanRequestResultList]
+        print('Fell back to scan types %s' % ', '.join(seriesDescList))
+
+    bidsmatcher = getBidsNameMap(project)
+
+    # Map all series descriptions to BIDS names (case insensitive), once per distinct description
+    matchedRules = {x: bidsmatcher.match(x) for x in set(seriesDescList)}
+    resolved = [matchedRules[x]["bidsname"] for x in seriesDescList if matchedRules[x] is not None]
+
+    # Count occurrences
+    bidscount = collections.Counter(resolved)
+
+    # Remove multiples
+    multiples = {seriesdesc: count for seriesdesc, count in six.viewitems(bidscount) if count > 1}
+
+    # Cheat and reverse scanid and seriesdesc lists so numbering is in the right order
+    scanJobs = []
+    for scanid, seriesdesc in zip(reversed(scanIDList), reversed(seriesDescList)):
+        print()
+        print('Beginning process for scan %s.' % scanid)
+
+        print('Assigning BIDS name for scan %s.' % scanid)
 
-##########
-# Generate session-level metadata files
-previouschanges = ""
+        rule = matchedRules[seriesdesc]
+        if rule is None:
+            print("Series " + seriesdesc + " not found in BIDSMAP")
+            # bidsname = "Z"
+            continue  # Exclude series from processing
+        else:
+            print("Series " + seriesdesc + " matched " + rule["bidsname"] + " by " + describeRule(rule))
+            match = rule["bidsname"]
 
-# Remove existing files if they are there
-print("Check for presence of session-level BIDS data")
-r = get(host + "/data/experiments/%s/resources" % session, params={"format": "json"})
-sessionResources = r.json()["ResultSet"]["Result"]
-print('Found resources %s.' % ', '.join(res["label"] for res in sessionResources))
+        # split before last _
+        splitname = match.split("_")
 
-# Do initial checks to determine if session-level BIDS metadata is present
-hasSessionBIDS = any([res["label"] == "BIDS" for res in sessionResources])
+        # Check for multiples
+        if match in multiples:
+            # insert run-0x
+            run = 'run-%02d' % multiples[match]
+            splitname.insert(len(splitname) - 1, run)
 
-if hasSessionBIDS:
-    print("Session has preexisting BIDS resource. Deleting previous BIDS metadata if present.")
+            # decrement count
+            multiples[match] -= 1
 
-    # Consider making CHANGES a real, living changelog
-    # r = get( host + "/data/experiments/%s/resources/BIDS/files/CHANGES"%(session) )
-    # previouschanges = r.text
-    # print previouschanges
+            # rejoin as string
+            bidsname = "_".join(splitname)
+        else:
+            bidsname = match
+
+        scanJobs.append(ScanJob(ctx, scanid, seriesdesc, bidsname))
+
+    print()
+    print('Fetching resources and file lists for %d scans in the background.' % len(scanJobs))
+    prefetch = ctx.catalog.prefetch([job.scanid for job in scanJobs], concurrency=metadataConcurrency, backend=httpBackend,
+                                    fingerprints=incremental and not overwrite, skipConverted=not (overwrite or incremental))
 
+    print('Processing %d scans with up to %d in flight.' % (len(scanJobs), maxParallelScans))
     try:
-        queryArgs = {}
-        if workflowId is not None:
-            queryArgs["event_id"] = workflowId
+        runPipeline(scanJobs, [('download', fetchScan, 1), ('convert', convertScan, conversionCores), ('upload', uploadScan, uploadWorkers)],
+                    maxParallelScans)
+    finally:
+        prefetch.cancel()
+        prefetch.join()
+        for job in scanJobs:
+            staging.release(job)
+    print()
+    print('All done with image conversion.')
 
-        r = sess.delete(host + "/data/experiments/%s/resources/BIDS" % session, params=queryArgs)
-        r.raise_for_status()
-        uploadSessionBids = True
-    except (requests.ConnectionError, requests.exceptions.RequestException) as e:
-        print("There was a problem deleting")
-        print("    " + str(e))
-        print("Skipping upload for session-level files.")
-        uploadSessionBids = False
+    ##########
+    # Generate session-level metadata files
+    previouschanges = ""
+
+    # Remove existing files if they are there
+    print("Check for presence of session-level BIDS data")
+    r = get(host + "/data/experiments/%s/resources" % session, params={"format": "json"})
+    sessionResources = r.json()["ResultSet"]["Result"]
+    print('Found resources %s.' % ', '.join(res["label"] for res in sessionResources))
+
+    # Do initial checks to determine if session-level BIDS metadata is present
+    hasSessionBIDS = any([res["label"] == "BIDS" for res in sessionResources])
+
+    if hasSessionBIDS:
+        print("Session has preexisting BIDS resource. Deleting previous BIDS metadata if present.")
+
+        # Consider making CHANGES a real, living changelog
+        # r = get( host + "/data/experiments/%s/resources/BIDS/files/CHANGES"%(session) )
+        # previouschanges = r.text
+        # print previouschanges
+
+        try:
+            queryArgs = {}
+            if workflowId is not None:
+                queryArgs["event_id"] = workflowId
+
+            r = sess.delete(host + "/data/experiments/%s/resources/BIDS" % session, params=queryArgs)
+            r.raise_for_status()
+            uploadSessionBids = True
+        except (requests.ConnectionError, requests.exceptions.RequestException) as e:
+            print("There was a problem deleting")
+            print("    " + str(e))
+            print("Skipping upload for session-level files.")
+            uploadSessionBids = False
 
-    print("Done")
-    print("")
+        print("Done")
+        print("")
 
-# Fetch metadata from project
-print("Fetching project {} metadata".format(project))
-rawprojectdata = get(host + "/data/projects/%s" % project, params={"format": "json"})
-projectdata = rawprojectdata.json()
-print("Got project metadata\n")
+    # Fetch metadata from project
+    print("Fetching project {} metadata".format(project))
+    status, body = metadataCache.fetch(host + "/data/projects/%s" % project, params={"format": "json"})
+    if status != 200:
+        print("Request Failed")
+        print("    Could not fetch metadata for project %s (HTTP %d)" % (project, status))
+        sys.exit(1)
+    projectdata = json.loads(body)
+    print("Got project metadata\n")
 
-# Build dataset description
-print("Constructing BIDS data")
-dataset_description = OrderedDict()
-dataset_description['Name'] = project
+    # Build dataset description
+    print("Constructing BIDS data")
+    dataset_description = OrderedDict()
+    dataset_description['Name'] = project
 
-dataset_description['BIDSVersion'] = BIDSVERSION
+    dataset_description['BIDSVersion'] = BIDSVERSION
 
-# License- to be added later on after discussion of sensible default options
-# dataset_description['License'] = None
+    # License- to be added later on after discussion of sensible default options
+    # dataset_description['License'] = None
 
-# Compile investigators and PI into names list
-invnames = []
-invfield = [x for x in projectdata["items"][0]["children"] if x["field"] == "investigators/investigator"]
-print(str(invfield))
+    # Compile investigators and PI into names list
+    invnames = []
+    invfield = [x for x in projectdata["items"][0]["children"] if x["field"] == "investigators/investigator"]
+    print(str(invfield))
 
-if invfield != []:
-    invs = invfield[0]["items"]
+    if invfield != []:
+        invs = invfield[0]["items"]
 
-    for i in invs:
-        invnames.append(" ".join([i["data_fields"]["firstname"], i["data_fields"]["lastname"]]))
+        for i in invs:
+            invnames.append(" ".join([i["data_fields"]["firstname"], i["data_fields"]["lastname"]]))
 
-pifield = [x for x in projectdata["items"][0]["children"] if x["field"] == "PI"]
+    pifield = [x for x in projectdata["items"][0]["children"] if x["field"] == "PI"]
 
-if pifield != []:
-    pi = pifield[0]["items"][0]["data_fields"]
-    piname = " ".join([pi["firstname"], pi["lastname"]])
+    if pifield != []:
+        pi = pifield[0]["items"][0]["data_fields"]
+        piname = " ".join([pi["firstname"], pi["lastname"]])
 
-    if piname in invnames:
-        invnames.remove(piname)
+        if piname in invnames:
+            invnames.remove(piname)
 
-    invnames.insert(0, piname + " (PI)")
+        invnames.insert(0, piname + " (PI)")
 
-if invnames != []:
-    dataset_description['Authors'] = invnames
+    if invnames != []:
+        dataset_description['Authors'] = invnames
 
-# Other metadata - to be added later on
-# dataset_description['Acknowledgments'] = None
-# dataset_description['HowToAcknowledge'] = None
-# dataset_description['Funding'] = None
-# dataset_description['ReferencesAndLinks'] = None
+    # Other metadata - to be added later on
+    # dataset_description['Acknowledgments'] = None
+    # dataset_description['HowToAcknowledge'] = None
+    # dataset_description['Funding'] = None
+    # dataset_description['ReferencesAndLinks'] = None
 
-# Session identifier
-dataset_description['DatasetDOI'] = host + '/data/experiments/' + session
+    # Session identifier
+    dataset_description['DatasetDOI'] = host + '/data/experiments/' + session
 
-# Upload
-queryArgs = {"format": "BIDS", "content": "BIDS", "tags": "BIDS", "inbody": "true"}
-if workflowId is not None:
-    queryArgs["event_id"] = workflowId
+    # Upload
+    queryArgs = {"format": "BIDS", "content": "BIDS", "tags": "BIDS", "inbody": "true"}
+    if workflowId is not None:
+        queryArgs["event_id"] = workflowId
 
-r = sess.put(host + "/data/experiments/%s/resources/BIDS/files/dataset_description.json" % session, json=dataset_description, params=queryArgs)
-r.raise_for_status()
+    r = sess.put(host + "/data/experiments/%s/resources/BIDS/files/dataset_description.json" % session, json=dataset_description, params=queryArgs)
+    r.raise_for_status()
+
+    # Generate CHANGES
+    changes = "1.0 " + time.strftime("%Y-%m-%d") + "\n\n - Initial release."
 
-# Generate CHANGES
-changes = "1.0 " + time.strftime("%Y-%m-%d") + "\n\n - Initial release."
+    # Upload
+    h = {"content-type": "text/plain"}
+    r = sess.put(host + "/data/experiments/%s/resources/BIDS/files/CHANGES" % session, data=changes, params=queryArgs, headers=h)
+    r.raise_for_status()
 
-# Upload
-h = {"content-type": "text/plain"}
-r = sess.put(host + "/data/experiments/%s/resources/BIDS/files/CHANGES" % session, data=changes, params=queryArgs, headers=h)
-r.raise_for_status()
+    # All done
+    print('All done with session-level metadata.')
 
-# All done
-print('All done with session-level metadata.')
+    return {"session": session, "project": project, "subject": subject,
+            "scans": len(scanIDList), "mapped": len(scanJobs),
+            "matches": {job.scanid: describeRule(matchedRules[job.seriesdesc]) for job in scanJobs},
+            "converted": sum(1 for job in scanJobs if job.done),
+            "seconds": round(time.time() - start, 1)}
+
+
+def runSession(session, subject=None, project=None, dicomdir=None, niftidir=None):
+    # Convert a session with its events tagged, and write its run report even if it fails
+    try:
+        with runMetrics.scope(session=session):
+            result = convertSession(session, subject, project, dicomdir, niftidir)
+    finally:
+        events, summary = runMetrics.takeSession(session)
+        if runReport and os.path.isdir(niftidir):
+            reportPath = os.path.join(niftidir, RUN_REPORT_FILE)
+            RunMetrics.writeReport(reportPath, session, events, summary)
+            print("Wrote run report to %s." % reportPath)
+    result["operations"] = summary
+    return result
+
+
+def listBatchSessions(batchProject=None, batchSessions=None, batchQuery=None):
+    # Work out which sessions a batch run covers. Returns a list of (session, subject, project).
+    sessions = []
+    if batchSessions:
+        if batchSessions.startswith("@"):
+            with open(batchSessions[1:]) as f:
+                batchSessions = f.read()
+        sessions.extend((s, None, batchProject) for s in batchSessions.replace(",", " ").split())
+    if batchProject or batchQuery:
+        params = {"format": "json", "columns": "ID,label,project,subject_label,xsiType"}
+        if batchProject:
+            params["project"] = batchProject
+        if batchQuery:
+            params.update(parse_qsl(batchQuery))
+        if not batchQuery or "xsiType" not in batchQuery:
+            params["xsiType"] = "xnat:mrSessionData"
+        print("Get session list for %s." % ", ".join("%s=%s" % item for item in sorted(params.items()) if item[0] != "format"))
+        r = get(host + "/data/experiments", params=params)
+        listed = [(e["ID"], e.get("subject_label") or None, e.get("project") or None) for e in r.json()["ResultSet"]["Result"]]
+        if batchSessions:
+            # An explicit session list narrows down the project or query
+            wanted = {s for s, _, _ in sessions}
+            sessions = [e for e in listed if e[0] in wanted]
+        else:
+            sessions = listed
+    print("Found %d sessions to convert." % len(sessions))
+    return sessions
+
+
+def runBatch(sessions, dicomdir, niftidir, concurrency=1):
+    # Convert many sessions over one authenticated connection pool and one copy of each BIDS map.
+    # Each session gets its own subdirectory of dicomdir and niftidir.
+    start = time.time()
+    for path in (dicomdir, niftidir):
+        if not os.access(path, os.R_OK):
+            os.mkdir(path)
+
+    def convertOne(entry):
+        session, subject, project = entry
+        print()
+        print("########## Starting session %s ##########" % session)
+        sessionStart = time.time()
+        try:
+            result = runSession(session, subject, project,
+                                os.path.join(dicomdir, session), os.path.join(niftidir, session))
+            result["status"] = "ok"
+        except (Exception, SystemExit) as e:
+            print("Session %s failed: %r" % (session, e))
+            result = {"session": session, "project": project, "subject": subject, "status": "failed",
+                      "error": repr(e), "seconds": round(time.time() - sessionStart, 1)}
+        print("########## Finished session %s: %s ##########" % (session, result["status"]))
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        results = list(executor.map(convertOne, sessions))
+
+    report = {"sessions": results,
+              "succeeded": sum(1 for r in results if r["status"] == "ok"),
+              "failed": sum(1 for r in results if r["status"] != "ok"),
+              "scansConverted": sum(r.get("converted", 0) for r in results),
+              "seconds": round(time.time() - start, 1)}
+    print()
+    print("Batch done: %d sessions succeeded, %d failed, %d scans converted in %.1f s." %
+          (report["succeeded"], report["failed"], report["scansConverted"], report["seconds"]))
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run dcm2niix on every file in a session")
+    parser.add_argument("--host", default="https://cnda.wustl.edu", help="CNDA host", required=True)
+    parser.add_argument("--user", help="CNDA username", required=True)
+    parser.add_argument("--password", help="Password", required=True)
+    parser.add_argument("--session", help="Session ID", required=False)
+    parser.add_argument("--subject", help="Subject Label", required=False)
+    parser.add_argument("--project", help="Project", required=False)
+    parser.add_argument("--dicomdir", help="Root output directory for DICOM files", required=True)
+    parser.add_argument("--niftidir", help="Root output directory for NIFTI files", required=True)
+    parser.add_argument("--overwrite", help="Overwrite NIFTI files if they exist")
+    parser.add_argument("--incremental", help="Only reconvert scans whose DICOM files, BIDS name or dcm2niix arguments have changed since the last run")
+    parser.add_argument("--upload-by-ref", default="False", help="Upload \"by reference\" (True), as zips (False, the default), or auto: try by reference on the first upload and keep doing it if XNAT could read the files. Only use True if your host can read your file system")
+    parser.add_argument("--upload-workers", type=int, default=2, help="Number of scans that may be uploading at the same time")
+    parser.add_argument("--workflowId", help="Pipeline workflow ID")
+    parser.add_argument("--download-workers", type=int, default=8, help="Number of files to download concurrently for each scan")
+    parser.add_argument("--connect-timeout", type=float, default=30, help="Seconds to wait for a connection to XNAT")
+    parser.add_argument("--read-timeout", type=float, default=300, help="Seconds to wait for XNAT to send anything, on any request, before it counts as failed (and downloads are retried)")
+    parser.add_argument("--download-retries", type=int, default=3, help="Number of times to retry a failed file download")
+    parser.add_argument("--max-parallel-scans", type=int, help="Number of scans that may be downloading, converting or uploading at the same time. Defaults to enough to keep every conversion core and upload worker busy while the next scan downloads")
+    parser.add_argument("--metadata-concurrency", type=int, default=16, help="Number of resource and file listing requests to make at the same time")
+    parser.add_argument("--http-backend", choices=["auto", "httpx", "requests"], default="auto", help="Client for concurrent metadata requests. auto uses httpx (with HTTP/2 if h2 is installed) when it is available")
+    parser.add_argument("--link-mode", choices=["auto"] + LINK_MODES, default="auto", help="How to stage DICOMs that can be read straight from the archive. auto tries symlink, hardlink, reflink and copy once per filesystem and keeps the first that works")
+    parser.add_argument("--staging-dir", default="/dev/shm", help="Memory-backed directory for each scan's DICOMs and dcm2niix output while it converts. Empty to always use --dicomdir and --niftidir")
+    parser.add_argument("--staging-budget-mb", type=int, default=1024, help="Most memory, in MB, that staged scans may use at once. A scan needs twice the size of its DICOM files")
+    parser.add_argument("--dedup-dir", default="", help="Node-wide store of DICOM files and converter outputs, shared between sessions and runs, so identical series are fetched and converted once. Empty to turn it off")
+    parser.add_argument("--dedup-max-mb", type=int, default=10240, help="Size, in MB, that the --dedup-dir store is trimmed to, least recently used entries first")
+    parser.add_argument("--zip-download", choices=["auto", "always", "never"], default="auto", help="Fetch each scan's DICOMs as one zip archive instead of one request per file. auto does this when the archive isn't readable and at least --zip-download-min-files files are needed")
+    parser.add_argument("--zip-download-min-files", type=int, default=100, help="Smallest number of files to fetch as a zip archive in auto mode")
+    parser.add_argument("--zip-upload", choices=["stream", "file"], default="stream", help="Stream zipped resources straight into the upload request, or build a temporary zip file first")
+    parser.add_argument("--zip-threads", type=int, default=os.cpu_count(), help="Threads that compress each large uncompressed file (e.g. a .nii from dcm2niix -z n) in a zipped upload, pigz style")
+    parser.add_argument("--conversion-cores", type=int, default=os.cpu_count(), help="Number of CPU cores to share among concurrent dcm2niix processes")
+    parser.add_argument("--cache-dir", default=os.path.join(os.path.expanduser("~"), ".cache", "dicom2bids"), help="Directory for caching BIDS maps and project metadata between runs. Pass an empty string to disable")
+    parser.add_argument("--cache-ttl", type=int, default=0, help="Seconds before cached BIDS maps and project metadata are revalidated with XNAT. The default revalidates every time, which costs a 304 when nothing changed")
+    parser.add_argument("--cache-max-mb", type=int, default=64, help="Size limit of the metadata cache in MB")
+    parser.add_argument("--refresh-cache", help="Fetch BIDS maps and project metadata from XNAT again, ignoring the cache")
+    parser.add_argument("--batch-project", help="Convert every MR session in this project")
+    parser.add_argument("--batch-sessions", help="Comma- or space-separated session IDs to convert, or @file with one per line")
+    parser.add_argument("--batch-query", help="Extra query parameters for selecting sessions from /data/experiments, e.g. \"date=01/01/2020-12/31/2020\"")
+    parser.add_argument("--batch-concurrency", type=int, default=1, help="Number of sessions to convert at the same time in batch mode")
+    parser.add_argument("--batch-report", help="Where to write the batch summary report (default: <niftidir>/dicom2bids_batch_report.json)")
+    parser.add_argument("--run-report", help="Write a JSONL report of every request, download, conversion and zip to <niftidir>/%s" % RUN_REPORT_FILE)
+    parser.add_argument("--prometheus-textfile", help="Write run totals to this file in the Prometheus textfile collector format")
+    parser.add_argument('--version', action='version', version='%(prog)s 1')
+
+    args, unknown_args = parser.parse_known_args()
+    host = cleanServer(args.host)
+    session = args.session
+    subject = args.subject
+    project = args.project
+    overwrite = isTrue(args.overwrite)
+    incremental = isTrue(args.incremental)
+    dicomdir = args.dicomdir
+    niftidir = args.niftidir
+    workflowId = args.workflowId
+    uploadPlanner = UploadPlanner('auto' if args.upload_by_ref == 'auto' else 'ref' if isTrue(args.upload_by_ref) else 'zip')
+    uploadWorkers = args.upload_workers
+    downloadWorkers = max(1, args.download_workers)
+    downloadRetries = max(0, args.download_retries)
+    conversionCores = max(1, args.conversion_cores or 1)
+    # One scan downloading, one converting on each core and one uploading on each worker
+    maxParallelScans = max(1, args.max_parallel_scans or (1 + conversionCores + max(1, uploadWorkers)))
+    zipUpload = args.zip_upload
+    zipThreads = args.zip_threads
+    zipDownload = args.zip_download
+    linkMode = args.link_mode
+    metadataConcurrency = max(1, args.metadata_concurrency)
+    httpBackend = args.http_backend
+    zipDownloadMinFiles = max(1, args.zip_download_min_files)
+    batchConcurrency = max(1, args.batch_concurrency)
+    runReport = isTrue(args.run_report)
+    runMetrics.keepEvents = runReport
+    dcm2niixArgs = unknown_args if unknown_args is not None else []
+
+    if bool(args.session) == bool(args.batch_project or args.batch_sessions or args.batch_query):
+        parser.error("Give either --session, or one or more of --batch-project, --batch-sessions and --batch-query")
+
+    # Set up session
+    sess = InstrumentedSession()
+    sess.timeout = (args.connect_timeout, args.read_timeout)
+    sess.verify = False
+    sess.auth = (args.user, args.password)
+    # Size the connection pool to match the download workers and metadata prefetch so they don't queue for sockets
+    poolAdapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(10, downloadWorkers * batchConcurrency,
+                                                                                       metadataConcurrency * batchConcurrency))
+    sess.mount('https://', poolAdapter)
+    sess.mount('http://', poolAdapter)
+
+    converter = ConversionScheduler(conversionCores)
+    metadataCache = MetadataCache(args.cache_dir, ttl=args.cache_ttl, maxBytes=args.cache_max_mb * 1048576,
+                                  refresh=isTrue(args.refresh_cache))
+    staging = StagingManager(args.staging_dir, args.staging_budget_mb * 1048576)
+    dedupStore = DedupStore(args.dedup_dir, args.dedup_max_mb * 1048576) if args.dedup_dir else None
+
+    try:
+        if session:
+            runSession(session, subject, project, dicomdir, niftidir)
+        else:
+            batchSessions = listBatchSessions(args.batch_project, args.batch_sessions, args.batch_query)
+            report = runBatch(batchSessions, dicomdir, niftidir, batchConcurrency)
+            reportPath = args.batch_report or os.path.join(niftidir, "dicom2bids_batch_report.json")
+            with open(reportPath, "w") as f:
+                json.dump(report, f, indent=4)
+            print("Wrote batch report to %s." % reportPath)
+            if report["failed"]:
+                sys.exit(1)
+    finally:
+        staging.close()
+        if args.prometheus_textfile:
+            runMetrics.writePrometheus(args.prometheus_textfile, {"host": host})
+            print("Wrote metrics to %s." % args.prometheus_textfile)
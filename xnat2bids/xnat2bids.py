@@ -4,13 +4,30 @@
 Turn files in XNAT archive format into BIDS format.
 
 Usage:
-    xnat2bids.py <inputDir> <outputDir>
+    xnat2bids.py [--view=<view>] [--link-mode=<mode>] [--source-root=<dir>] [--manifest=<file>] [--jobs=<n>] <inputDir> <outputDir>
     xnat2bids.py (-h | --help)
     xnat2bids.py --version
 
 Options:
     -h --help           Show the usage
     --version           Show the version
+    --view=<view>       What to write to outputDir:
+                            files      a BIDS tree of real files, put there with --link-mode
+                            symlinks   a BIDS tree of symlinks into the input. Only as many writes as there are
+                                       files, but the app must see the input at --source-root
+                            manifest   only a manifest listing each BIDS path and the input file behind it
+                        [default: files]
+    --link-mode=<mode>  How to put files in the output: symlink, hardlink, reflink, copy or auto.
+                        auto uses a reflink (a copy-on-write clone) if the filesystems allow it,
+                        and otherwise a copy, so the output never shares data with the archive.
+                        hardlink and symlink must be asked for. With them, editing an output
+                        file in place (a sidecar fix-up, a validator rewrite) also changes the
+                        file in the XNAT archive. [default: auto]
+    --source-root=<dir> Where the app reading the output sees inputDir, for symlink targets and
+                        manifest sources. Defaults to inputDir itself.
+    --manifest=<file>   Also write the manifest to this file. With --view manifest it defaults to
+                        bids_manifest.json in outputDir.
+    --jobs=<n>          Number of sessions to search, and files to link or copy, at once. [default: 8]
     <inputDir>          Directory with XNAT-archive-formatted files.
                         There should be scan directories, each having a NIFTI resource with NIFTI files, and
                         BIDS resources with BIDS sidecar JSON files.
@@ -20,8 +37,12 @@ Options:
 import os
 import sys
 import json
+import errno
+import fcntl
 import shutil
-from glob import glob
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from docopt import docopt
 
 bidsAnatModalities = ['t1w', 't2w', 't1rho', 't1map', 't2map', 't2star', 'flair', 'flash', 'pd', 'pdmap', 'pdt2', 'inplanet1', 'inplanet2', 'angio', 'defacemask', 'swimagandphase']
@@ -30,12 +51,28 @@ bidsDwiModalities = ['dwi', 'dti']
 bidsBehavioralModalities = ['beh']
 bidsFieldmapModalities = ['phasemap', 'magnitude1']
 
+# ioctl that makes a file share another file's blocks (btrfs, XFS with reflink=1, ...)
+FICLONE = 0x40049409
+linkModes = ['symlink', 'hardlink', 'reflink', 'copy']
+# What auto mode tries, in order. Neither shares an inode with the archive.
+autoLinkModes = ['reflink', 'copy']
+MANIFEST_FILE = 'bids_manifest.json'
+# Files are put here, inside outputDir, once everything has been checked, and then moved into place all at once.
+STAGING_DIR = '.xnat2bids-staging'
+views = ['files', 'symlinks', 'manifest']
+
+# Strategy that worked for each (source filesystem, destination filesystem)
+linkProbes = {}
+linkProbeLock = threading.Lock()
+
 class BidsScan(object):
+    # A mounted project can have tens of thousands of scans, so these have no __dict__.
+    # bidsNameMap is shared by every scan with the same file name.
+    __slots__ = ('scanId', 'bidsNameMap', 'subDir', 'sourceFiles')
+
     def __init__(self, scanId, bidsNameMap, *args):
         self.scanId = scanId
         self.bidsNameMap = bidsNameMap
-        self.subject = bidsNameMap.get('sub')
-        self.modality = bidsNameMap.get('modality')
         modalityLowercase = self.modality.lower()
         self.subDir = 'anat' if modalityLowercase in bidsAnatModalities else \
                       'func' if modalityLowercase in bidsFuncModalities else \
@@ -43,14 +80,26 @@ class BidsScan(object):
                       'beh' if modalityLowercase in bidsBehavioralModalities else \
                       'fmap' if modalityLowercase in bidsFieldmapModalities else \
                       None
-        self.sourceFiles = list(args)
+        self.sourceFiles = args
+
+    @property
+    def subject(self):
+        return self.bidsNameMap.get('sub')
+
+    @property
+    def modality(self):
+        return self.bidsNameMap.get('modality')
 
 class BidsSession(object):
+    __slots__ = ('sessionLabel', 'bidsScans')
+
     def __init__(self, sessionLabel, bidsScans=[]):
         self.sessionLabel = sessionLabel
         self.bidsScans = bidsScans
 
 class BidsSubject(object):
+    __slots__ = ('subjectLabel', 'bidsSessions', 'bidsScans')
+
     def __init__(self, subjectLabel, bidsSession=None, bidsScans=[]):
         self.subjectLabel = subjectLabel
         if bidsSession:
@@ -73,6 +122,8 @@ class BidsSubject(object):
     def hasScans(self):
         return bool(self.bidsScans is not None and self.bidsScans is not [])
 
+# Sessions of one subject share file names, so each name is parsed once. Callers must not modify the result.
+@lru_cache(maxsize=None)
 def generateBidsNameMap(bidsFileName):
 
     # The BIDS file names will look like
@@ -95,69 +146,84 @@ def generateBidsNameMap(bidsFileName):
 
     return bidsNameMap
 
-def bidsifySession(sessionDir):
-    print("Checking for session structure in " + sessionDir)
-
-    sessionBidsJsonPath = os.path.join(sessionDir, 'RESOURCES', 'BIDS', 'dataset_description.json')
+def indexScanDir(scanDir):
+    """Read the BIDS and NIFTI directories of a scan once each.
+
+    Returns the file names in BIDS without '.json' (sorted), and a map from every name a file
+    could be found by (everything before one of its dots) to the paths of those files, BIDS first.
+    So index['sub-01_T1w'] holds what glob('BIDS/sub-01_T1w.*') + glob('NIFTI/sub-01_T1w.*') did.
+    """
+    jsonStems = []
+    index = {}
+    for resource in ('BIDS', 'NIFTI'):
+        try:
+            entries = sorted(os.scandir(os.path.join(scanDir, resource)), key=lambda entry: entry.name)
+        except (IOError, OSError):
+            continue
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if resource == 'BIDS' and entry.name.endswith('.json'):
+                jsonStems.append(entry.name[:-len('.json')])
+            dot = entry.name.find('.')
+            while dot > 0:
+                index.setdefault(entry.name[:dot], []).append(entry.path)
+                dot = entry.name.find('.', dot + 1)
+    return jsonStems, index
+
+def iterSessionScans(sessionDir, log=print):
+    # Yields each BidsScan in sessionDir as soon as it is found.
+    # Sessions are searched in parallel, so messages go through log to keep each session's together
+    log("Checking for session structure in " + sessionDir)
 
     scansDir = os.path.join(sessionDir, 'SCANS')
     if not os.path.exists(scansDir):
         # I guess we don't have any scans with BIDS data in this session
-        print("STOPPING. Could not find SCANS directory.")
+        log("STOPPING. Could not find SCANS directory.")
         return
 
-    print("Found SCANS directory. Checking scans for BIDS data.")
+    log("Found SCANS directory. Checking scans for BIDS data.")
 
-    bidsScans = []
-    for scanId in os.listdir(scansDir):
-        print("")
-        print("Checking scan {}.".format(scanId))
+    for scanId in sorted(os.listdir(scansDir)):
+        log("")
+        log("Checking scan {}.".format(scanId))
 
         scanDir = os.path.join(scansDir, scanId)
         scanBidsDir = os.path.join(scanDir, 'BIDS')
-        scanNiftiDir = os.path.join(scanDir, 'NIFTI')
 
-        if not os.path.exists(scanBidsDir):
+        if not os.path.isdir(scanBidsDir):
             # This scan does not have BIDS data
-            print("SKIPPING. Scan {} does not have a BIDS directory.".format(scanId))
+            log("SKIPPING. Scan {} does not have a BIDS directory.".format(scanId))
             continue
 
-        scanBidsJsonGlobList = glob(scanBidsDir + '/*.json')
-        for scanBidsJsonFilePath in scanBidsJsonGlobList:
-        
-            # scanBidsJsonFilePath = scanBidsJsonGlobList[0]
-            scanBidsJsonFileName = os.path.basename(scanBidsJsonFilePath)
-            scanBidsFileName = scanBidsJsonFileName.rstrip('.json')
+        scanBidsFileNames, scanFileIndex = indexScanDir(scanDir)
+        for scanBidsFileName in scanBidsFileNames:
+            scanBidsJsonFileName = scanBidsFileName + '.json'
             scanBidsNameMap = generateBidsNameMap(scanBidsFileName)
 
-            print("BIDS JSON file name: {}".format(scanBidsJsonFileName))
-            print("Name map: {}".format(scanBidsNameMap))
+            log("BIDS JSON file name: {}".format(scanBidsJsonFileName))
+            log("Name map: {}".format(scanBidsNameMap))
 
             if not scanBidsNameMap.get('sub') or not scanBidsNameMap.get('modality'):
                 # Either 'sub' or 'modality' or both weren't found. Something is wrong. Let's find out what.
                 if not scanBidsNameMap.get('sub') and not scanBidsNameMap.get('modality'):
-                    print("SKIPPING. Neither 'sub' nor 'modality' could be parsed from the BIDS JSON file name.")
+                    log("SKIPPING. Neither 'sub' nor 'modality' could be parsed from the BIDS JSON file name.")
                 elif not scanBidsNameMap.get('sub'):
-                    print("SKIPPING. Could not parse 'sub' from the BIDS JSON file name.")
+                    log("SKIPPING. Could not parse 'sub' from the BIDS JSON file name.")
                 else:
-                    print("SKIPPING. Could not parse 'modality' from the BIDS JSON file name.")
+                    log("SKIPPING. Could not parse 'modality' from the BIDS JSON file name.")
                 continue
 
-            scanBidsDirFilePaths = glob(os.path.join(scanBidsDir, scanBidsFileName) + '.*')
-            scanNiftiDirFilePaths = glob(os.path.join(scanNiftiDir, scanBidsFileName) + '.*')
-            allFilePaths = scanBidsDirFilePaths + scanNiftiDirFilePaths
-
-            bidsScan = BidsScan(scanId, scanBidsNameMap, *allFilePaths)
+            bidsScan = BidsScan(scanId, scanBidsNameMap, *scanFileIndex[scanBidsFileName])
             if not bidsScan.subDir:
-                print("SKIPPING. Could not determine subdirectory for modality {}.".format(bidsScan.modality))
+                log("SKIPPING. Could not determine subdirectory for modality {}.".format(bidsScan.modality))
                 continue
 
-            bidsScans.append(bidsScan)
-            print("Done checking scan {}.".format(scanId))
+            log("Done checking scan {}.".format(scanId))
+            yield bidsScan
 
-    print("")
-    print("Done checking all scans.")
-    return bidsScans
+    log("")
+    log("Done checking all scans.")
 
 def getSubjectForBidsScans(bidsScanList):
     print("")
@@ -174,28 +240,121 @@ def getSubjectForBidsScans(bidsScanList):
 
     return None
 
-def copyScanBidsFiles(destDirBase, bidsScanList):
-    # First make all the "anat", "func", etc. subdirectories that we will need
-    for subDir in {scan.subDir for scan in bidsScanList}:
-        os.mkdir(os.path.join(destDirBase, subDir))
+def reflinkFile(src, dst):
+    # Clone src's blocks into dst, or failing that let the kernel copy them
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except (IOError, OSError):
+            if not hasattr(os, 'copy_file_range'):
+                raise
+        remaining = os.fstat(fsrc.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+            if copied == 0:
+                raise OSError(errno.EIO, "copy_file_range stopped short on {}".format(src))
+            remaining -= copied
+
+linkers = {'symlink': lambda src, dst: os.symlink(os.path.abspath(src), dst),
+           'hardlink': os.link,
+           'reflink': reflinkFile,
+           'copy': shutil.copy}
+
+def linkFile(src, dst, mode='auto'):
+    # Put src at dst with the given strategy, falling back to a copy.
+    # In auto mode, try a reflink and then a copy on the first file between two filesystems and remember what worked.
+    if mode == 'auto':
+        key = (os.stat(src).st_dev, os.stat(os.path.dirname(os.path.abspath(dst))).st_dev)
+        with linkProbeLock:
+            known = linkProbes.get(key)
+        candidates = autoLinkModes[autoLinkModes.index(known or autoLinkModes[0]):]
+    else:
+        key = known = None
+        candidates = [mode, 'copy'] if mode != 'copy' else ['copy']
+
+    for candidate in candidates:
+        try:
+            linkers[candidate](src, dst)
+        except (IOError, OSError):
+            if os.path.lexists(dst):
+                os.remove(dst)
+            if candidate == candidates[-1]:
+                raise
+            continue
+        if key is not None and known is None:
+            with linkProbeLock:
+                if key not in linkProbes:
+                    linkProbes[key] = candidate
+                    print("Putting files from {} into {} with {}.".format(os.path.dirname(src), os.path.dirname(os.path.abspath(dst)), candidate))
+        return candidate
+
+def planScanBidsFiles(destDirBase, bidsScanList):
+    # Returns the "anat", "func", etc. subdirectories we will need and the (source, destination) of each file
+    subDirs = sorted({os.path.join(destDirBase, scan.subDir) for scan in bidsScanList})
+    files = [(f, os.path.join(destDirBase, scan.subDir, os.path.basename(f))) for scan in bidsScanList for f in scan.sourceFiles]
+    return subDirs, files
+
+def viewSource(src):
+    # src as the app reading the output will see it
+    return os.path.join(sourceRoot, os.path.relpath(os.path.abspath(src), os.path.abspath(inputDir)))
+
+def writeManifest(manifestPath, plannedFiles):
+    # One entry per BIDS file, with its path relative to the BIDS root, sorted by that path
+    files = sorted(({"path": os.path.relpath(dst, outputDir), "source": viewSource(src), "size": os.path.getsize(src)}
+                    for src, dst in plannedFiles), key=lambda entry: entry["path"])
+    manifest = {"sourceRoot": sourceRoot, "files": files}
+    tmpPath = manifestPath + '.tmp'
+    with open(tmpPath, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.rename(tmpPath, manifestPath)
+    print("Wrote manifest of {} files to {}.".format(len(files), manifestPath))
+
+def materialize(src, dst):
+    if view == 'symlinks':
+        os.symlink(viewSource(src), dst)
+    else:
+        linkFile(src, dst, linkMode)
 
-    # Now go through all the scans and copy their files into the correct subdirectory
-    for scan in bidsScanList:
-        destDir = os.path.join(destDirBase, scan.subDir)
-        for f in scan.sourceFiles:
-            shutil.copy(f, destDir)
+def findConflicts(plannedFiles):
+    # Returns a message for every destination that more than one source file would be written to
+    sources = {}
+    for src, dst in plannedFiles:
+        sources.setdefault(dst, []).append(src)
+    return ["{} would come from {}".format(dst, ", ".join(srcs)) for dst, srcs in sorted(sources.items()) if len(srcs) > 1]
 
 version = "1.0"
 args = docopt(__doc__, version=version)
 
 inputDir = args['<inputDir>']
 outputDir = args['<outputDir>']
+linkMode = args['--link-mode']
+view = args['--view']
+if view not in views:
+    print("ERROR: --view must be one of {}.".format(", ".join(views)))
+    sys.exit(1)
+sourceRoot = os.path.abspath(args['--source-root'] or inputDir)
+manifestPath = args['--manifest'] or (os.path.join(outputDir, MANIFEST_FILE) if view == 'manifest' else None)
+if linkMode not in ['auto'] + linkModes:
+    print("ERROR: --link-mode must be one of auto, {}.".format(", ".join(linkModes)))
+    sys.exit(1)
+try:
+    jobs = int(args['--jobs'])
+    if jobs < 1:
+        raise ValueError()
+except ValueError:
+    print("ERROR: --jobs must be a positive number.")
+    sys.exit(1)
 
 print("Input dir: {}".format(inputDir))
 print("Output dir: {}".format(outputDir))
 
+# Everything we will write
+plannedDirs = []
+plannedFiles = []
+
 # First check if the input directory is a session directory
-sessionBidsScans = bidsifySession(inputDir)
+sessionBidsScans = list(iterSessionScans(inputDir))
 
 bidsSubjectMap = {}
 if sessionBidsScans:
@@ -207,7 +366,7 @@ if sessionBidsScans:
     # Copy the BIDS/dataset_description.json to the root
     print("Copying BIDS description file to the root dir.")
     sessionBidsJsonPath = os.path.join(inputDir, 'RESOURCES', 'BIDS', 'dataset_description.json')
-    shutil.copy(sessionBidsJsonPath, outputDir)
+    plannedFiles.append((sessionBidsJsonPath, os.path.join(outputDir, 'dataset_description.json')))
 
 
 else:
@@ -215,23 +374,31 @@ else:
     print("")
     print("Checking subdirectories of {}.".format(inputDir))
 
-    for subSessionDir in os.listdir(inputDir):
-        subSessionBidsScans = bidsifySession(os.path.join(inputDir, subSessionDir))
-        if subSessionBidsScans:
-            subject = getSubjectForBidsScans(subSessionBidsScans)
-            if not subject:
-                print("SKIPPING. Could not determine subject for session {}.".format(subSessionDir))
-                continue
+    def searchSession(subSessionDir):
+        messages = []
+        return list(iterSessionScans(os.path.join(inputDir, subSessionDir), log=lambda *a: messages.append(a))), messages
+
+    # Search the sessions in parallel, then go through the results in name order so the output does not depend on timing
+    subSessionDirs = sorted(os.listdir(inputDir))
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for subSessionDir, (subSessionBidsScans, messages) in zip(subSessionDirs, pool.map(searchSession, subSessionDirs)):
+            for message in messages:
+                print(*message)
+            if subSessionBidsScans:
+                subject = getSubjectForBidsScans(subSessionBidsScans)
+                if not subject:
+                    print("SKIPPING. Could not determine subject for session {}.".format(subSessionDir))
+                    continue
+
+                print("Adding BIDS session {} to list for subject {}.".format(subSessionDir, subject))
+                bidsSession = BidsSession(subSessionDir, subSessionBidsScans)
+                if subject not in bidsSubjectMap:
+                    bidsSubjectMap[subject] = BidsSubject(subject, bidsSession=bidsSession)
+                else:
+                    bidsSubjectMap[subject].addBidsSession(bidsSession)
 
-            print("Adding BIDS session {} to list for subject {}.".format(subSessionDir, subject))
-            bidsSession = BidsSession(subSessionDir, subSessionBidsScans)
-            if subject not in bidsSubjectMap:
-                bidsSubjectMap[subject] = BidsSubject(subject, bidsSession=bidsSession)
             else:
-                bidsSubjectMap[subject].addBidsSession(bidsSession)
-
-        else:
-            print("No BIDS data found in session {}.".format(subSessionDir))
+                print("No BIDS data found in session {}.".format(subSessionDir))
 
 print("")
 
@@ -242,7 +409,7 @@ if not bidsSubjectMap:
 print("")
 allHaveSessions = True
 allHaveScans = True
-for bidsSubject in bidsSubjectMap.itervalues():
+for bidsSubject in bidsSubjectMap.values():
     allHaveSessions = allHaveSessions and bidsSubject.hasSessions()
     allHaveScans = allHaveScans and bidsSubject.hasScans()
 
@@ -250,21 +417,60 @@ if not (allHaveSessions ^ allHaveScans):
     print("ERROR: Somehow we have a mix of subjects with explicit sessions and subjects without explicit sessions. We must have either all subjects with sessions, or all subjects without. They cannot be mixed.")
     sys.exit(1)
 
-print("Copying BIDS data.")
-for bidsSubject in bidsSubjectMap.itervalues():
+for subjectLabel in sorted(bidsSubjectMap):
+    bidsSubject = bidsSubjectMap[subjectLabel]
     subjectDir = os.path.join(outputDir, "sub-" + bidsSubject.subjectLabel)
-    os.mkdir(subjectDir)
+    plannedDirs.append(subjectDir)
     print("Subject dir: ", subjectDir)
 
     if allHaveSessions:
         print("All have sessions")
         for bidsSession in bidsSubject.bidsSessions:
             sessionDir = os.path.join(subjectDir, "ses-" + bidsSession.sessionLabel)
-            os.mkdir(sessionDir)
-            copyScanBidsFiles(sessionDir, bidsSession.bidsScans)
+            plannedDirs.append(sessionDir)
+            subDirs, files = planScanBidsFiles(sessionDir, bidsSession.bidsScans)
+            plannedDirs.extend(subDirs)
+            plannedFiles.extend(files)
     else:
-        copyScanBidsFiles(subjectDir, bidsSubject.bidsScans)
-
-print(os.listdir(outputDir))
+        subDirs, files = planScanBidsFiles(subjectDir, bidsSubject.bidsScans)
+        plannedDirs.extend(subDirs)
+        plannedFiles.extend(files)
+
+conflicts = findConflicts(plannedFiles)
+if view != 'manifest':
+    conflicts.extend("{} already exists".format(path) for path in plannedDirs + [dst for _, dst in plannedFiles] if os.path.lexists(path))
+if conflicts:
+    print("ERROR: Not writing anything, because the output would have conflicts:")
+    for conflict in conflicts:
+        print("    " + conflict)
+    sys.exit(1)
 
-print("Done.")
\ No newline at end of file
+if manifestPath:
+    writeManifest(manifestPath, plannedFiles)
+if view == 'manifest':
+    print("Done.")
+    sys.exit(0)
+
+# Everything has been checked. Put the files in stagingDir, laid out as they will be in outputDir,
+# and then move them into place, so the BIDS tree appears all at once.
+stagingDir = os.path.join(outputDir, STAGING_DIR)
+if os.path.lexists(stagingDir):
+    # Left over from an interrupted run
+    shutil.rmtree(stagingDir)
+print("Copying BIDS data." if view == 'files' else "Linking BIDS data.")
+try:
+    stagedFiles = [(src, os.path.join(stagingDir, os.path.relpath(dst, outputDir))) for src, dst in plannedFiles]
+    for stagedDir in sorted({os.path.dirname(dst) for _, dst in stagedFiles}):
+        os.makedirs(stagedDir, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for future in [pool.submit(materialize, src, dst) for src, dst in stagedFiles]:
+            future.result()
+    for name in sorted(os.listdir(stagingDir)):
+        os.rename(os.path.join(stagingDir, name), os.path.join(outputDir, name))
+finally:
+    if os.path.lexists(stagingDir):
+        shutil.rmtree(stagingDir)
+
+print(sorted(os.listdir(outputDir)))
+
+print("Done.")